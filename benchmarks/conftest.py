@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from goshawk.midas import getStations, midasSubsetter, partitionIndex, syntheticData
+from goshawk.midas.rowTokenizer import RowTokenizer
+
+# Size of the generated archive. GOSHAWK_BENCH_DIR can point at an archive written by syntheticData.py
+# with the same number of stations, months and seed.
+BENCH_STATIONS = int(os.environ.get('GOSHAWK_BENCH_STATIONS', '200'))
+BENCH_MONTHS = os.environ.get('GOSHAWK_BENCH_MONTHS', '201601-201612').split('-')
+BENCH_SEED = int(os.environ.get('GOSHAWK_BENCH_SEED', '0'))
+
+
+def _use_archive(root):
+    """Points the subsetter and the station lookup at the archive and returns a function restoring them."""
+    metadata = os.path.join(root, 'metadata')
+    settings = [
+        (midasSubsetter, 'base_dir', root),
+        (midasSubsetter, 'datadir', os.path.join(root, 'data')),
+        (midasSubsetter, 'metadatadir', metadata),
+        (getStations, 'sourceFile', os.path.join(metadata, 'SRCE.DATA.COMMAS_REMOVED')),
+        (getStations, 'sourceColsFile', os.path.join(metadata, 'SOURCE.txt')),
+        (getStations, 'sourceCapabilitiesFile', os.path.join(metadata, 'SRCC.DATA')),
+        (getStations, 'sourceCapsColsFile', os.path.join(metadata, 'table_structures', 'SCTB.txt')),
+        (getStations, 'geogAreaFile', os.path.join(metadata, 'GEAR.DATA')),
+        (getStations, 'geogAreaColsFile', os.path.join(metadata, 'GEOGRAPHIC_AREA.txt')),
+    ]
+    saved = [(module, name, getattr(module, name)) for (module, name, value) in settings]
+    for (module, name, value) in settings:
+        setattr(module, name, value)
+
+    def restore():
+        for (module, name, value) in saved:
+            setattr(module, name, value)
+    return restore
+
+
+@pytest.fixture(scope='session')
+def synthetic_archive(tmpdir_factory):
+    """Writes (or reuses) a synthetic TD and RH archive with its partition indexes and returns its stations."""
+    root = os.environ.get('GOSHAWK_BENCH_DIR')
+    if not root:
+        root = str(tmpdir_factory.mktemp('midas'))
+    if not os.path.isdir(os.path.join(root, 'data')):
+        syntheticData.writeArchive(root, BENCH_STATIONS, BENCH_MONTHS[0], BENCH_MONTHS[-1], ('TD', 'RH'),
+                                   BENCH_SEED, verbose=0)
+
+    for name in sorted(os.listdir(os.path.join(root, 'data'))):
+        path = os.path.join(root, 'data', name)
+        if name.endswith('.txt') and partitionIndex.readTimeIndex(path) is None:
+            partitionIndex.buildPartitionIndexes(path, RowTokenizer(0, 6))
+
+    restore = _use_archive(root)
+    yield syntheticData.makeStations(BENCH_STATIONS, BENCH_MONTHS[0], BENCH_MONTHS[-1], seed=BENCH_SEED)
+    restore()
+
+
+@pytest.fixture(scope='session')
+def time_indexed_root(synthetic_archive, tmpdir_factory):
+    """Links the partitions of the synthetic archive into a directory where they only have time indexes."""
+    source = midasSubsetter.base_dir
+    root = str(tmpdir_factory.mktemp('midas-time-indexed'))
+    os.symlink(os.path.join(source, 'metadata'), os.path.join(root, 'metadata'))
+    os.mkdir(os.path.join(root, 'data'))
+    for name in sorted(os.listdir(os.path.join(source, 'data'))):
+        if name.endswith('.txt'):
+            path = os.path.join(root, 'data', name)
+            os.symlink(os.path.join(source, 'data', name), path)
+            partitionIndex.buildTimeIndex(path, RowTokenizer(0).getTime)
+    return root
+
+
+@pytest.fixture
+def time_indexed_archive(synthetic_archive, time_indexed_root):
+    """Points the subsetter at the synthetic archive without its zone maps and station indexes."""
+    restore = _use_archive(time_indexed_root)
+    yield synthetic_archive
+    restore()
@@ -0,0 +1,20 @@
+import pytest
+
+from goshawk.midas.getStations import StationIDGetter
+
+pytest.importorskip('pytest_benchmark')
+
+
+@pytest.mark.parametrize('counties', [['cornwall'], ['cornwall', 'devon', 'wiltshire', 'kent', 'highland']])
+def test_county_lookup(benchmark, synthetic_archive, counties):
+    getter = benchmark(StationIDGetter, counties, None, [], None, None, noprint=1)
+    assert getter.getStationList()
+
+
+@pytest.mark.parametrize('bbox', [(51, -5, 50, -4), (58.5, -6, 50, 1.7)], ids=['small', 'uk'])
+def test_bbox_lookup(benchmark, synthetic_archive, bbox):
+    benchmark(StationIDGetter, [], list(bbox), [], None, None, noprint=1)
+
+
+def test_bbox_lookup_with_capabilities(benchmark, synthetic_archive):
+    benchmark(StationIDGetter, [], [58.5, -6, 50, 1.7], ['rain'], '201601010000', '201612312359', noprint=1)
@@ -0,0 +1,87 @@
+import pytest
+
+from goshawk.midas.midasSubsetter import MIDASSubsetter, iterRecords
+
+from .conftest import BENCH_MONTHS
+
+pytest.importorskip('pytest_benchmark')
+
+YEAR = BENCH_MONTHS[0][:4]
+
+# Length of a long station list, e.g. all the stations of a large region
+LONG_STATION_LIST = 5000
+
+WINDOWS = {
+    'day': (YEAR + '01150000', YEAR + '01152359'),
+    'month': (YEAR + '01010000', YEAR + '01312359'),
+    'all': (BENCH_MONTHS[0] + '010000', BENCH_MONTHS[-1] + '312359'),
+}
+
+
+def run_extraction(benchmark, tmpdir, table, window, **kwargs):
+    output = tmpdir.join('output.txt')
+    (start, end) = WINDOWS[window]
+
+    def extract():
+        MIDASSubsetter([table], str(output), start, end, tempDir=str(tmpdir), verbose=0, **kwargs)
+
+    benchmark.pedantic(extract, rounds=3, iterations=1)
+    return output
+
+
+@pytest.mark.parametrize('table', ['TD', 'RH'])
+@pytest.mark.parametrize('window', ['day', 'month', 'all'])
+def test_time_window(benchmark, synthetic_archive, tmpdir, table, window):
+    run_extraction(benchmark, tmpdir, table, window)
+
+
+def get_src_ids(stations, n_stations):
+    """Returns ``n_stations`` ids: those of the archive's stations, then ids with no rows in the archive."""
+    src_ids = [station.src_id for station in stations[:n_stations]]
+    # The synthetic stations have ids below 100000
+    return src_ids + [str(src_id) for src_id in xrange(100000, 100000 + n_stations - len(src_ids))]
+
+
+@pytest.mark.parametrize('n_stations', [1, 10, 100, LONG_STATION_LIST])
+@pytest.mark.parametrize('window', ['month', 'all'])
+def test_station_list(benchmark, synthetic_archive, tmpdir, n_stations, window):
+    run_extraction(benchmark, tmpdir, 'RH', window, src_ids=get_src_ids(synthetic_archive, n_stations))
+
+
+@pytest.mark.parametrize('max_indexed_stations', [50, LONG_STATION_LIST])
+def test_long_station_list(benchmark, synthetic_archive, tmpdir, max_indexed_stations):
+    # The station index is only used for the long list when the limit is raised to its length
+    run_extraction(benchmark, tmpdir, 'RH', 'all', src_ids=get_src_ids(synthetic_archive, LONG_STATION_LIST),
+                   maxIndexedStations=max_indexed_stations)
+
+
+@pytest.mark.parametrize('columns', ['all', 'ob_end_time,src_id,prcp_amt'])
+def test_projection(benchmark, synthetic_archive, tmpdir, columns):
+    if columns != 'all':
+        columns = columns.split(',')
+    run_extraction(benchmark, tmpdir, 'RH', 'all', columns=columns)
+
+
+@pytest.mark.parametrize('seek_mode', ['index', 'bisect', 'scan'])
+def test_seek_mode(benchmark, time_indexed_archive, tmpdir, seek_mode):
+    # Without zone maps the scan reads the whole of each partition
+    run_extraction(benchmark, tmpdir, 'RH', 'day', seekMode=seek_mode)
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_workers(benchmark, synthetic_archive, tmpdir, workers):
+    run_extraction(benchmark, tmpdir, 'RH', 'all', workers=workers)
+
+
+def test_conditions(benchmark, synthetic_archive, tmpdir):
+    run_extraction(benchmark, tmpdir, 'RH', 'all', conditions={'prcp_amt:greater_than': '1.0'})
+
+
+@pytest.mark.parametrize('window', ['month', 'all'])
+def test_iter_records(benchmark, synthetic_archive, tmpdir, window):
+    (start, end) = WINDOWS[window]
+
+    def count():
+        return sum(1 for record in iterRecords(['RH'], start, end, tempDir=str(tmpdir), verbose=0))
+
+    benchmark.pedantic(count, rounds=3, iterations=1)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""
+cancellation.py
+===============
+
+Cancellation and deadlines for running MIDAS extractions.
+
+A ``CancellationToken`` is handed to ``MIDASSubsetter`` and can be cancelled from
+another thread (for example by a service whose client has abandoned the job). A
+deadline is a wall-clock time (in seconds since 1970, as from ``time.time()``)
+after which the extraction is given up. The partition scan checks both at
+regular intervals; when either has been reached the temporary and partial
+output files are removed and an ``ExtractionCancelled`` or
+``ExtractionDeadlineExceeded`` exception (both ``ExtractionInterrupted``) is
+raised.
+
+"""
+
+# Import required modules
+import time
+import threading
+
+
+class ExtractionInterrupted(Exception):
+    "Raised when an extraction is stopped before it has finished."
+    pass
+
+
+class ExtractionCancelled(ExtractionInterrupted):
+    "Raised when an extraction is stopped by its cancellation token."
+    pass
+
+
+class ExtractionDeadlineExceeded(ExtractionInterrupted):
+    "Raised when an extraction is still running at its deadline."
+    pass
+
+
+class CancellationToken:
+    """
+    Flag that is set to ask a running extraction to stop. It can be set from
+    any thread.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        "Asks the extraction to stop."
+        self.event.set()
+
+    def isCancelled(self):
+        "Returns True if the extraction has been asked to stop."
+        return self.event.is_set()
+
+
+class InterruptCheck:
+    """
+    Checks a cancellation token and a deadline (either can be None).
+    """
+
+    def __init__(self, cancelToken=None, deadline=None):
+        self.cancelToken = cancelToken
+        self.deadline = deadline
+
+    def isActive(self):
+        "Returns True if there is anything to check."
+        return self.cancelToken is not None or self.deadline is not None
+
+    def check(self):
+        """
+        Raises ``ExtractionCancelled`` if the token has been cancelled or
+        ``ExtractionDeadlineExceeded`` if the deadline has passed.
+        """
+        if self.cancelToken is not None and self.cancelToken.isCancelled():
+            raise ExtractionCancelled("The extraction was cancelled.")
+        if self.deadline is not None and time.time() > self.deadline:
+            raise ExtractionDeadlineExceeded("The extraction did not finish before its deadline.")
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+"""
+columnarStore.py
+================
+
+Converts MIDAS partition files into a columnar copy and queries it.
+
+The text partitions remain the source of truth: the columnar copy is derived from
+them (and should be rebuilt after each data release) to make filtering quicker.
+Each partition 'nonsense-data_tempdrnl_201701-201712.txt' gets a directory
+'nonsense-data_tempdrnl_201701-201712.txt.columns' holding one NumPy array file
+per column:
+
+    - the time column (and any other date/time column) as int64 YYYYMMDDhhmm values
+    - src_id as int32 (-1 where it is not a number written without leading
+      zeros, so that it is matched exactly as the text is)
+    - other numeric columns as float32 (NaN where empty)
+    - '_offset.npy' and '_length.npy' giving the position of each row in the text file
+
+Columns holding text are not converted. Queries on time and station are done as
+vectorized masks over the arrays and the matching rows are then read from the
+text partition, so the output is exactly the same as filtering the text.
+
+This module needs NumPy, which is optional: if it is not installed the columnar
+copies are simply not used.
+
+Usage:
+======
+
+    columnarStore.py -t <table> [<partition_file> ...]
+
+Where:
+------
+
+    <table>     - is the name of the MIDAS table
+    <partition_file> - files to convert (default is all partitions of the table)
+
+Examples:
+=========
+
+columnarStore.py -t TD
+
+"""
+
+# Import required modules
+import os
+import sys
+import getopt
+import shutil
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import partitionCatalog
+import compressedPartition
+from rowTokenizer import fieldSeparator, parseTime, canonicalSrcId
+
+
+storeSuffix = ".columns"
+completeFlag = "_complete"
+# Suffix of the files gathering the values of a column while a store is built
+chunkSuffix = ".chunks"
+
+# Number of rows read before their values are written out
+chunkRows = 65536
+
+
+def getStorePath(partitionPath):
+    "Returns the path of the columnar copy of a partition file."
+    return partitionPath + storeSuffix
+
+
+def hasColumnarStore(partitionPath):
+    """
+    Returns True if NumPy is available and the partition has a columnar copy
+    that is newer than the partition itself.
+    """
+    if numpy is None:
+        return False
+
+    flagPath = os.path.join(getStorePath(partitionPath), completeFlag)
+    try:
+        return os.path.getmtime(flagPath) >= os.path.getmtime(partitionPath)
+    except OSError:
+        return False
+
+
+def _toNumber(value):
+    """
+    Returns the value of a field as a number (date/times as YYYYMMDDhhmm), None
+    if it is empty, or raises ValueError if it is not numeric.
+    """
+    if value == "":
+        return None
+    dateLong = parseTime(value, 0)
+    if dateLong is not None:
+        return dateLong
+    return float(value)
+
+
+def _toSrcIdNumber(value):
+    """
+    Returns a src_id as a number, or None if it is not a number in the form
+    requested station IDs are matched in (see ``canonicalSrcId``).
+    """
+    if not value.isdigit() or canonicalSrcId(value) != value:
+        return None
+    return int(value)
+
+
+def _flushChunk(buffers, chunkFiles):
+    "Appends each buffer of values to its file (if it still has one) and empties it."
+    for (buf, chunkFile) in zip(buffers, chunkFiles):
+        if chunkFile is not None:
+            buf.tofile(chunkFile)
+        del buf[:]
+
+
+def _writeColumn(chunkPath, columnPath, nRows, sourceType, targetType, convert=None):
+    """
+    Writes the ``nRows`` values of ``sourceType`` held in the file ``chunkPath``
+    to the NumPy array file ``columnPath`` as ``targetType``, a chunk at a time
+    (applying ``convert`` to each chunk if given), and removes ``chunkPath``.
+    """
+    chunkFile = open(chunkPath, "rb")
+    columnFile = open(columnPath, "wb")
+    numpy.lib.format.write_array_header_1_0(columnFile, {
+        "descr": numpy.lib.format.dtype_to_descr(numpy.dtype(targetType)), "fortran_order": False,
+        "shape": (nRows,)})
+    for start in xrange(0, nRows, chunkRows):
+        chunk = numpy.fromfile(chunkFile, dtype=sourceType, count=chunkRows)
+        if convert is not None:
+            chunk = convert(chunk)
+        chunk.astype(targetType).tofile(columnFile)
+    columnFile.close()
+    chunkFile.close()
+    os.remove(chunkPath)
+
+
+def buildColumnarStore(partitionPath, columnNames, timeIndex, srcidIndex):
+    """
+    Converts the partition file into its columnar copy. ``columnNames`` gives the
+    name of each column in the table. The values are written out every
+    ``chunkRows`` rows, so the memory used does not grow with the partition.
+    Returns the path to the store directory.
+    """
+    if numpy is None:
+        raise Exception("NumPy is required to build columnar copies of partition files.")
+
+    storePath = getStorePath(partitionPath)
+    if os.path.isdir(storePath):
+        shutil.rmtree(storePath)
+    os.mkdir(storePath)
+
+    nColumns = len(columnNames)
+    # Each column is gathered as doubles in a chunk file and converted to its final type at the end
+    chunkPaths = [os.path.join(storePath, "%s%s" % (name, chunkSuffix)) for name in columnNames]
+    chunkFiles = [open(chunkPath, "wb") for chunkPath in chunkPaths]
+    values = [array.array("d") for name in columnNames]
+    positionPaths = [os.path.join(storePath, "_%s%s" % (name, chunkSuffix)) for name in ("offset", "length")]
+    positionFiles = [open(positionPath, "wb") for positionPath in positionPaths]
+    (offsets, lengths) = positions = (array.array("l"), array.array("l"))
+    # Whether each column holds date/times (True), numbers (False) or is not known yet (None)
+    isTime = [None] * nColumns
+    isNumeric = [True] * nColumns
+    nan = float("nan")
+
+    nRows = 0
+    offset = 0
+    partition = open(partitionPath, "rb")
+    for line in partition:
+        fields = line.rstrip().split(fieldSeparator)
+        fields.extend([""] * (nColumns - len(fields)))
+
+        offsets.append(offset)
+        lengths.append(len(line))
+        offset += len(line)
+        nRows += 1
+
+        for i in xrange(nColumns):
+            if not isNumeric[i]:
+                continue
+
+            try:
+                if i == srcidIndex:
+                    number = _toSrcIdNumber(fields[i])
+                else:
+                    number = _toNumber(fields[i])
+            except ValueError:
+                if i in (timeIndex, srcidIndex):
+                    number = -1
+                else:
+                    isNumeric[i] = False
+                    continue
+
+            if number is None:
+                number = -1 if i in (timeIndex, srcidIndex) else nan
+            elif i not in (timeIndex, srcidIndex):
+                numberIsTime = type(number) != float
+                if isTime[i] is None:
+                    isTime[i] = numberIsTime
+                elif isTime[i] != numberIsTime:
+                    # Mixture of date/times and numbers
+                    isNumeric[i] = False
+                    continue
+
+            values[i].append(number)
+
+        if nRows % chunkRows == 0:
+            # Columns found not to be numeric are no longer written
+            for i in xrange(nColumns):
+                if not isNumeric[i] and chunkFiles[i] is not None:
+                    chunkFiles[i].close()
+                    chunkFiles[i] = None
+            _flushChunk(values, chunkFiles)
+            _flushChunk(positions, positionFiles)
+    partition.close()
+
+    _flushChunk(values, chunkFiles)
+    _flushChunk(positions, positionFiles)
+    for chunkFile in chunkFiles + positionFiles:
+        if chunkFile is not None:
+            chunkFile.close()
+
+    _writeColumn(positionPaths[0], os.path.join(storePath, "_offset.npy"), nRows, numpy.int64, numpy.int64)
+    _writeColumn(positionPaths[1], os.path.join(storePath, "_length.npy"), nRows, numpy.int64, numpy.int32)
+
+    for i, name in enumerate(columnNames):
+        if not isNumeric[i]:
+            os.remove(chunkPaths[i])
+            continue
+
+        columnPath = os.path.join(storePath, "%s.npy" % name)
+        if i == srcidIndex:
+            _writeColumn(chunkPaths[i], columnPath, nRows, numpy.float64, numpy.int32)
+        elif i == timeIndex or isTime[i]:
+            _writeColumn(chunkPaths[i], columnPath, nRows, numpy.float64, numpy.int64,
+                         lambda chunk: numpy.where(numpy.isnan(chunk), -1, chunk))
+        else:
+            _writeColumn(chunkPaths[i], columnPath, nRows, numpy.float64, numpy.float32)
+
+    open(os.path.join(storePath, completeFlag), "w").close()
+    return storePath
+
+
+def loadColumn(partitionPath, name):
+    """
+    Returns the named column of the partition's columnar copy as a read-only
+    memory-mapped array.
+    """
+    return numpy.load(os.path.join(getStorePath(partitionPath), "%s.npy" % name), mmap_mode="r")
+
+
+def queryRowPositions(partitionPath, timeColumn, startTimeLong, endTimeLong, srcidColumn=None,
+                      src_ids=None, byteRange=None):
+    """
+    Returns arrays of (offsets, lengths) of the rows of the partition with times
+    between ``startTimeLong`` and ``endTimeLong`` (inclusive) and, if given, a
+    src_id in ``src_ids``. If ``byteRange`` is given as (start, end) only rows
+    starting in that range are returned.
+    """
+    times = loadColumn(partitionPath, timeColumn)
+    offsets = loadColumn(partitionPath, "_offset")
+
+    mask = (times >= startTimeLong) & (times <= endTimeLong)
+
+    if src_ids is not None:
+        ids = numpy.array([int(src_id) for src_id in src_ids if src_id.isdigit()], dtype=numpy.int32)
+        mask &= numpy.in1d(loadColumn(partitionPath, srcidColumn), ids)
+
+    if byteRange is not None:
+        mask &= (offsets >= byteRange[0]) & (offsets < byteRange[1])
+
+    rows = numpy.flatnonzero(mask)
+    return (offsets[rows], loadColumn(partitionPath, "_length")[rows])
+
+
+if __name__ == "__main__":
+
+    from midasSubsetter import tableMatch, getTimeColumnIndex, getColumnIndex, exitNicely, \
+        metadatadir, datadir, midasStructureTable
+
+    argList = sys.argv[1:]
+    (args, partitionFiles) = getopt.getopt(argList, "t:")
+
+    tableName = None
+
+    for arg, value in args:
+        if arg == "-t":
+            tableName = value.upper()
+
+    if not tableName:
+        exitNicely("Must provide table name with '-t' argument.")
+    if numpy is None:
+        exitNicely("NumPy must be installed to build columnar copies.")
+
+    (tableID, longTableName) = tableMatch(tableName)
+    structureFile = os.path.join(metadatadir, "table_structures/%sTB.txt" % tableID)
+    columnNames = [col.strip().lower() for col in open(structureFile).readlines()]
+
+    if not partitionFiles:
+        # Compressed partitions are read by streaming so are not converted here
+        partitionFiles = [pfile for pfile in
+                          partitionCatalog.getPartitionFiles(datadir, longTableName, manifest=midasStructureTable)
+                          if not compressedPartition.isCompressed(pfile)]
+
+    for partitionFile in partitionFiles:
+        storePath = buildColumnarStore(partitionFile, columnNames, getTimeColumnIndex(tableID),
+                                       getColumnIndex(tableID, "src_id"))
+        print "Wrote columnar copy: %s" % storePath
@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+
+"""
+compressedPartition.py
+======================
+
+Compresses MIDAS partition files and reads them back by streaming decompression.
+
+A partition 'nonsense-data_tempdrnl_201701-201712.txt' can be kept compressed as
+'nonsense-data_tempdrnl_201701-201712.txt.gz' (or '.bz2', '.xz' or '.zst'). The
+subsetter reads compressed partitions transparently. gzip and bz2 are always
+available; xz needs the 'lzma' module (or 'backports.lzma') and zstd needs the
+'zstandard' package.
+
+When compressed with this module the file is written as a series of independently
+compressed blocks, each holding whole rows (about 4MB uncompressed by default).
+The result is still a standard compressed file (a concatenation of members or
+frames) that any tool can decompress. A block index is written next to it with the
+suffix '.blocks', giving the codec and the time of the first row and the offset
+of each block:
+
+    codec gzip
+    201701010900 0
+    201701140900 402112
+    ...
+
+Requests for a time window then start decompressing at the block holding the
+start time rather than at the start of the file, and ranges of blocks can be
+decompressed in parallel. Compressed files without a block index are read from
+the start.
+
+Each block is decompressed up to the offset of the next one, so files with several
+members (or frames) are read correctly whatever the codec. A zstd file with
+several frames and no block index (e.g. one written by another tool) needs a
+'zstandard' package that reports the end of each frame (version 0.15 or later);
+older versions only read the first frame of such files.
+
+Usage:
+======
+
+    compressedPartition.py -t <table> [-c <codec>] [-b <block_size>] [-r] [<partition_file> ...]
+
+Where:
+------
+
+    <table>     - is the name of the MIDAS table
+    -c          - codec: "gzip" (default), "bz2", "xz" or "zstd"
+    -b          - uncompressed size of each block in bytes (default 4194304)
+    -r          - remove each partition file once it has been compressed
+    <partition_file> - files to compress (default is all uncompressed partitions of the table)
+
+Examples:
+=========
+
+compressedPartition.py -t TD
+
+compressedPartition.py -t TD -c bz2 -r data/nonsense-data_tempdrnl_201701-201712.txt
+
+"""
+
+# Import required modules
+import os
+import sys
+import getopt
+import bisect
+import io
+import zlib
+import bz2
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import partitionCatalog
+
+
+blocksSuffix = ".blocks"
+defaultBlockSize = 4 * 1024 * 1024
+
+# Size of the reads from the compressed file
+readSize = 1024 * 1024
+
+# File name suffix of each codec
+codecSuffixes = {"gzip": ".gz", "bz2": ".bz2", "xz": ".xz", "zstd": ".zst"}
+
+
+def _getModule(codec):
+    "Returns the module needed by the codec or raises an Exception if it is not installed."
+    module = {"gzip": zlib, "bz2": bz2, "xz": lzma, "zstd": zstandard}.get(codec, False)
+    if module is False:
+        raise Exception("Compression codec not known: %s" % codec)
+    if module is None:
+        raise Exception("The '%s' codec needs a module that is not installed." % codec)
+    return module
+
+
+def _compressBlock(codec, data):
+    "Returns ``data`` compressed as a single member (or frame) of the codec."
+    if codec == "gzip":
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    elif codec == "bz2":
+        return bz2.compress(data)
+    elif codec == "xz":
+        return _getModule(codec).compress(data)
+    return _getModule(codec).ZstdCompressor().compress(data)
+
+
+def _newDecompressor(codec):
+    "Returns a decompressor for one member (or frame) of the codec."
+    if codec == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif codec == "bz2":
+        return bz2.BZ2Decompressor()
+    elif codec == "xz":
+        return _getModule(codec).LZMADecompressor()
+    return _getModule(codec).ZstdDecompressor().decompressobj()
+
+
+def getCodec(partitionPath):
+    "Returns the codec of a partition file from its suffix, or None if it is not compressed."
+    for codec, suffix in codecSuffixes.items():
+        if partitionPath.endswith(suffix):
+            return codec
+    return None
+
+
+def isCompressed(partitionPath):
+    "Returns True if the partition file is compressed."
+    return getCodec(partitionPath) is not None
+
+
+def getBlocksPath(partitionPath):
+    "Returns the path of the block index for a compressed partition file."
+    return partitionPath + blocksSuffix
+
+
+def _iterMembers(raw, codec, end=None):
+    """
+    Yields the decompressed data read from the open compressed file ``raw``, from
+    its current position up to offset ``end`` (default is the end of the file).
+    Any number of concatenated members (or frames) are decompressed in turn.
+    """
+    decompressor = _newDecompressor(codec)
+
+    while True:
+        size = readSize
+        if end is not None:
+            size = min(size, end - raw.tell())
+            if size <= 0:
+                break
+
+        data = raw.read(size)
+        if not data:
+            break
+
+        while data:
+            try:
+                decompressed = decompressor.decompress(data)
+            except EOFError:
+                # The previous member has ended so the data starts the next one
+                decompressor = _newDecompressor(codec)
+                continue
+
+            if decompressed:
+                yield decompressed
+
+            data = getattr(decompressor, "unused_data", "")
+            if data:
+                decompressor = _newDecompressor(codec)
+
+
+def _iterDecompressed(raw, codec, end=None, blockOffsets=None):
+    """
+    Yields the decompressed data read from the open compressed file ``raw``, from
+    its current position (the start of a block) up to offset ``end``. With the
+    ``blockOffsets`` of a block index each block is decompressed on its own, so
+    the end of each member (or frame) is known without relying on the codec to
+    find it.
+    """
+    if not blockOffsets:
+        for decompressed in _iterMembers(raw, codec, end):
+            yield decompressed
+        return
+
+    start = raw.tell()
+    blockEnds = [offset for offset in blockOffsets if offset > start and (end is None or offset < end)]
+    for blockEnd in blockEnds + [end]:
+        for decompressed in _iterMembers(raw, codec, blockEnd):
+            yield decompressed
+
+
+class _DecompressedStream(io.RawIOBase):
+    """
+    Raw stream of the decompressed contents of part of a compressed file.
+    """
+
+    def __init__(self, raw, codec, end=None, blockOffsets=None):
+        self.raw = raw
+        self.chunks = _iterDecompressed(raw, codec, end, blockOffsets)
+        self.pending = ""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            try:
+                self.pending = next(self.chunks)
+            except StopIteration:
+                return 0
+
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+        io.RawIOBase.close(self)
+
+
+def openPartition(partitionPath, start=0, end=None):
+    """
+    Returns a buffered file object (with ``readline()`` and iteration) reading
+    the decompressed rows of the compressed partition from the block at offset
+    ``start`` up to the block at offset ``end`` (default is the end of the file).
+    """
+    index = readBlockIndex(partitionPath)
+    blockOffsets = index[1] if index is not None else None
+
+    raw = open(partitionPath, "rb")
+    raw.seek(start)
+    return io.BufferedReader(_DecompressedStream(raw, getCodec(partitionPath), end, blockOffsets), readSize)
+
+
+def compressPartition(partitionPath, codec="gzip", blockSize=defaultBlockSize, getTime=None):
+    """
+    Writes a compressed copy of the partition file as a series of blocks of
+    whole rows, and its block index. ``getTime`` is called on the first row of
+    each block and returns its time as a long (YYYYMMDDhhmm) or None. Returns
+    the path of the compressed file.
+    """
+    _getModule(codec)
+    compressedPath = partitionPath + codecSuffixes[codec]
+    tempPath = compressedPath + ".tmp"
+
+    entries = []
+    lastTime = 0
+    partition = open(partitionPath, "rb")
+    output = open(tempPath, "wb")
+
+    block = partition.read(blockSize)
+    while block:
+        # Complete the last row so that blocks hold whole rows
+        block += partition.readline()
+
+        if getTime is not None:
+            lastTime = getTime(block) or lastTime
+        entries.append((lastTime, output.tell()))
+        output.write(_compressBlock(codec, block))
+        block = partition.read(blockSize)
+
+    partition.close()
+    output.close()
+    os.rename(tempPath, compressedPath)
+
+    # The index is written after the partition so that it is newer
+    blocksPath = getBlocksPath(compressedPath)
+    output = open(blocksPath + ".tmp", "w")
+    output.write("codec %s\n" % codec)
+    for blockTime, offset in entries:
+        output.write("%s %s\n" % (blockTime, offset))
+    output.close()
+    os.rename(blocksPath + ".tmp", blocksPath)
+
+    return compressedPath
+
+
+def readBlockIndex(partitionPath):
+    """
+    Returns a tuple of (times, offsets) for the blocks of the compressed
+    partition, or None if there is no block index or it is older than the
+    partition.
+    """
+    blocksPath = getBlocksPath(partitionPath)
+    try:
+        if os.path.getmtime(blocksPath) < os.path.getmtime(partitionPath):
+            return None
+        index = open(blocksPath)
+    except (IOError, OSError):
+        return None
+
+    index.readline()
+    times = []
+    offsets = []
+    for line in index:
+        blockTime, offset = line.split()
+        times.append(long(blockTime))
+        offsets.append(long(offset))
+    index.close()
+
+    return (times, offsets)
+
+
+def getBlockStart(partitionPath, startTimeLong):
+    """
+    Returns the offset of the block from which to read rows at or after
+    ``startTimeLong``: the last block starting before that time (rows at the
+    start time can end the previous block). Returns 0 if there is no block index.
+    """
+    index = readBlockIndex(partitionPath)
+    if index is None:
+        return 0
+
+    (times, offsets) = index
+    position = bisect.bisect_left(times, startTimeLong) - 1
+    if position < 0:
+        return 0
+    return offsets[position]
+
+
+def getBlockRanges(partitionPath, start=0, splitSize=None):
+    """
+    Returns a list of (start, end) offset ranges, aligned to blocks, covering
+    the compressed partition from offset ``start`` in pieces of about
+    ``splitSize`` compressed bytes. Without a block index (or a ``splitSize``)
+    the rest of the file is one range.
+    """
+    size = os.path.getsize(partitionPath)
+    index = readBlockIndex(partitionPath)
+    if index is None or splitSize is None:
+        return [(start, size)] if start < size else []
+
+    boundaries = [start]
+    for offset in index[1]:
+        if offset - boundaries[-1] >= splitSize:
+            boundaries.append(offset)
+    boundaries.append(size)
+
+    return [(first, last) for (first, last) in zip(boundaries[:-1], boundaries[1:]) if first < last]
+
+
+if __name__ == "__main__":
+
+    from midasSubsetter import tableMatch, getTimeColumnIndex, exitNicely, datadir, midasStructureTable
+    from rowTokenizer import RowTokenizer
+
+    argList = sys.argv[1:]
+    (args, partitionFiles) = getopt.getopt(argList, "t:c:b:r")
+
+    tableName = None
+    codec = "gzip"
+    blockSize = defaultBlockSize
+    removeOriginal = False
+
+    for arg, value in args:
+        if arg == "-t":
+            tableName = value.upper()
+        elif arg == "-c":
+            codec = value
+        elif arg == "-b":
+            blockSize = int(value)
+        elif arg == "-r":
+            removeOriginal = True
+
+    if not tableName:
+        exitNicely("Must provide table name with '-t' argument.")
+    if codec not in codecSuffixes:
+        exitNicely("Codec must be one of: %s" % ", ".join(codecSuffixes.keys()))
+
+    (tableID, longTableName) = tableMatch(tableName)
+    tokenizer = RowTokenizer(getTimeColumnIndex(tableID))
+
+    if not partitionFiles:
+        partitionFiles = [pfile for pfile in
+                          partitionCatalog.getPartitionFiles(datadir, longTableName, manifest=midasStructureTable)
+                          if not isCompressed(pfile)]
+
+    for partitionFile in partitionFiles:
+        compressedPath = compressPartition(partitionFile, codec, blockSize, tokenizer.getTime)
+        print "Wrote compressed partition: %s (%s -> %s bytes)" % (
+            compressedPath, os.path.getsize(partitionFile), os.path.getsize(compressedPath))
+        if removeOriginal:
+            os.unlink(partitionFile)
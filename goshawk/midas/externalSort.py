@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+"""
+externalSort.py
+===============
+
+Sorts the rows of MIDAS extractions of any size in bounded memory.
+
+Rows are gathered in memory up to a byte budget (128MB by default). Each time
+the budget is reached the rows are sorted and written to a run file in the
+temporary directory. When all the rows have been seen the runs are merged (a
+k-way merge reading each run line by line) and the rows are passed on, in
+order, to the output writer. No more than 64 runs are merged at once: whenever
+64 runs of the same size have been written they are merged into one larger
+run, and any runs left over beyond 64 at the end are merged in further passes,
+so the number of run files open at a time stays bounded. If all the rows fit within the budget they are
+sorted in memory and no run files are written. The sorted rows can also be
+taken from ``SortingOutputWriter.iterRows`` instead of being passed to a writer.
+
+Rows can be sorted by station (src_id and then time) or by time (time and then
+src_id). src_ids are compared as numbers where possible.
+
+"""
+
+# Import required modules
+import heapq
+import tempfile
+import itertools
+
+from rowTokenizer import RowTokenizer
+
+
+sortOrders = ("station", "time")
+
+# Bytes of rows held in memory before a sorted run is written to disk
+defaultMaxBytes = 128 * 1024 * 1024
+
+# Largest number of runs merged in one pass
+maxMergeRuns = 64
+
+# Number of rows passed to the output writer at a time
+writeBatchSize = 1000
+
+
+def _toSortableId(src_id):
+    "Returns src_id as a key that orders numeric IDs by value and other IDs after them."
+    src_id = (src_id or "").strip()
+    try:
+        return (0, int(src_id), "")
+    except ValueError:
+        return (1, 0, src_id)
+
+
+class RowSortKey:
+    """
+    Callable returning the sort key of a row for one of the ``sortOrders``.
+    ``getChunk`` (if given) maps the time of a row to the index of its output
+    file so that each file is sorted separately.
+    """
+
+    def __init__(self, sortOrder, timeIndex, srcidIndex, getChunk=None):
+        if sortOrder not in sortOrders:
+            raise Exception("Sort order must be one of: %s" % ", ".join(sortOrders))
+        if timeIndex is None or srcidIndex is None:
+            raise Exception("The time and src_id columns must be selected to sort the output.")
+
+        self.byStation = sortOrder == "station"
+        self.tokenizer = RowTokenizer(timeIndex, srcidIndex)
+        self.getChunk = getChunk
+
+    def __call__(self, row):
+        dateLong = self.tokenizer.getTime(row) or 0
+        src_id = _toSortableId(self.tokenizer.getSrcId(row))
+        chunk = self.getChunk(dateLong) if self.getChunk is not None else 0
+
+        if self.byStation:
+            return (chunk, src_id, dateLong)
+        return (chunk, dateLong, src_id)
+
+
+def _iterRun(runFile, getKey, runIndex):
+    "Yields (key, runIndex, row) for each row of an open run file."
+    runFile.seek(0)
+    for row in runFile:
+        yield (getKey(row), runIndex, row)
+
+
+def _mergeRuns(runFiles, getKey):
+    "Yields the rows of the open run files in sorted order (rows of earlier runs first for equal keys)."
+    streams = [_iterRun(runFile, getKey, i) for (i, runFile) in enumerate(runFiles)]
+    for (key, runIndex, row) in heapq.merge(*streams):
+        yield row
+
+
+class SortingOutputWriter:
+    """
+    Output writer that sorts the rows written to it and passes them on to
+    another writer when it is closed.
+    """
+
+    def __init__(self, writer, getKey, tempDir=None, maxBytes=defaultMaxBytes):
+        """
+        Sorts rows by ``getKey(row)`` into ``writer``, writing runs of sorted
+        rows to files in ``tempDir`` when more than ``maxBytes`` are held.
+        ``writer`` can be None if the rows are taken from ``iterRows``.
+        """
+        self.writer = writer
+        self.getKey = getKey
+        self.tempDir = tempDir
+        self.maxBytes = maxBytes
+        self.rows = []
+        self.size = 0
+        # List of (level, runFile) in the order written: a run of level n holds 64**n runs
+        self.runs = []
+
+    def write(self, rows):
+        """
+        Adds one or more complete rows to be sorted.
+        """
+        self.rows.extend(rows.splitlines(True))
+        self.size += len(rows)
+        if self.size >= self.maxBytes:
+            self._writeRun()
+
+    def _sortRows(self):
+        "Returns the rows held in memory sorted by their keys."
+        getKey = self.getKey
+        rows = self.rows
+        self.rows = []
+        self.size = 0
+        return sorted(rows, key=getKey)
+
+    def _writeRun(self):
+        """
+        Writes the rows held in memory to a new run file in sorted order,
+        merging the last ``maxMergeRuns`` runs whenever they are of one level.
+        """
+        self.runs.append((0, self._newRun(self._sortRows())))
+
+        while len(self.runs) >= maxMergeRuns:
+            level = self.runs[-1][0]
+            if any(runLevel != level for (runLevel, runFile) in self.runs[-maxMergeRuns:]):
+                break
+            self._mergeLastRuns(maxMergeRuns, level + 1)
+
+    def _newRun(self, rows):
+        "Returns a new run file holding ``rows``."
+        runFile = tempfile.TemporaryFile(prefix="sortrun_", dir=self.tempDir)
+        runFile.writelines(rows)
+        return runFile
+
+    def _mergeLastRuns(self, nRuns, level):
+        "Replaces the last ``nRuns`` runs with a run of ``level`` holding their rows merged."
+        runFiles = [runFile for (runLevel, runFile) in self.runs[-nRuns:]]
+        mergedRun = self._newRun(_mergeRuns(runFiles, self.getKey))
+        del self.runs[-nRuns:]
+        for runFile in runFiles:
+            runFile.close()
+        self.runs.append((level, mergedRun))
+
+    def _writeRows(self, rows):
+        "Passes the sorted rows to the output writer in batches."
+        while True:
+            batch = list(itertools.islice(rows, writeBatchSize))
+            if not batch:
+                break
+            self.writer.write("".join(batch))
+
+    def iterRows(self):
+        """
+        Yields all the rows written so far (with their line endings) in sorted
+        order. The run files are removed when the last row has been taken.
+        """
+        try:
+            if not self.runs:
+                for row in self._sortRows():
+                    yield row
+            else:
+                if self.rows:
+                    self._writeRun()
+                # Merge the smallest runs until the rest can be merged in one pass
+                while len(self.runs) > maxMergeRuns:
+                    nRuns = min(maxMergeRuns, len(self.runs) - maxMergeRuns + 1)
+                    self._mergeLastRuns(nRuns, self.runs[-nRuns][0] + 1)
+                for row in _mergeRuns([runFile for (level, runFile) in self.runs], self.getKey):
+                    yield row
+        finally:
+            self._closeRuns()
+
+    def close(self):
+        """
+        Writes all the rows, sorted, to the output writer and closes it.
+        """
+        rows = self.iterRows()
+        try:
+            self._writeRows(rows)
+        finally:
+            rows.close()
+
+        self.writer.close()
+
+    def _closeRuns(self):
+        "Closes (and so removes) the run files."
+        for (level, runFile) in self.runs:
+            runFile.close()
+        self.runs = []
+
+    def abort(self):
+        """
+        Drops the rows, removes the run files and aborts the output writer.
+        """
+        self.rows = []
+        self._closeRuns()
+        if self.writer is not None:
+            self.writer.abort()
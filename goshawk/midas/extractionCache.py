@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+"""
+extractionCache.py
+==================
+
+On-disk cache of the output files of MIDAS extractions.
+
+Each request is identified by a hash of its canonical form: the table IDs, the
+padded start and end times, the sorted station IDs, the columns, conditions,
+delimiter, region, whether tables are merged and the time chunk, format and sort
+order of the output.
+The output files of a request are kept in a directory of the cache named by that
+hash, along with a fingerprint of the partition files that were read (their
+names, sizes and modification times). A repeated request is then answered by
+hard-linking (or copying, if the cache is on another file system) the cached
+files to the requested output paths instead of scanning the partitions again.
+
+An entry is dropped as soon as the fingerprint of the partitions changes. The
+total size of the cache is kept within a byte budget by removing the least
+recently used entries.
+
+"""
+
+# Import required modules
+import os
+import shutil
+import hashlib
+import json
+
+import midasSubsetter
+import partitionCatalog
+from outputWriters import getDelimiter
+from rowTokenizer import canonicalSrcId
+
+
+# Default byte budget of the cache
+defaultMaxBytes = 10 * 1024 * 1024 * 1024
+
+fingerprintName = "_catalog"
+
+
+def _linkOrCopy(sourcePath, targetPath):
+    "Hard links ``targetPath`` to ``sourcePath``, or copies it if they cannot be linked."
+    if os.path.exists(targetPath):
+        os.unlink(targetPath)
+    try:
+        os.link(sourcePath, targetPath)
+    except OSError:
+        shutil.copyfile(sourcePath, targetPath)
+
+
+class ExtractionCache:
+    """
+    Cache of extraction outputs held in ``cacheDir`` within ``maxBytes`` bytes.
+    """
+
+    def __init__(self, cacheDir, maxBytes=defaultMaxBytes, verbose=1):
+        """
+        Creates the cache directory if it does not exist.
+        """
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.verbose = verbose
+
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+    def getKey(self, tables, startTime, endTime, columns="all", conditions=None, src_ids=None, region=None,
+               delimiter="default", mergeTables=False, timeChunk=None, outputFormat="text",
+               sortOrder=None):
+        """
+        Returns the hash identifying a request. ``tables`` is a list of (tableID,
+        tableName) tuples.
+        """
+        if columns != "all":
+            columns = [str(column).strip().lower() for column in columns]
+        if src_ids:
+            src_ids = sorted(set(canonicalSrcId(src_id) for src_id in src_ids))
+
+        request = {"tables": [tableID for (tableID, tableName) in tables],
+                   "startTime": midasSubsetter.padTime(startTime),
+                   "endTime": midasSubsetter.padTime(endTime),
+                   "columns": columns,
+                   "conditions": sorted(conditions.items()) if conditions else None,
+                   "src_ids": src_ids or None,
+                   "region": region,
+                   "delimiter": getDelimiter(delimiter),
+                   "mergeTables": bool(mergeTables) and len(tables) > 1,
+                   "timeChunk": timeChunk,
+                   "outputFormat": outputFormat,
+                   "sortOrder": sortOrder}
+        return hashlib.sha1(json.dumps(request, sort_keys=True)).hexdigest()
+
+    def getFingerprint(self, tables, region=None):
+        """
+        Returns a hash of the names, sizes and modification times of the
+        partition files of the tables.
+        """
+        files = []
+        for (tableID, tableName) in tables:
+            for partitionPath in partitionCatalog.getPartitionFiles(midasSubsetter.datadir, tableName, region,
+                                                                    manifest=midasSubsetter.midasStructureTable):
+                stat = os.stat(partitionPath)
+                files.append((os.path.basename(partitionPath), stat.st_size, stat.st_mtime))
+        return hashlib.sha1(json.dumps(files)).hexdigest()
+
+    def getEntryPath(self, key):
+        "Returns the directory holding the cached outputs of a request."
+        return os.path.join(self.cacheDir, key)
+
+    def fetch(self, key, fingerprint, outputPaths):
+        """
+        Links the cached outputs of the request to ``outputPaths`` and returns
+        True, or returns False if the request is not cached. Entries made from
+        partitions that have since changed are removed.
+        """
+        entryPath = self.getEntryPath(key)
+        try:
+            if open(os.path.join(entryPath, fingerprintName)).read() != fingerprint:
+                if self.verbose:
+                    print "Removing cached extraction made from older partitions."
+                shutil.rmtree(entryPath, ignore_errors=True)
+                return False
+
+            for (i, outputPath) in enumerate(outputPaths):
+                _linkOrCopy(os.path.join(entryPath, str(i)), outputPath)
+            # Mark the entry as recently used
+            os.utime(entryPath, None)
+        except (IOError, OSError):
+            return False
+
+        if self.verbose:
+            print "Extraction found in cache: %s" % entryPath
+        return True
+
+    def store(self, key, fingerprint, outputPaths):
+        """
+        Adds the output files of a request to the cache and then removes the
+        least recently used entries until the cache is within its budget.
+        """
+        size = sum(os.path.getsize(outputPath) for outputPath in outputPaths)
+        if size > self.maxBytes:
+            return
+
+        # The entry is built under a temporary name so it only appears when complete
+        tempPath = os.path.join(self.cacheDir, ".tmp-%s-%s" % (os.getpid(), key))
+        os.mkdir(tempPath)
+        try:
+            for (i, outputPath) in enumerate(outputPaths):
+                _linkOrCopy(outputPath, os.path.join(tempPath, str(i)))
+            fingerprintFile = open(os.path.join(tempPath, fingerprintName), "w")
+            fingerprintFile.write(fingerprint)
+            fingerprintFile.close()
+            os.rename(tempPath, self.getEntryPath(key))
+        except OSError:
+            # Another process has stored the same request
+            pass
+        finally:
+            if os.path.exists(tempPath):
+                shutil.rmtree(tempPath, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the total size of the
+        cache is within its budget.
+        """
+        entries = []
+        totalSize = 0
+        for name in os.listdir(self.cacheDir):
+            entryPath = os.path.join(self.cacheDir, name)
+            if name.startswith(".") or not os.path.isdir(entryPath):
+                continue
+            try:
+                entrySize = sum(os.path.getsize(os.path.join(entryPath, fname)) for fname in os.listdir(entryPath))
+                entries.append((os.path.getmtime(entryPath), entrySize, entryPath))
+            except OSError:
+                continue
+            totalSize += entrySize
+
+        entries.sort()
+        while totalSize > self.maxBytes and entries:
+            (used, entrySize, entryPath) = entries.pop(0)
+            shutil.rmtree(entryPath, ignore_errors=True)
+            totalSize -= entrySize
+
+    def extract(self, tableNames, outputPath, startTime=None, endTime=None, columns="all", conditions=None,
+                src_ids=None, region=None, delimiter="default", mergeTables=False, timeChunk=None,
+                outputFormat="text", sortOrder=None, **kwargs):
+        """
+        Writes the outputs of an extraction, from the cache if the same request
+        has been made before or else by running ``MIDASSubsetter`` (with any
+        extra ``kwargs``) and caching its outputs. Returns True if the outputs
+        came from the cache.
+        """
+        tables = [midasSubsetter.tableMatch(tableName.upper()) for tableName in tableNames]
+        subsetterArgs = (tableNames, outputPath, startTime, endTime, columns, conditions, src_ids, region,
+                         delimiter)
+
+        if outputPath == "display":
+            midasSubsetter.MIDASSubsetter(*subsetterArgs, mergeTables=mergeTables, outputFormat=outputFormat,
+                                          sortOrder=sortOrder, **kwargs)
+            return False
+
+        outputPaths = midasSubsetter.getOutputPaths([tableID for (tableID, tableName) in tables], outputPath,
+                                                    startTime, endTime, mergeTables, timeChunk)
+
+        key = self.getKey(tables, startTime, endTime, columns, conditions, src_ids, region, delimiter,
+                          mergeTables, timeChunk, outputFormat, sortOrder)
+        fingerprint = self.getFingerprint(tables, region)
+
+        if self.fetch(key, fingerprint, outputPaths):
+            return True
+
+        midasSubsetter.MIDASSubsetter(*subsetterArgs, mergeTables=mergeTables, timeChunk=timeChunk,
+                                      outputFormat=outputFormat, sortOrder=sortOrder, **kwargs)
+        self.store(key, fingerprint, outputPaths)
+        return False
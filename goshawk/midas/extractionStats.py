@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""
+extractionStats.py
+==================
+
+Timings and counters of the stages of a MIDAS extraction.
+
+An ``ExtractionStats`` object is kept by each ``MIDASSubsetter`` (as
+``subsetter.stats``) and shared with its partition filters. It records the time
+spent in each stage:
+
+    catalog     - listing the partition files of the tables
+    fileList    - selecting the partition files of the time window
+    scan        - reading and filtering the partition files (includes the time
+                  of filter and write while rows are being found)
+    filter      - applying the value conditions and column selection
+    write       - writing the rows to the outputs and closing them (sorting
+                  and encoding any binary format)
+    total       - the whole extraction
+
+and counts of:
+
+    filesConsidered - partition files of the tables
+    filesSelected   - partition files of the time window
+    filesPruned     - partition files skipped using their zone maps
+    bytesRead       - bytes of the partition files read
+    rowsParsed      - rows read and tested against the time and stations
+    rowsMatched     - rows of the time window and stations
+    rowsWritten     - rows that also met the value conditions
+    bytesWritten    - bytes of the output files
+
+Timers use ``time.monotonic`` where it exists and are only started for each
+file or batch of rows, so the stats are cheap enough to keep for every
+extraction. Python 2 has no monotonic clock, so there the timers fall back to
+``time.time`` and a step of the system clock (e.g. an NTP correction) during a
+stage makes its time wrong; a negative time is counted as zero. The times of stages run by worker processes are
+summed over the workers, so they can add up to more than the elapsed time.
+
+"""
+
+# Import required modules
+import time
+
+
+# Clock used for the timers (``time.time`` on Python 2, which can step backwards)
+clock = getattr(time, "monotonic", time.time)
+
+stages = ("catalog", "fileList", "scan", "filter", "write", "total")
+counters = ("filesConsidered", "filesSelected", "filesPruned", "bytesRead", "rowsParsed", "rowsMatched",
+            "rowsWritten", "bytesWritten")
+
+
+class _StageTimer:
+    """
+    Context manager adding the time spent in its block to a stage.
+    """
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.stats.addTime(self.stage, clock() - self.start)
+        return False
+
+
+class ExtractionStats:
+    """
+    Seconds spent in each stage and counts of files, bytes and rows of an
+    extraction.
+    """
+
+    def __init__(self):
+        self.times = dict((stage, 0.0) for stage in stages)
+        self.counts = dict((counter, 0) for counter in counters)
+
+    def timer(self, stage):
+        "Returns a context manager timing its block as part of ``stage``."
+        return _StageTimer(self, stage)
+
+    def addTime(self, stage, seconds):
+        "Adds ``seconds`` to the time of ``stage`` (a negative time, from a step of the clock, counts as zero)."
+        self.times[stage] += max(seconds, 0.0)
+
+    def add(self, counter, n=1):
+        "Adds ``n`` to ``counter``."
+        self.counts[counter] += n
+
+    def merge(self, other):
+        "Adds the times and counts of another ``ExtractionStats`` (e.g. from a worker)."
+        for (stage, seconds) in other.times.items():
+            self.times[stage] += seconds
+        for (counter, n) in other.counts.items():
+            self.counts[counter] += n
+
+    def asDict(self):
+        "Returns the stats as a dictionary of {<stage>Seconds: seconds, <counter>: count}."
+        stats = dict(("%sSeconds" % stage, round(seconds, 6)) for (stage, seconds) in self.times.items())
+        stats.update(self.counts)
+        return stats
+
+    def format(self):
+        "Returns the stats as a single line of text."
+        return " ".join(["%s=%.3fs" % (stage, self.times[stage]) for stage in stages] +
+                        ["%s=%s" % (counter, self.counts[counter]) for counter in counters])
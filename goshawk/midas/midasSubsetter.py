@@ -12,33 +12,53 @@ Subsets data from the MIDAS flat files. Allows extraction by:
 - column name
 - value conditions
 
-The MIDASSubsetter class needs to be able to see the file 'midas_structure.txt' which
-is essentially a description of the table contents in a text file. This is parsed each
-time this script is called.
-
-There is hard-coded limit of 100,000 lines that can currently be extracted.
+The MIDASSubsetter class needs to be able to see the table structure files which
+describe the columns of each table. The partition files of each table are found from
+a catalog of the data directory that is built once per process (see
+'partitionCatalog.py').
+
+There is no limit on the size of an extraction: rows are streamed to the output
+as they are filtered and, if the output is to be sorted by station or by time,
+sorted in bounded memory with an external merge sort (see 'externalSort.py').
+Python callers can instead take the rows lazily as named tuple records, without
+any output being written, from ``iterRecords`` (or ``MIDASSubsetter.iterRecords``).
+
+Partition files with a columnar copy (built with 'columnarStore.py') are filtered
+using that copy. Other partition files are read from the start of the requested
+time window rather than from the beginning of the file. The start is found using
+the index written by 'partitionIndex.py' if there is one, or else by bisection of
+the (time-sorted) file.
 
 Usage:
 ======
 
     midasSubsetter.py -t <table> [-s <YYYYMMDDhhmm>] [-e <YYYYMMDDhhmm>]
          [-c <column1>[,<column2>...]] [-n <conditions>] [-d <delimiter>]
-         [-i <src_id1>[,<src_id2>...]] [-g <groupfile>] [-r <region>] [-p <tempdir>] <outputFile>
+         [-i <src_id1>[,<src_id2>...]] [-g <groupfile>] [-r <region>] [-p <tempdir>]
+         [-m <seek_mode>] [-w <workers>] [-a] [-k <cachedir>] [-o <time_chunk>]
+         [-f <format>] [-b <sort_order>] [-l <seconds>] <outputFile>
 
 
 Where:
 ------
 
-    <table>     - is the name of the MIDAS table
+    <table>     - is the name of the MIDAS table, or a comma-separated list of tables. When
+                  several tables are given each is written to its own output file, named
+                  by adding "_<table>" to <outputFile>, unless -a is used.
     -s          - provide the start date/time
     -e          - provide the end date/time
-    -c          - provide a comma-separated list of required columns
+    -c          - provide a comma-separated list of required columns, given as names (as listed
+                  in the table structure file) or as positions counting from 1. The output
+                  only holds these columns, in the order given.
     -n          - provide a list of comma-separated list of conditions in the form:
                     * range=<low>:<high>     [<low> and <high> are values]
                     * greater_than=<value>
                     * less_than=<value>
                     * exact=<match>          [<match> is a string]
                     * pattern=<pattern>      [<pattern> is a regular expression]
+                  A condition applies to each of the columns selected with -c (other than
+                  the time and src_id) unless it names a column, e.g.
+                  "max_air_temp:greater_than=25". Rows must meet every condition.
     -d          - delimiter is one of ","|"comma"|"tab" or other character/string.
     -i          - provide a comma separated list of station IDs
     -g          - provide the name of a file containing one station id per line.
@@ -46,6 +66,28 @@ Where:
                   Regions are: 1-Africa, 2-Asia, 3-South America, 4-North Central America,
                                5-South West Pacific, 6-Europe, 7-Antarctic.
     -p           - temporary directory location (absolute path)
+    -m           - how to find the start of the time window in each file, one of:
+                    * auto    [use the time index if available, else bisect (default)]
+                    * index   [use the time index only]
+                    * bisect  [binary search of the file]
+                    * scan    [read from the start of the file]
+    -w           - number of worker processes used to filter partition files (and ranges of
+                   large partition files) in parallel (default 1).
+    -a           - write the rows of all tables to <outputFile>, merged in time order, with
+                   each row (and a header line for each table) starting with its table ID.
+    -k           - directory of a cache of extraction outputs (see 'extractionCache.py'). Repeated
+                   requests are answered from the cache while the partition files are unchanged.
+    -o           - split the output into a file for each "decade", "year" or "month" of the time
+                   window, named "<base>-<start>-<end>.<ext>" from <outputFile>. The partitions are
+                   read once and each row is written to the file of its time chunk.
+    -f           - output format, one of "text" (default, delimited by -d), "arrow" (Arrow IPC file),
+                   "parquet" or "netcdf". The binary formats hold typed columns named from the table
+                   structure and need the 'pyarrow' or 'netCDF4' package (see 'outputWriters.py').
+    -b           - sort the rows of each output file by "station" (src_id, then time) or by "time"
+                   (time, then src_id). Rows that do not fit in memory are sorted in runs written
+                   to the temporary directory and merged. The time and src_id must be selected.
+    -l           - time limit in seconds: the extraction is stopped, and its output files removed,
+                   if it has not finished in this time.
 
 Examples:
 =========
@@ -58,16 +100,39 @@ midasSubsetter.py -t RS -s 200401010000 -e 200401011000 -g testlist.txt outputfi
 
 midasSubsetter.py -t RS -s 200401010000 -e 200401011000 -i 214,926 -d tab
 
+midasSubsetter.py -t RD,TD -s 200401010000 -e 200401311000 -i 214,926 outputfile.dat
+
+midasSubsetter.py -t TD -s 200401010000 -e 200401311000 -n max_air_temp:greater_than=25 outputfile.dat
+
+midasSubsetter.py -t TD -s 200401010000 -e 200401311000 -c ob_end_time,src_id,max_air_temp outputfile.dat
+
+midasSubsetter.py -t TD -s 199001010000 -e 200912312359 -i 214,926 -o year outputfile.csv
+
+midasSubsetter.py -t TD -s 200401010000 -e 200412312359 -i 214,926 -f parquet outputfile.parquet
+
+midasSubsetter.py -t TD -s 200401010000 -e 200412312359 -b station outputfile.dat
+
 """
 
 # Import required modules
 import sys
-import commands
 import os
 import getopt
 import re
-import glob
 import time
+import heapq
+import collections
+
+import partitionCatalog
+from partitionFilter import PartitionFilter, filterPartitionJobs, iterPartitions, getProgress, defaultSplitSize, \
+    defaultMaxIndexedStations
+from cancellation import InterruptCheck
+from externalSort import SortingOutputWriter, RowSortKey, sortOrders
+from extractionStats import ExtractionStats, clock
+from outputWriters import TextOutputWriter, ChunkedOutputWriter, splitTimeChunks, getChunkOutputPath, \
+    getOutputWriter, outputFormats
+from rowConditions import compileConditions
+from rowTokenizer import RowTokenizer, fieldSeparator, parseTime
 
 
 # Set up global variables
@@ -92,15 +157,7 @@ nameDict = {'STXX': 'SOIL_TEMP_OB', 'SRCC': 'SRC_CAPABILITY', 'GLXX': 'GBL_WX_OB
             'RDXX': 'RAIN_DRNL_OB', 'RSXX': 'RAIN_SUBHRLY_OB', 'RHXX': 'RAIN_HRLY_OB',
             'WMXX': 'WIND_MEAN_OB', 'WHXX': 'WEATHER_HRLY_OB'}
 
-globalWXCodes = {"1": "glblwx-africa", "2": "glblwx-asia",
-                 "3": "glblwx-south-america", "4": "glblwx-north-central-america",
-                 "5": "glblwx-south-west-pacific", "6": "glblwx-europe",
-                 "7": "glblwx-antarctic"}
-
-
-def countLines(fname):
-    "Returns a count of the lines in a files."
-    return commands.getoutput("wc -l %s" % fname).strip()
+seekModes = ("auto", "index", "bisect", "scan")
 
 
 def dateMatch(line, pattern):
@@ -175,212 +232,449 @@ def getColumnIndex(tableID, colName):
                     (colName, tableID))
 
 
+def getTimeColumnIndex(tableID):
+    """
+    Returns the index in a row of the column holding the observation time.
+    """
+    try:
+        return getColumnIndex(tableID, "ob_time")
+    except:
+        try:
+            return getColumnIndex(tableID, "ob_date")
+        except:
+            return getColumnIndex(tableID, "ob_end_time")
+
+
+def getTableOutputPath(outputPath, tableID, nTables):
+    """
+    Returns the output path for a table: when several tables are extracted
+    the table ID is added before the extension of ``outputPath``.
+    """
+    if nTables == 1 or outputPath == "display":
+        return outputPath
+
+    (base, ext) = os.path.splitext(outputPath)
+    return "%s_%s%s" % (base, tableID, ext)
+
+
+def getOutputPaths(tableIDs, outputPath, startTime, endTime, mergeTables=False, timeChunk=None):
+    """
+    Returns the list of output files written for the tables: one per table
+    (or one for all tables if ``mergeTables`` is set), or one per table and
+    time chunk if ``timeChunk`` is given.
+    """
+    if mergeTables and len(tableIDs) > 1:
+        return [outputPath]
+
+    tablePaths = [getTableOutputPath(outputPath, tableID, len(tableIDs)) for tableID in tableIDs]
+    if not timeChunk:
+        return tablePaths
+
+    chunks = splitTimeChunks(padTime(startTime), padTime(endTime), timeChunk)
+    return [getChunkOutputPath(tablePath, start, end) for tablePath in tablePaths for (start, end) in chunks]
+
+
+def getRecordType(tableID, rowHeaders):
+    """
+    Returns the named tuple type, called "<tableID>Record", of the records of
+    a table with the columns ``rowHeaders``. Headers that are not valid field
+    names are renamed by their position (e.g. "_3").
+    """
+    return collections.namedtuple("%sRecord" % tableID, rowHeaders, rename=True)
+
+
+def _iterRecordsOfRows(recordType, rows):
+    """
+    Yields a record of type ``recordType`` for each row (without its line
+    ending), holding the text of each field. Rows are split into fields as by
+    the typed output writers (see 'outputWriters.py').
+    """
+    nFields = len(recordType._fields)
+    makeRecord = recordType._make
+    for row in rows:
+        fields = row.split(fieldSeparator, nFields - 1)
+        if len(fields) < nFields:
+            fields.extend([""] * (nFields - len(fields)))
+        yield makeRecord(fields)
+
+
+def iterRecords(tableNames, startTime=None, endTime=None, **kwargs):
+    """
+    Returns an iterator over the records of an extraction (see
+    ``MIDASSubsetter.iterRecords``), which writes no output. ``kwargs`` are
+    passed on to ``MIDASSubsetter``.
+    """
+    return MIDASSubsetter(tableNames, None, startTime, endTime, run=False, **kwargs).iterRecords()
+
+
 class MIDASSubsetter:
     """
     Subsetting class to manage extractions from large text files holding MIDAS data.
     """
 
     def __init__(self, tableNames, outputPath, startTime=None, endTime=None, columns="all", conditions=None,
-                 src_ids=None, region=None, delimiter="default", tempDir=temp_dir, verbose=1):
+                 src_ids=None, region=None, delimiter="default", tempDir=temp_dir, verbose=1,
+                 seekMode="auto", workers=1, splitSize=defaultSplitSize, useMmap=True, useColumnar=True,
+                 maxIndexedStations=defaultMaxIndexedStations, mergeTables=False, timeChunk=None,
+                 outputFormat="text", sortOrder=None, progressCallback=None, cancelToken=None, deadline=None,
+                 stats=None, run=True):
         """
-        Initialisation of instance sets up the rules and calls various methods.
+        Initialisation of instance sets up the rules and, unless ``run`` is False,
+        runs the extraction (see ``run``). The rows can instead be taken as records,
+        without writing any output, from ``iterRecords`` (``outputPath`` can then
+        be None). The paths of the files written are listed in ``self.outputPaths``.
+        If ``progressCallback`` is given it is called as ``progressCallback(doneBytes,
+        totalBytes)`` as the partition files are read. The extraction is stopped,
+        its output files removed and an ``ExtractionInterrupted`` exception raised
+        if the ``cancelToken`` is cancelled or the ``deadline`` (a ``time.time()``
+        value) passes (see 'cancellation.py').
+        The time spent in each stage and the numbers of files, bytes and rows read
+        and written are recorded in ``self.stats`` (see 'extractionStats.py'),
+        which is ``stats`` if given.
+        The station indexes of the partitions are used for requests of no more than
+        ``maxIndexedStations`` stations.
         """
+        self.stats = stats if stats is not None else ExtractionStats()
         self.region = region
         self.verbose = verbose
         self.tempDir = tempDir
+        self.progressCallback = progressCallback
+        self.interruptCheck = InterruptCheck(cancelToken, deadline)
+
+        if timeChunk and (mergeTables or outputPath == "display"):
+            raise Exception("Output split into time chunks must be written to a file for each table.")
+        self.timeChunk = timeChunk
+
+        if outputFormat not in outputFormats:
+            raise Exception("Output format must be one of: %s" % ", ".join(outputFormats))
+        if outputFormat != "text" and mergeTables and len(tableNames) > 1:
+            raise Exception("Tables can only be merged into a single output in text format.")
+        self.outputFormat = outputFormat
+
+        if sortOrder and sortOrder not in sortOrders:
+            raise Exception("Sort order must be one of: %s" % ", ".join(sortOrders))
+        if sortOrder and mergeTables and len(tableNames) > 1:
+            raise Exception("Tables merged into a single output are always in time order.")
+        self.sortOrder = sortOrder
+
+        if seekMode not in seekModes:
+            raise Exception("Seek mode must be one of: %s" % ", ".join(seekModes))
+        self.seekMode = seekMode
+        self.workers = workers
+        self.splitSize = splitSize
+        self.useMmap = useMmap
+        self.useColumnar = useColumnar
+        self.maxIndexedStations = maxIndexedStations
 
         tableNames = [a.upper() for a in tableNames]
-        if type(columns) == type([]):
-            # convert to list of ints if appropriate
-            try:
-                columns = [int(i) for i in columns]
-            except:
-                pass
 
-        # Get full list of all tables and partitions
-        tableDict = self._parseTableStructure()
+        tables = [tableMatch(tableName) for tableName in tableNames]
+        self.outputPaths = []
+        if outputPath is not None:
+            self.outputPaths = getOutputPaths([tableID for (tableID, tableName) in tables], outputPath,
+                                              startTime, endTime, mergeTables, timeChunk)
+        self.request = (tables, outputPath, startTime, endTime, src_ids, delimiter, mergeTables, columns, conditions)
+        if run:
+            self.run()
 
-        (tableID, tableName) = tableMatch(tableNames[0])
-        if self.verbose:
-            print "NOTE: Multiple table search not yet implemented."
-        #print tableDict[tableName]
+    def run(self):
+        """
+        Runs the extraction, writing the output files listed in ``self.outputPaths``
+        (or printing the rows if the output path is "display").
+        """
+        (tables, outputPath, startTime, endTime, src_ids, delimiter, mergeTables, columns, conditions) = self.request
+        if outputPath is None:
+            raise Exception("An output path must be given to write the extraction.")
 
-        self.rowHeaders = self._getRowHeaders(tableID)
-        if self.verbose:
-            print "Got row headers..."
-        partitionFiles = tableDict[tableName]["partitionList"]
-        if self.verbose:
-            print "Got partition files..."
+        with self.stats.timer("total"):
+            self._extractTables(tables, outputPath, startTime, endTime, src_ids, delimiter,
+                                mergeTables, columns, conditions)
 
+        if outputPath != "display":
+            self.stats.add("bytesWritten", sum(os.path.getsize(path) for path in self.outputPaths
+                                               if os.path.exists(path)))
         if self.verbose:
-            print "Getting file list..."
-        fileList = self._getFileList(
-            tableName, startTime, endTime, partitionFiles)
+            print "Extraction stats: %s" % self.stats.format()
 
-        if columns == "all" and conditions == None:
-            if self.verbose:
-                print "\nExtracting all rows: %s\nFrom files: %s\nBetween: %s and %s\n" % (tableID, ("\t"+"\n\t".join(fileList)), startTime,
-                                                                                           endTime)
-            dataFile = self._getCompleteRows(
-                tableID, fileList, startTime, endTime, src_ids=src_ids)
-        else:
-            if self.verbose:
-                print "\nExtracting row subsets for: %s\nFrom files: %s\nBetween: %s and %s\n" % (tableID, fileList, startTime,
-                                                                                                  endTime)
-            dataFile = self._getRowSubsets(
-                tableID, fileList, startTime, endTime, columns, conditions)
+    def iterRecords(self):
+        """
+        Yields the matching rows of each table in turn (or of all the tables
+        merged in time order if ``mergeTables`` was set) as records: named tuples
+        of the selected columns (see ``getRecordType``) holding the text of each
+        field. The partitions are read lazily, in this process, as the records
+        are taken and nothing is written to disk unless the rows are to be sorted
+        (see 'externalSort.py'). The output path, delimiter, time chunk, output
+        format and workers are not used.
+        """
+        (tables, outputPath, startTime, endTime, src_ids, delimiter, mergeTables, columns, conditions) = self.request
+        jobs = self._getJobs(tables, startTime, endTime, src_ids, columns, conditions)
+        progress = getProgress([fileList for (tableID, rowHeaders, partitionFilter, fileList) in jobs],
+                               self.progressCallback, self.interruptCheck)
+
+        if not (mergeTables and len(jobs) > 1):
+            for (tableID, rowHeaders, partitionFilter, fileList) in jobs:
+                rows = self._iterTableRows(tableID, partitionFilter, fileList, progress)
+                for record in _iterRecordsOfRows(getRecordType(tableID, rowHeaders), rows):
+                    yield record
+            return
 
-        if self.verbose:
-            print "\nData extracted to temporary file(s)..."
+        # Progress within files is not reported as the files of the tables are read in turns
+        streams = []
+        for (order, (tableID, rowHeaders, partitionFilter, fileList)) in enumerate(jobs):
+            timeIndex = partitionFilter.getOutputTimeIndex()
+            if timeIndex is None:
+                raise Exception("The time column must be selected to merge tables by time.")
+            rows = self._iterTableRows(tableID, partitionFilter, fileList, progress, withinFiles=False)
+            streams.append(self._iterTimedRecords(getRecordType(tableID, rowHeaders), rows, timeIndex, order))
 
-        self._writeOutputFile(dataFile, outputPath, delimiter)
+        for (dateLong, order, record) in heapq.merge(*streams):
+            yield record
 
-    def _parseTableStructure(self, structureFile=midasStructureTable):
+    def _iterTableRows(self, tableID, partitionFilter, fileList, progress=None, withinFiles=True):
         """
-        Parses the table structure text file to return a list of [<files>, <columns>]
-        where <files> is a list of [<file_name>, <start_time>, <end_time>].
+        Yields the selected rows (without line endings) of the partitions of a
+        table, sorted in the sort order if one was given. The cancellation token
+        and deadline are checked for each batch of rows.
         """
-        tableDict = {}
-
-        fpatt = re.compile(r"nonsense-data_([a-zA-Z\-]+)_(\d{6})-(\d{6}).txt")
+        interruptCheck = self.interruptCheck if self.interruptCheck.isActive() else None
+        batches = iterPartitions(partitionFilter, fileList, progress, withinFiles)
+
+        if not self.sortOrder:
+            for rows in batches:
+                if interruptCheck is not None:
+                    interruptCheck.check()
+                for row in rows:
+                    yield row
+            return
 
-        tableList = nameDict.values()
+        getKey = RowSortKey(self.sortOrder, partitionFilter.getOutputTimeIndex(),
+                            partitionFilter.getOutputIndex(getColumnIndex(tableID, "src_id")))
+        sorter = SortingOutputWriter(None, getKey, self.tempDir)
+        try:
+            for rows in batches:
+                if interruptCheck is not None:
+                    interruptCheck.check()
+                sorter.write("\n".join(rows) + "\n")
+            for row in sorter.iterRows():
+                yield row.rstrip("\r\n")
+        finally:
+            # Removes any run files left if the records are not all taken
+            sorter.abort()
+
+    def _iterTimedRecords(self, recordType, rows, timeIndex, order):
+        """
+        Yields (time, order, record) for each row, with the time of field ``timeIndex``.
+        """
+        for record in _iterRecordsOfRows(recordType, rows):
+            yield (parseTime(record[timeIndex], 0), order, record)
 
-        for tableName in tableList:  
+    def _extractTables(self, tables, outputPath, startTime, endTime, src_ids, delimiter,
+                       mergeTables=False, columns="all", conditions=None):
+        """
+        Extracts rows from each of the tables (a list of (tableID, tableName)),
+        sharing the partition catalog, stations, time bounds, column selection and
+        value conditions. Writes one output per table, or a single output merged by
+        time if ``mergeTables`` is set.
+        """
+        jobs = self._getJobs(tables, startTime, endTime, src_ids, columns, conditions)
 
-            if tableName in ["SRC_CAPABILITY", "SOURCE", "TEMP_MIN_SOIL_OB", "MARINE_OB"]:
-                continue
-            tableID = tableMatch(tableName)[0]
-            tableDict[tableName] = {"partitionList": []}
+        if mergeTables and len(jobs) > 1:
+            self._writeMergedOutput(jobs, outputPath, delimiter)
+            return
 
-            partitionDir = datadir
-            os.chdir(partitionDir)
-            partitionFiles = glob.glob("*.txt")
-            partitionFiles.sort()
+        # Rows are streamed straight to the outputs as they are filtered
+        outputs = [self._getOutputWriter(tableID, getTableOutputPath(outputPath, tableID, len(jobs)), rowHeaders,
+                                         delimiter, partitionFilter, startTime, endTime)
+                   for (tableID, rowHeaders, partitionFilter, fileList) in jobs]
 
-            for pfile in partitionFiles:
-                pmatch = fpatt.match(pfile)
-                if pmatch:
-                    # Deal with non-matching regions if global used...
-                    if self.region:
-                        regionName = globalWXCodes[self.region]
-                        if pmatch.groups()[0] != regionName:
-                            continue
+        try:
+            with self.stats.timer("scan"):
+                counts = filterPartitionJobs([(partitionFilter, fileList, output) for
+                                              ((tableID, rowHeaders, partitionFilter, fileList), output) in
+                                              zip(jobs, outputs)],
+                                             workers=self.workers, tempDir=self.tempDir, splitSize=self.splitSize,
+                                             progressCallback=self.progressCallback,
+                                             interruptCheck=self.interruptCheck)
+        except:
+            # Partial outputs are removed if the extraction is stopped or fails
+            for output in outputs:
+                output.abort()
+            raise
 
-                    ppath = os.path.join(partitionDir, pfile)
-                    tableDict[tableName]["partitionList"].append(ppath)
+        for ((tableID, rowHeaders, partitionFilter, fileList), output, count) in zip(jobs, outputs, counts):
+            if self.verbose:
+                print "Lines extracted from %s = %s" % (tableID, count)
+            with self.stats.timer("write"):
+                output.close()
 
-            os.chdir(base_dir)
+    def _getJobs(self, tables, startTime, endTime, src_ids, columns="all", conditions=None):
+        """
+        Returns a list of (tableID, rowHeaders, partitionFilter, fileList) for
+        each of the tables (a list of (tableID, tableName)): the headers of the
+        selected columns, the filter of its rows and the partition files to read.
+        """
+        jobs = []
+        for (tableID, tableName) in tables:
+            rowHeaders = self._getRowHeaders(tableID)
+            columnIndexes = self._getColumnIndexes(tableID, rowHeaders, columns)
+            if self.verbose:
+                print "Got row headers..."
+            with self.stats.timer("catalog"):
+                partitionFiles = self._getPartitionFiles(tableName)
 
-        return tableDict
+            if self.verbose:
+                print "Getting file list..."
+            with self.stats.timer("fileList"):
+                fileList = self._getFileList(
+                    tableName, startTime, endTime, partitionFiles)
+            self.stats.add("filesConsidered", len(partitionFiles))
+            self.stats.add("filesSelected", len(fileList))
 
-    def _getFileList(self, table, startTime, endTime, partitionFiles, pattern=_partitionPattern):
+            if self.verbose:
+                print "\nExtracting rows: %s\nFrom files: %s\nBetween: %s and %s\n" % (
+                    tableID, ("\t" + "\n\t".join(fileList)), startTime, endTime)
+            partitionFilter = self._getPartitionFilter(tableID, rowHeaders, startTime, endTime, src_ids,
+                                                       columnIndexes, conditions)
+            # The headers of the output are those of the selected columns
+            if columnIndexes is not None:
+                rowHeaders = [rowHeaders[i] for i in columnIndexes]
+            jobs.append((tableID, rowHeaders, partitionFilter, fileList))
+
+        return jobs
+
+    def _getOutputWriter(self, tableID, outputPath, rowHeaders, delimiter, partitionFilter, startTime, endTime):
         """
-        Returns a list of files required for reading based on the request.
+        Returns the writer for the output of a table, in the output format: a
+        single file or, if a time chunk was requested, a file for each chunk of
+        the time window that rows are routed to as they are filtered. If a sort
+        order was requested the rows are sorted on their way to the writer.
         """
-        startYM = long(startTime[:6])
-        endYM = long(endTime[:6])
-        filePathList = []
-        template = "nonsense-data_%s_%s-%s.txt"
+        getChunk = None
+        if not self.timeChunk:
+            writer = getOutputWriter(outputPath, rowHeaders, delimiter, self.outputFormat, tempDir=self.tempDir,
+                                     verbose=self.verbose)
+        else:
+            timeIndex = partitionFilter.getOutputTimeIndex()
+            if timeIndex is None:
+                raise Exception("The time column must be selected to split the output into time chunks.")
 
-        for file in partitionFiles:
-            (nameStart, nameEnd) = pattern.search(file).groups()
-            if long(nameEnd) < long(startYM) or long(nameStart) > long(endYM):
-                pass
-            else:
-                filePathList.append(file)
-        return filePathList
+            chunks = splitTimeChunks(padTime(startTime), padTime(endTime), self.timeChunk)
+            writer = ChunkedOutputWriter(outputPath, rowHeaders, delimiter, chunks, RowTokenizer(timeIndex).getTime,
+                                         self.outputFormat, tempDir=self.tempDir, verbose=self.verbose)
+            getChunk = writer.getChunk
+
+        if not self.sortOrder:
+            return writer
 
-    def _getCompleteRows(self, tableID, fileList, startTime, endTime, src_ids=None):
+        # Rows are sorted before they reach the writer, separately for each time chunk
+        getKey = RowSortKey(self.sortOrder, partitionFilter.getOutputTimeIndex(),
+                            partitionFilter.getOutputIndex(getColumnIndex(tableID, "src_id")), getChunk)
+        return SortingOutputWriter(writer, getKey, self.tempDir)
+
+    def _getPartitionFilter(self, tableID, rowHeaders, startTime, endTime, src_ids=None, columnIndexes=None,
+                            conditions=None):
         """
-        Returns a list of complete rows from the database.
+        Returns the filter selecting rows of the table by time, station and value
+        conditions, and selecting the columns at ``columnIndexes`` (default is all).
         """
-        try:
-            timeIndex = getColumnIndex(tableID, "ob_time")
-        except:
-            try:
-                timeIndex = getColumnIndex(tableID, "ob_date")
-            except:
-                timeIndex = getColumnIndex(tableID, "ob_end_time")
+        timeIndex = getTimeColumnIndex(tableID)
+        srcidIndex = None
 
-        _datePattern = re.compile(
-            r"([^,]+, ){%s}(\d{4})-(\d{2})-(\d{2})\s+(\d{2}):(\d{2})" % timeIndex)
-
-        now = time.strftime("%Y%m%d.%H%M%S", time.localtime(time.time()))
-        print self.tempDir
-        tempFilePath = os.path.join(self.tempDir, "temp_%s" % (now))
-        tempFile = open(tempFilePath, "w")
+        # Conditions are compiled once, in the order they are to be applied. Those
+        # without a column name apply to the selected columns other than time and src_id.
+        compiledConditions = None
+        if conditions:
+            valueColumns = [i for i in (columnIndexes or []) if i != timeIndex and rowHeaders[i] != "src_id"]
+            compiledConditions = compileConditions(conditions, rowHeaders, valueColumns)
 
         startTimeLong = long(padTime(startTime))
         endTimeLong = long(padTime(endTime))
 
-        getAllSrcIds = False
-        # Set up srcId pattern finders
+        # Set up the station lookup: the src_id field of each row is tested against a set
         if src_ids:
-            selectedRows = []
-            print "Now extracting station ids provided..."
-            srcidIndex = getColumnIndex(tableID, "src_id")
-
-            # reg ex module has a limit of 9999 items that can be in a "|" separated match option
-            # somewhere on web says it can be set at 7500
-            # For safety I'll split them into 5000 batches
-            n = 0
-            srcIdPatternsList = []
-
-            while n <= (len(src_ids) - 1):
-                srcIdPatternsList.append(re.compile(
-                    r"([^,]+, ){%s}(%s)," % (srcidIndex, "|".join(src_ids[n: (n + 5000)]))))
-                n += 5000
-
-        else:
-            getAllSrcIds = True
-
-        count = 0
-        for filename in fileList:
-
-            lcount = 0
             if self.verbose:
-                print "\nFiltering file '%s' containing %s lines." % (
-                    filename, countLines(filename))
-            file = open(filename)
-            line = file.readline()
-
-            while line:
-                lcount = lcount+1
-                if self.verbose and lcount % 100000 == 0:
-                    print "\tRead %s lines..." % lcount
-
-                line = line.strip()
-                dmatch = dateMatch(line, _datePattern)
-
-                # Check if datetime has gone past the selected range
-                if dmatch and dmatch > endTimeLong:
-                    print "Breaking out of read loop because time past end time!"
-                    break
+                print "Now extracting station ids provided..."
+            srcidIndex = getColumnIndex(tableID, "src_id")
 
-                # Now check if src ids need to match
-                idmatch = None
+        return PartitionFilter(timeIndex, startTimeLong, endTimeLong, srcidIndex, src_ids,
+                               seekMode=self.seekMode, useMmap=self.useMmap,
+                               columnNames=rowHeaders, useColumnar=self.useColumnar,
+                               verbose=self.verbose, conditions=compiledConditions,
+                               columns=columnIndexes, maxIndexedStations=self.maxIndexedStations,
+                               stats=self.stats)
 
-                if src_ids:
-                    for _srcidPattern in srcIdPatternsList:
-                        if _srcidPattern.match(line):
-                            idmatch = 1
-                            break
+    def _writeMergedOutput(self, jobs, outputPath, delimiter):
+        """
+        Filters each table (jobs are (tableID, rowHeaders, partitionFilter, fileList))
+        to its own temporary file and then merges the rows of all tables into a
+        single output in time order. Each row starts with its table ID and the
+        output starts with a header line for each table.
+        """
+        tempPaths = [os.path.join(self.tempDir, "table_%s_%s" % (os.getpid(), job[0])) for job in jobs]
+        tempFiles = [open(tempPath, "w+b") for tempPath in tempPaths]
 
-                if dmatch and (idmatch or getAllSrcIds):
-                    if startTimeLong <= dmatch <= endTimeLong:
-                        tempFile.write(line.strip()+"\n")
-                        count += 1
+        try:
+            with self.stats.timer("scan"):
+                filterPartitionJobs([(partitionFilter, fileList, tempFile) for
+                                     ((tableID, rowHeaders, partitionFilter, fileList), tempFile) in
+                                     zip(jobs, tempFiles)],
+                                    workers=self.workers, tempDir=self.tempDir, splitSize=self.splitSize,
+                                    progressCallback=self.progressCallback, interruptCheck=self.interruptCheck)
+
+            mergeStart = clock()
+            output = TextOutputWriter(outputPath, None, delimiter, verbose=self.verbose)
+            for (tableID, rowHeaders, partitionFilter, fileList) in jobs:
+                output.writeHeader([tableID] + rowHeaders)
+
+            streams = []
+            for (order, (job, tempFile)) in enumerate(zip(jobs, tempFiles)):
+                (tableID, rowHeaders, partitionFilter, fileList) = job
+                timeIndex = partitionFilter.getOutputTimeIndex()
+                if timeIndex is None:
+                    raise Exception("The time column must be selected to merge tables by time.")
+                tempFile.seek(0)
+                streams.append(self._iterTimedRows(tempFile, RowTokenizer(timeIndex), order, tableID))
+
+            for (dateLong, order, row) in heapq.merge(*streams):
+                output.write(row)
+            output.close()
+            self.stats.addTime("write", clock() - mergeStart)
+        finally:
+            for (tempPath, tempFile) in zip(tempPaths, tempFiles):
+                tempFile.close()
+                os.unlink(tempPath)
 
-                line = file.readline()
+    def _iterTimedRows(self, rows, tokenizer, order, tableID):
+        """
+        Yields (time, order, row) for each row prefixed with its table ID.
+        """
+        prefix = tableID + ", "
+        for row in rows:
+            yield (tokenizer.getTime(row), order, prefix + row)
 
-            file.close()
-        tempFile.close()
+    def _getPartitionFiles(self, tableName):
+        """
+        Returns the list of partition files of the table (for the selected region
+        if it is the global table), from the catalog cached for the process.
+        """
+        return partitionCatalog.getPartitionFiles(datadir, tableName, self.region, manifest=midasStructureTable)
 
-        if self.verbose:
-            print "Lines to filter = ", countLines(tempFilePath)
+    def _getFileList(self, table, startTime, endTime, partitionFiles, pattern=_partitionPattern):
+        """
+        Returns a list of files required for reading based on the request.
+        """
+        startYM = long(startTime[:6])
+        endYM = long(endTime[:6])
+        filePathList = []
+        template = "nonsense-data_%s_%s-%s.txt"
 
-        return tempFilePath  # rows
+        for file in partitionFiles:
+            (nameStart, nameEnd) = pattern.search(file).groups()
+            if long(nameEnd) < long(startYM) or long(nameStart) > long(endYM):
+                pass
+            else:
+                filePathList.append(file)
+        return filePathList
 
     def _getRowHeaders(self, tableID, columns="all"):
         """
@@ -391,132 +685,35 @@ class MIDASSubsetter:
         rowHeaders = [rh.strip().lower() for rh in open(inputFile).readlines()]
         return rowHeaders
 
-    def _getRowSubsets(self, tableID, fileList, startTime, endTime, columns="all", conditions=None):
-        """
-        Returns a list of rows after sub-setting according to columns and conditions.
-        """
-        # rows=[]
-        now = time.strftime("%Y%m%d.%H%M%S", time.localtime(time.time()))
-        tempFilePath = os.path.join(self.tempDir, "temp_%s" % (now))
-        tempFile = open(tempFilePath, "w")
-
-        startTimeLong = long(padTime(startTime))
-        endTimeLong = long(padTime(endTime))
-
-        count = 0
-        for filename in fileList:
-            file = open(filename)
-            line = file.readline()
-            while line:
-                line = line.strip()
-                match = dateMatch(line)
-
-                if match:
-                    dataTimeLong = long(match)
-                    if startTimeLong < match < endTimeLong:
-                        if type(columns) == type([]):
-                            newLine = None
-                            splitLine = re.split(",\s+", line)
-
-                            for i in columns:
-                                i = i-1
-                                if newLine == None:
-                                    newLine = "%s, " % splitLine[i]
-                                else:
-                                    newLine = "%s%s, " % (
-                                        newLine, splitLine[i])
-                            # rows.append(newLine)
-                            tempFile.write(newLine)
-
-                        count = count+1
-                line = file.readline()
-
-            file.close()
-            tempFile.close()
-
-        return tempFilePath
-
-    def _writeOutputFile(self, tempDataFile, outputPath, delimiter="default"):
-        """
-        Writes the output file and returns 1 if successful, if delimiter is not "default"
-        it modifies each output line accordingly to include chosen delimiter.
-        """
-        headerLine = ", ".join(self.rowHeaders)+"\n"
-
-        print "Getting size of temporary output file."
-        size = os.path.getsize(tempDataFile)
-        if size > (200*10**6):
-            print "File is bigger than 200MB so I'm not going to try filtering it."
-
-            if outputPath == "display":
-                print "This file is too big to display so data has been saved to:"
-                now = time.strftime(
-                    "%Y%m%d.%H%M%S", time.localtime(time.time()))
-                outputPath = os.path.join(outputDir, "out_%s.txt" % now)
-
-            outputFile = open(outputPath, "w")
-            outputFile.write(headerLine)
-            dataFile = open(tempDataFile)
-            line = dataFile.readline()
-
-            while line:
-                outputFile.write(line)
-                line = dataFile.readline()
-
-            dataFile.close()
-            outputFile.close()
-
-            print "\t", outputPath
-            os.unlink(tempDataFile)
-            return
-        else:
-            print "Can sort and filter since file is small."
-
-        dataFile = open(tempDataFile)
-        rows = dataFile.readlines()
-        dataFile.close()
-        rows.insert(0, headerLine)
-
-        if delimiter != "default":
-            rows = self._reFormatDelimiters(rows, delimiter)
-
-        data = "".join(rows)
-        if outputPath == "display":
-            print "Output data follows:\n"
-            print data+"\n"
-        else:
-            if len(rows) == 1:
-                print "===\nNo data found.\n===\n"
-                data = "Your extraction request has run successfully, but no data have been found matching your request.\n\nPlease use the MIDAS station search pages on the CEDA website (http://archive.ceda.ac.uk/midas_stations/) to check your station reporting periods and message types to ensure that your selected stations report message types containing the data elements you require within your selected period.\n\nAdditional information about data outages/known issues/instrument failure can also be found on station records.\n\nIf you have completed these checks and believe the data should be available please contact the CEDA helpdesk for further assistance (support@ceda.ac.uk), providing full details of the extractions you are trying to submit."
-
-            output = open(outputPath, "w")
-            output.write(data)
-            output.close()
-            if len(rows) > 1:
-                print "%s records written to: %s\n===\n" % (
-                    len(rows), outputPath)
-
-        os.unlink(tempDataFile)
-        return 1
-
-    def _reFormatDelimiters(self, rows, delimiter):
+    def _getColumnIndexes(self, tableID, rowHeaders, columns="all"):
         """
-        Returns a list of rows with delimiters as requested.
+        Returns the list of indexes of the requested columns, which are given as
+        names or 1-based positions, or None if all columns are wanted.
         """
-        if delimiter in ("comma", ","):
-            return rows
-        elif delimiter == "tab":
-            delimiter = "\t"
+        if columns is None or columns == "all":
+            return None
+
+        columnIndexes = []
+        for column in columns:
+            column = str(column).strip().lower()
+            if column.isdigit():
+                index = int(column) - 1
+                if not 0 <= index < len(rowHeaders):
+                    raise Exception("Column number %s is not in table '%s'" % (column, tableID))
+            elif column in rowHeaders:
+                index = rowHeaders.index(column)
+            else:
+                raise Exception("Cannot find column name '%s' in table '%s'" % (column, tableID))
+            columnIndexes.append(index)
 
-        newRows = [delimiter.join(row.split(", ")) for row in rows]
-        return newRows
+        return columnIndexes
 
 
 if __name__ == "__main__":
 
     argList = sys.argv[1:]
     outputPath = None
-    (args, outputPath) = getopt.getopt(argList, "t:s:e:c:n:d:i:r:g:p:")
+    (args, outputPath) = getopt.getopt(argList, "t:s:e:c:n:d:i:r:g:p:m:w:ak:o:f:b:l:")
 
     startTime = None
     endTime = None
@@ -527,6 +724,14 @@ if __name__ == "__main__":
     region = None
     tableNames = []
     tempDir = temp_dir
+    seekMode = "auto"
+    workers = 1
+    mergeTables = False
+    cacheDir = None
+    timeChunk = None
+    outputFormat = "text"
+    sortOrder = None
+    deadline = None
 
     if not outputPath:
         outputPath = "display"
@@ -550,6 +755,22 @@ if __name__ == "__main__":
             region = value
         elif arg == "-p":
             tempDir = value
+        elif arg == "-m":
+            seekMode = value
+        elif arg == "-w":
+            workers = int(value)
+        elif arg == "-a":
+            mergeTables = True
+        elif arg == "-k":
+            cacheDir = value
+        elif arg == "-o":
+            timeChunk = value
+        elif arg == "-f":
+            outputFormat = value
+        elif arg == "-b":
+            sortOrder = value
+        elif arg == "-l":
+            deadline = time.time() + float(value)
         elif arg == "-g":
             src_ids = [i.strip() for i in open(value).readlines()]
         elif arg == "-n":
@@ -562,5 +783,14 @@ if __name__ == "__main__":
     if tableNames == []:
         exitNicely("Must provide table name with '-t' argument.")
 
-    MIDASSubsetter(tableNames, outputPath, startTime, endTime, columns, conditions,
-                   src_ids, region, delimiter, tempDir=tempDir)
+    if cacheDir:
+        from extractionCache import ExtractionCache
+        ExtractionCache(cacheDir).extract(tableNames, outputPath, startTime, endTime, columns, conditions,
+                                          src_ids, region, delimiter, mergeTables, timeChunk, outputFormat,
+                                          sortOrder, tempDir=tempDir, seekMode=seekMode, workers=workers,
+                                          deadline=deadline)
+    else:
+        MIDASSubsetter(tableNames, outputPath, startTime, endTime, columns, conditions,
+                       src_ids, region, delimiter, tempDir=tempDir, seekMode=seekMode,
+                       workers=workers, mergeTables=mergeTables, timeChunk=timeChunk,
+                       outputFormat=outputFormat, sortOrder=sortOrder, deadline=deadline)
@@ -0,0 +1,716 @@
+#!/usr/bin/env python
+
+"""
+outputWriters.py
+================
+
+Writers for the output of MIDAS extractions.
+
+Rows are streamed to the writer as they are filtered, so there is no intermediate
+file and memory use does not grow with the size of the result. A writer looks
+like an open file to the filtering code: ``write()`` takes one or more complete
+rows (each ending in a newline) and ``close()`` finishes the output.
+
+Output can also be split into files each covering a chunk of time (a decade, year
+or month) with ``ChunkedOutputWriter``, which routes each row to the file of its
+chunk as it is written so that the partitions are only scanned once.
+
+As well as delimited text ("text"), rows can be written in binary formats that
+load straight into dataframes: Arrow IPC files ("arrow"), Parquet ("parquet") and
+NetCDF ("netcdf"). The binary writers write record batches of typed columns,
+named from the table structure: date/times become timestamps, src_id becomes an
+integer, other numeric columns become floats and anything else is kept as text.
+The type of each column is found from all of its values, so the rows are held in
+a temporary file until the output is closed: a column is widened (from integer
+to float to text, or from timestamps to text) as soon as a value does not fit,
+and the whole output is then written with the final types. The files of an
+output split into time chunks share the same types. Empty fields are written as
+missing values. Arrow and Parquet need the 'pyarrow' package and NetCDF needs
+'netCDF4'; they are optional and only imported when available.
+
+"""
+
+# Import required modules
+import os
+import sys
+import re
+import bisect
+import calendar
+import tempfile
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    parquet = None
+else:
+    parquet = pyarrow.parquet
+
+try:
+    import netCDF4
+    import numpy
+except ImportError:
+    netCDF4 = None
+
+from rowTokenizer import parseTime, timeLength
+
+
+noDataMessage = "Your extraction request has run successfully, but no data have been found matching your request.\n\nPlease use the MIDAS station search pages on the CEDA website (http://archive.ceda.ac.uk/midas_stations/) to check your station reporting periods and message types to ensure that your selected stations report message types containing the data elements you require within your selected period.\n\nAdditional information about data outages/known issues/instrument failure can also be found on station records.\n\nIf you have completed these checks and believe the data should be available please contact the CEDA helpdesk for further assistance (support@ceda.ac.uk), providing full details of the extractions you are trying to submit."  # noqa
+
+# Separator between the fields of rows in the partition files
+inputDelimiter = ", "
+
+
+def getDelimiter(delimiter):
+    """
+    Returns the string used to separate output fields for the delimiter option
+    ("default", "comma"/"," or "tab" or any other string).
+    """
+    if delimiter in ("default", "comma", ","):
+        return inputDelimiter
+    elif delimiter == "tab":
+        return "\t"
+    return delimiter
+
+
+timeChunks = ("decade", "year", "month")
+
+outputFormats = ("text", "arrow", "parquet", "netcdf")
+
+# File name extension of each binary output format
+formatExtensions = {"arrow": "arrow", "parquet": "parquet", "netcdf": "nc"}
+
+# Number of rows in each record batch of the binary output formats
+defaultRecordBatchSize = 10000
+
+# Numbers as written in the partitions (a leading zero marks an identifier, e.g. "0579")
+numberPattern = re.compile(r"-?(0|[1-9]\d*)(\.\d+)?$")
+
+
+def splitTimeChunks(startTime, endTime, timeChunk):
+    """
+    Returns a list of (start, end) times (as 12 digit strings) splitting the
+    period from ``startTime`` to ``endTime`` at the boundaries of each calendar
+    decade, year or month (``timeChunk``). The first chunk starts at the start
+    time and the last ends at the end time; the others run from 0000 on their
+    first day to 2359 on their last.
+    """
+    if timeChunk not in timeChunks:
+        raise Exception("Time chunk must be one of: %s" % ", ".join(timeChunks))
+
+    chunks = []
+    chunkStart = startTime
+    (year, month) = (int(startTime[:4]), int(startTime[4:6]))
+
+    while True:
+        if timeChunk == "month":
+            (year, month) = (year + month // 12, month % 12 + 1)
+        elif timeChunk == "year":
+            (year, month) = (year + 1, 1)
+        else:
+            (year, month) = ((year // 10 + 1) * 10, 1)
+
+        nextStart = "%04d%02d010000" % (year, month)
+        if nextStart > endTime:
+            chunks.append((chunkStart, endTime))
+            return chunks
+
+        (lastYear, lastMonth) = (year, month - 1) if month > 1 else (year - 1, 12)
+        lastDay = calendar.monthrange(lastYear, lastMonth)[1]
+        chunks.append((chunkStart, "%04d%02d%02d2359" % (lastYear, lastMonth, lastDay)))
+        chunkStart = nextStart
+
+
+def _removeFile(path):
+    "Removes the file at path if it exists."
+    if os.path.exists(path):
+        os.unlink(path)
+
+
+def getChunkOutputPath(outputPath, start, end):
+    """
+    Returns the path of the output file for the chunk from ``start`` to ``end``:
+    "<base>-<start>-<end>.<ext>" where ``outputPath`` is "<base>.<ext>".
+    """
+    (base, ext) = os.path.splitext(outputPath)
+    return "%s-%s-%s%s" % (base, start, end, ext)
+
+
+class TextOutputWriter:
+    """
+    Streams rows to a delimited text file, or to standard output if the output
+    path is "display".
+    """
+
+    def __init__(self, outputPath, headers, delimiter="default", append=False, verbose=1):
+        """
+        Opens the output and writes the header line (unless ``headers`` is None).
+        If ``append`` is set rows are added to the end of an existing file.
+        The number of rows written is only printed if ``verbose`` is set.
+        """
+        self.outputPath = outputPath
+        self.delimiter = getDelimiter(delimiter)
+        self.verbose = verbose
+        self.count = 0
+
+        if outputPath == "display":
+            print "Output data follows:\n"
+            self.output = sys.stdout
+        elif append:
+            self.output = open(outputPath, "a")
+            headers = None
+        else:
+            # Do not write through a hard link shared with the extraction cache
+            if os.path.exists(outputPath) and os.stat(outputPath).st_nlink > 1:
+                os.unlink(outputPath)
+            self.output = open(outputPath, "w")
+
+        if headers is not None:
+            self.writeHeader(headers)
+
+    def writeHeader(self, headers):
+        "Writes a header line listing the column names in ``headers``."
+        self._write(inputDelimiter.join(headers) + "\n")
+
+    def _write(self, data):
+        "Writes data to the output converting delimiters as required."
+        if self.delimiter != inputDelimiter:
+            data = data.replace(inputDelimiter, self.delimiter)
+        self.output.write(data)
+
+    def write(self, rows):
+        """
+        Writes one or more complete rows to the output.
+        """
+        self.count += rows.count("\n")
+        self._write(rows)
+
+    def close(self):
+        """
+        Finishes the output. If no rows were written to a file the header is
+        replaced by a message explaining that no data were found.
+        """
+        if self.outputPath == "display":
+            print
+            return
+
+        if self.count == 0:
+            if self.verbose:
+                print "===\nNo data found.\n===\n"
+            self.output.seek(0)
+            self.output.truncate()
+            self.output.write(noDataMessage)
+        elif self.verbose:
+            print "%s records written to: %s\n===\n" % (self.count, self.outputPath)
+
+        self.output.close()
+
+    def abort(self):
+        """
+        Stops writing and removes the incomplete output file.
+        """
+        if self.outputPath == "display":
+            return
+
+        self.output.close()
+        _removeFile(self.outputPath)
+
+
+def _toSeconds(value):
+    "Returns a 'YYYY-MM-DD hh:mm' date/time as seconds since 1970, or None."
+    dateLong = parseTime(value, 0) if len(value) == timeLength else None
+    if dateLong is None:
+        return None
+    return calendar.timegm((dateLong // 100000000, dateLong // 1000000 % 100, dateLong // 10000 % 100,
+                            dateLong // 100 % 100, dateLong % 100, 0))
+
+
+def _toFloat(value):
+    "Returns the value as a float, or None if it is not a number."
+    if not numberPattern.match(value):
+        return None
+    return float(value)
+
+
+def _toInt(value):
+    "Returns the value as an int, or None if it is not a whole number."
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+# Conversion of the text fields of each column type
+_converters = {"time": _toSeconds, "float": _toFloat, "int": _toInt, "string": None}
+
+
+def _widenType(columnType, value):
+    """
+    Returns the narrowest type holding a (non-empty) ``value`` as well as the
+    values of ``columnType`` (None if there are none yet).
+    """
+    if columnType is None:
+        if len(value) == timeLength and parseTime(value, 0) is not None:
+            return "time"
+        return "float" if numberPattern.match(value) else "string"
+    if columnType == "time":
+        return "time" if len(value) == timeLength and parseTime(value, 0) is not None else "string"
+    if columnType == "int" and _toInt(value) is not None:
+        return "int"
+    if columnType != "string" and numberPattern.match(value):
+        return "float"
+    return "string"
+
+
+def inferColumnTypes(headers, columns, types=None):
+    """
+    Returns the type ("time", "int", "float" or "string") of each column given
+    its name in ``headers`` and its values in ``columns``, widening the ``types``
+    of the values seen before (if given) to hold them: from "int" to "float" to
+    "string", or from "time" to "string". The type of a column without any
+    values is None.
+    """
+    if types is None:
+        types = ["int" if name == "src_id" else None for name in headers]
+    types = list(types)
+
+    for (i, values) in enumerate(columns):
+        columnType = types[i]
+        for value in values:
+            if columnType == "string":
+                break
+            if value != "":
+                columnType = _widenType(columnType, value)
+        types[i] = columnType
+    return types
+
+
+def mergeColumnTypes(typeLists):
+    """
+    Returns the narrowest types holding the values of each of the lists of
+    column types in ``typeLists`` (e.g. of the files of a chunked output).
+    """
+    merged = None
+    for types in typeLists:
+        if merged is None:
+            merged = list(types)
+            continue
+        for (i, (first, second)) in enumerate(zip(merged, types)):
+            if first is None or first == second:
+                merged[i] = second
+            elif second is None:
+                continue
+            elif set([first, second]) == set(["int", "float"]):
+                merged[i] = "float"
+            else:
+                merged[i] = "string"
+    return merged
+
+
+class RecordOutputWriter:
+    """
+    Base class of the writers of binary output formats. Rows are held in a
+    temporary file while the type of each column is found from their values (in
+    batches of ``batchSize`` rows). When the output is closed the rows are read
+    back, converted to typed columns and passed to ``_writeBatch()`` in batches.
+    """
+
+    formatName = None
+
+    def __init__(self, outputPath, headers, batchSize=defaultRecordBatchSize, tempDir=None, verbose=1):
+        """
+        Checks that the format can be written. The rows are held in a file in
+        ``tempDir`` and the output file is written when the writer is closed.
+        The number of rows written is only printed if ``verbose`` is set.
+        """
+        if outputPath == "display":
+            raise Exception("Output in %s format must be written to a file." % self.formatName)
+        if headers is None:
+            raise Exception("Output in %s format needs the names of the columns." % self.formatName)
+
+        self.checkAvailable()
+        self.outputPath = outputPath
+        self.headers = list(headers)
+        self.batchSize = batchSize
+        self.verbose = verbose
+        self.types = None
+        self.rows = []
+        self.count = 0
+        self.spool = tempfile.TemporaryFile(prefix="records_", dir=tempDir)
+        self.opened = False
+
+        # Do not write through a hard link shared with the extraction cache
+        if os.path.exists(outputPath):
+            os.unlink(outputPath)
+
+    @classmethod
+    def checkAvailable(cls):
+        "Raises an Exception if the modules needed to write the format are not installed."
+        raise NotImplementedError
+
+    def _splitRow(self, row):
+        "Returns the fields of a row (without its line ending), padded to the number of columns."
+        nColumns = len(self.headers)
+        fields = row.rstrip("\r").split(inputDelimiter, nColumns - 1)
+        if len(fields) < nColumns:
+            fields.extend([""] * (nColumns - len(fields)))
+        return fields
+
+    def write(self, rows):
+        """
+        Writes one or more complete rows to the output.
+        """
+        self.spool.write(rows)
+        self.rows.extend(rows.split("\n")[:-1])
+        if len(self.rows) >= self.batchSize:
+            self._updateTypes()
+
+    def _updateTypes(self):
+        "Widens the column types to hold the values of the rows gathered since the last update."
+        if self.rows:
+            self.count += len(self.rows)
+            self.types = inferColumnTypes(self.headers, zip(*[self._splitRow(row) for row in self.rows]),
+                                          self.types)
+            self.rows = []
+        elif self.types is None:
+            self.types = inferColumnTypes(self.headers, [])
+
+    def getColumnTypes(self):
+        """
+        Returns the types of the columns of the rows written so far (None for a
+        column without any values).
+        """
+        self._updateTypes()
+        return self.types
+
+    def _writeOutput(self):
+        "Writes the held rows to the output file in batches of typed columns."
+        # Columns without any values are written as text
+        self.types = [columnType or "string" for columnType in self.types]
+        self._open()
+        self.opened = True
+
+        converters = [_converters[columnType] for columnType in self.types]
+        self.spool.seek(0)
+        written = 0
+        while written < self.count:
+            rows = [self._splitRow(self.spool.readline().rstrip("\n")) for i in xrange(
+                min(self.batchSize, self.count - written))]
+            converted = []
+            for (convert, values) in zip(converters, zip(*rows)):
+                if convert is None:
+                    converted.append([value if value != "" else None for value in values])
+                else:
+                    converted.append([convert(value) if value != "" else None for value in values])
+            self._writeBatch(converted, len(rows), written)
+            written += len(rows)
+
+    def _open(self):
+        "Creates the output file once the column types are known."
+        raise NotImplementedError
+
+    def _writeBatch(self, columns, nRows, start):
+        "Writes a batch of ``nRows`` rows, from row ``start``, given as a list of converted columns."
+        raise NotImplementedError
+
+    def _close(self):
+        "Finishes the output file."
+        raise NotImplementedError
+
+    def close(self, types=None):
+        """
+        Writes the output file and removes the held rows. The column types are
+        widened to hold ``types`` if given (e.g. the types of the other files of
+        a chunked output).
+        """
+        self._updateTypes()
+        if types is not None:
+            self.types = mergeColumnTypes([self.types, types])
+        try:
+            self._writeOutput()
+            self._close()
+        finally:
+            self.spool.close()
+
+        if not self.verbose:
+            return
+        if self.count == 0:
+            print "===\nNo data found.\n===\n"
+        else:
+            print "%s records written to: %s\n===\n" % (self.count, self.outputPath)
+
+    def abort(self):
+        """
+        Stops writing and removes the held rows and any incomplete output file.
+        """
+        self.spool.close()
+        if self.opened:
+            self._close()
+        _removeFile(self.outputPath)
+
+
+class _ArrowTableWriter(RecordOutputWriter):
+    """
+    Shared parts of the Arrow IPC and Parquet writers.
+    """
+
+    arrowTypes = {"time": "timestamp", "int": "int64", "float": "float64", "string": "string"}
+
+    @classmethod
+    def checkAvailable(cls):
+        if pyarrow is None:
+            raise Exception("The 'pyarrow' package is needed to write %s output." % cls.formatName)
+
+    def _getSchema(self):
+        "Returns the Arrow schema of the output, with the header line as metadata."
+        fields = []
+        for (name, columnType) in zip(self.headers, self.types):
+            if columnType == "time":
+                arrowType = pyarrow.timestamp("s")
+            else:
+                arrowType = getattr(pyarrow, self.arrowTypes[columnType])()
+            fields.append(pyarrow.field(name, arrowType))
+        return pyarrow.schema(fields, metadata={"header": inputDelimiter.join(self.headers)})
+
+    def _getRecordBatch(self, columns):
+        "Returns the converted columns as an Arrow record batch."
+        arrays = [pyarrow.array(column, type=field.type) for (column, field) in zip(columns, self.schema)]
+        return pyarrow.RecordBatch.from_arrays(arrays, self.headers)
+
+
+class ArrowOutputWriter(_ArrowTableWriter):
+    """
+    Streams rows to an Arrow IPC file in record batches.
+    """
+
+    formatName = "arrow"
+
+    def _open(self):
+        self.schema = self._getSchema()
+        self.sink = pyarrow.OSFile(self.outputPath, "wb")
+        self.writer = pyarrow.RecordBatchFileWriter(self.sink, self.schema)
+
+    def _writeBatch(self, columns, nRows, start):
+        self.writer.write_batch(self._getRecordBatch(columns))
+
+    def _close(self):
+        self.writer.close()
+        self.sink.close()
+
+
+class ParquetOutputWriter(_ArrowTableWriter):
+    """
+    Streams rows to a Parquet file, one row group per record batch.
+    """
+
+    formatName = "parquet"
+
+    @classmethod
+    def checkAvailable(cls):
+        if parquet is None:
+            raise Exception("The 'pyarrow' package (with Parquet support) is needed to write parquet output.")
+
+    def _open(self):
+        self.schema = self._getSchema()
+        self.writer = parquet.ParquetWriter(self.outputPath, self.schema)
+
+    def _writeBatch(self, columns, nRows, start):
+        self.writer.write_table(pyarrow.Table.from_batches([self._getRecordBatch(columns)]))
+
+    def _close(self):
+        self.writer.close()
+
+
+class NetCDFOutputWriter(RecordOutputWriter):
+    """
+    Streams rows to a NetCDF4 file with a variable for each column along an
+    unlimited "record" dimension. Times are seconds since 1970.
+    """
+
+    formatName = "netcdf"
+
+    # NetCDF type and fill value of each column type
+    netcdfTypes = {"time": ("i8", -1), "int": ("i8", -1), "float": ("f8", float("nan")), "string": (str, None)}
+
+    @classmethod
+    def checkAvailable(cls):
+        if netCDF4 is None:
+            raise Exception("The 'netCDF4' package is needed to write netcdf output.")
+
+    def _open(self):
+        self.dataset = netCDF4.Dataset(self.outputPath, "w", format="NETCDF4")
+        self.dataset.header = inputDelimiter.join(self.headers)
+        self.dataset.createDimension("record", None)
+        self.variables = []
+
+        for (name, columnType) in zip(self.headers, self.types):
+            (netcdfType, fillValue) = self.netcdfTypes[columnType]
+            if fillValue is None:
+                variable = self.dataset.createVariable(name, netcdfType, ("record",))
+            else:
+                variable = self.dataset.createVariable(name, netcdfType, ("record",), fill_value=fillValue)
+            if columnType == "time":
+                variable.units = "seconds since 1970-01-01 00:00:00"
+                variable.calendar = "standard"
+            self.variables.append((variable, columnType, fillValue))
+
+    def _writeBatch(self, columns, nRows, start):
+        for ((variable, columnType, fillValue), column) in zip(self.variables, columns):
+            if columnType == "string":
+                values = numpy.array([value or "" for value in column], dtype=object)
+            else:
+                values = numpy.array([fillValue if value is None else value for value in column],
+                                     dtype=variable.dtype)
+            variable[start:start + nRows] = values
+
+    def _close(self):
+        self.dataset.close()
+
+
+# Writer class of each binary output format
+recordWriters = {"arrow": ArrowOutputWriter, "parquet": ParquetOutputWriter, "netcdf": NetCDFOutputWriter}
+
+
+def getOutputWriter(outputPath, headers, delimiter="default", outputFormat="text", append=False, tempDir=None,
+                    verbose=1):
+    """
+    Returns a writer for ``outputPath`` in the output format: a
+    ``TextOutputWriter`` using the delimiter, or the writer of a binary format
+    (holding its rows in ``tempDir`` until it is closed).
+    """
+    if outputFormat == "text":
+        return TextOutputWriter(outputPath, headers, delimiter, append, verbose=verbose)
+    if outputFormat not in recordWriters:
+        raise Exception("Output format must be one of: %s" % ", ".join(outputFormats))
+    return recordWriters[outputFormat](outputPath, headers, tempDir=tempDir, verbose=verbose)
+
+
+class ChunkedOutputWriter:
+    """
+    Streams rows to one output file for each time chunk, choosing the file from
+    the time of each row.
+    """
+
+    def __init__(self, outputPath, headers, delimiter, chunks, getTime, outputFormat="text", tempDir=None,
+                 verbose=1):
+        """
+        Sets up an output for each (start, end) time in ``chunks`` (see
+        ``splitTimeChunks``), named from ``outputPath`` by ``getChunkOutputPath``.
+        ``getTime`` returns the time of a row as a YYYYMMDDhhmm number. Files are
+        opened as rows arrive for them. Binary outputs hold their rows in
+        ``tempDir`` until they are closed.
+        """
+        if outputPath == "display":
+            raise Exception("Output split into time chunks must be written to files.")
+
+        self.headers = headers
+        self.delimiter = delimiter
+        self.outputFormat = outputFormat
+        self.tempDir = tempDir
+        self.verbose = verbose
+        self.getTime = getTime
+        self.outputPaths = [getChunkOutputPath(outputPath, start, end) for (start, end) in chunks]
+        self.starts = [long(start) for (start, end) in chunks]
+        self.ends = [long(end) for (start, end) in chunks]
+        self.count = 0
+
+        # Rows arrive in time order so only one text file is open at a time. Binary
+        # files cannot be appended to so they are kept open until the end.
+        self.current = None
+        self.writer = None
+        self.writers = {}
+        self.opened = set()
+
+    def getChunk(self, dateLong):
+        "Returns the index of the chunk holding the time."
+        return max(bisect.bisect_right(self.starts, dateLong) - 1, 0)
+
+    def _getChunk(self, dateLong):
+        "Returns the index of the chunk holding the time, checking the current chunk first."
+        current = self.current
+        if dateLong is None or (current is not None and self.starts[current] <= dateLong <= self.ends[current]):
+            return current
+        return self.getChunk(dateLong)
+
+    def _switchTo(self, chunk):
+        "Makes the output of ``chunk`` the one that rows are written to."
+        if self.outputFormat == "text" and self.writer is not None:
+            self.writer.close()
+            del self.writers[self.current]
+
+        if chunk not in self.writers:
+            self.writers[chunk] = getOutputWriter(self.outputPaths[chunk], self.headers, self.delimiter,
+                                                  self.outputFormat, append=chunk in self.opened,
+                                                  tempDir=self.tempDir, verbose=self.verbose)
+        self.writer = self.writers[chunk]
+        self.opened.add(chunk)
+        self.current = chunk
+
+    def write(self, rows):
+        """
+        Writes one or more complete rows, each to the output of its chunk.
+        """
+        getTime = self.getTime
+        group = []
+        groupChunk = self.current
+
+        for row in rows.splitlines(True):
+            chunk = self._getChunk(getTime(row))
+            if chunk != groupChunk:
+                self._writeGroup(group, groupChunk)
+                group = []
+                groupChunk = chunk
+            group.append(row)
+
+        self._writeGroup(group, groupChunk)
+
+    def _writeGroup(self, group, chunk):
+        "Writes a list of rows to the output of ``chunk``."
+        if not group:
+            return
+        if chunk is None:
+            chunk = 0
+        if chunk != self.current:
+            self._switchTo(chunk)
+
+        self.writer.write("".join(group))
+        self.count += len(group)
+
+    def close(self):
+        """
+        Finishes the outputs. Chunks without any rows get a file explaining
+        that no data were found (or, for a binary format, a file without rows).
+        The files of a binary format are all written with the column types
+        found across all of their rows.
+        """
+        if self.outputFormat == "text":
+            closeArgs = ()
+        else:
+            writers = [self.writers[chunk] for chunk in sorted(self.writers)]
+            closeArgs = (mergeColumnTypes([writer.getColumnTypes() for writer in writers]),)
+
+        for chunk in sorted(self.writers):
+            self.writers[chunk].close(*closeArgs)
+        self.writers = {}
+        self.writer = None
+
+        for (chunk, outputPath) in enumerate(self.outputPaths):
+            if chunk not in self.opened:
+                getOutputWriter(outputPath, self.headers, self.delimiter, self.outputFormat, tempDir=self.tempDir,
+                                verbose=self.verbose).close(*closeArgs)
+
+    def abort(self):
+        """
+        Stops writing and removes the output files written so far.
+        """
+        for chunk in sorted(self.writers):
+            self.writers[chunk].abort()
+        self.writers = {}
+        self.writer = None
+
+        for chunk in self.opened:
+            _removeFile(self.outputPaths[chunk])
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""
+partitionCatalog.py
+===================
+
+Catalog of the partition files of the MIDAS tables.
+
+Partition files are named 'nonsense-data_<label>_<YYYYMM>-<YYYYMM>.txt' where the
+label identifies the table (e.g. 'tempdrnl' for TEMP_DRNL_OB) and, for the global
+weather table, the region (e.g. 'glblwx-europe'). Partitions may be compressed
+(see 'compressedPartition.py'), in which case the name ends with the suffix of
+the codec; if a partition is present both compressed and uncompressed the
+uncompressed file is used.
+
+Only the label of 'tempdrnl' is known from real partition names; the others are
+expected names. If a table has no known label, or no partition file has its
+label, every partition file (of the region, if one is given) is listed for it,
+as the subsetter did before partitions were matched to their tables, so that a
+wrong label cannot silently give an empty extraction.
+
+The data directory is listed once and the partitions of each (table, region) are
+looked up from that listing the first time they are asked for. The catalog is
+kept for the life of the process and is only rebuilt when the modification time
+of the data directory (or of the manifest file, if there is one) changes.
+
+"""
+
+# Import required modules
+import os
+import re
+
+
+# Partition file name pattern: (label, start YYYYMM, end YYYYMM)
+partitionNamePattern = re.compile(r"nonsense-data_([a-zA-Z\-]+)_(\d{6})-(\d{6})\.txt(\.gz|\.bz2|\.xz|\.zst)?$")
+
+# Label used in the partition file names of each table
+partitionLabels = {"TEMP_DRNL_OB": "tempdrnl", "WEATHER_DRNL_OB": "wxdrnl", "WEATHER_HRLY_OB": "wxhrly",
+                   "RAIN_DRNL_OB": "raindrnl", "RAIN_HRLY_OB": "rainhrly", "RAIN_SUBHRLY_OB": "rainsubhrly",
+                   "WIND_MEAN_OB": "wind", "SOIL_TEMP_OB": "soiltemp", "RADT_OB_V2": "radtob",
+                   "GBL_WX_OB": "glblwx"}
+
+# Tables whose partitions are split by region
+regionalTables = ("GBL_WX_OB",)
+
+globalWXCodes = {"1": "glblwx-africa", "2": "glblwx-asia",
+                 "3": "glblwx-south-america", "4": "glblwx-north-central-america",
+                 "5": "glblwx-south-west-pacific", "6": "glblwx-europe",
+                 "7": "glblwx-antarctic"}
+
+# Catalogs of each data directory: {datadir: PartitionCatalog}
+_catalogs = {}
+
+
+def _getMTime(path):
+    "Returns the modification time of path or None if it does not exist."
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class PartitionCatalog:
+    """
+    Partition files of a data directory grouped by their label.
+    """
+
+    def __init__(self, datadir, manifest=None):
+        """
+        Lists the partition files in ``datadir``.
+        """
+        self.datadir = datadir
+        self.manifest = manifest
+        self.stamp = self.getStamp()
+        self.partitions = {}
+        self.tables = {}
+
+        pfiles = sorted(os.listdir(datadir))
+        names = set(pfiles)
+
+        for pfile in pfiles:
+            pmatch = partitionNamePattern.match(pfile)
+            if pmatch:
+                suffix = pmatch.group(4)
+                if suffix and pfile[:-len(suffix)] in names:
+                    continue
+                label = pmatch.group(1)
+                self.partitions.setdefault(label, []).append(os.path.join(datadir, pfile))
+
+    def getStamp(self):
+        "Returns the modification times that the catalog depends on."
+        return (_getMTime(self.datadir), _getMTime(self.manifest) if self.manifest else None)
+
+    def isCurrent(self):
+        "Returns True if the data directory and manifest have not changed since the catalog was built."
+        return self.getStamp() == self.stamp
+
+    def getPartitionFiles(self, tableName, region=None):
+        """
+        Returns the sorted list of partition file paths for the table (and the
+        region for regional tables).
+        """
+        if tableName not in regionalTables:
+            region = None
+
+        key = (tableName, region)
+        if key not in self.tables:
+            self.tables[key] = self._findPartitionFiles(tableName, region)
+        return self.tables[key]
+
+    def _findPartitionFiles(self, tableName, region):
+        """
+        Returns the partition file paths whose label matches the table and
+        region, or all the partition files (of the region) if there are none.
+        """
+        if region:
+            if region not in globalWXCodes:
+                raise Exception("Region not known: %s" % region)
+            regionLabels = [globalWXCodes[region]]
+        else:
+            regionLabels = list(self.partitions)
+
+        label = partitionLabels.get(tableName)
+        if label is None:
+            labels = []
+        elif region:
+            labels = regionLabels
+        elif tableName in regionalTables:
+            labels = [name for name in self.partitions if name.split("-")[0] == label]
+        else:
+            labels = [label]
+
+        paths = []
+        for name in labels:
+            paths.extend(self.partitions.get(name, []))
+        if not paths:
+            # The label of the table is not known or not used by the partition files
+            for name in regionLabels:
+                paths.extend(self.partitions.get(name, []))
+        return sorted(paths, key=os.path.basename)
+
+
+def getCatalog(datadir, manifest=None):
+    """
+    Returns the catalog of ``datadir``, building it if it has not been built yet
+    or if the directory or the manifest has changed.
+    """
+    catalog = _catalogs.get(datadir)
+    if catalog is None or catalog.manifest != manifest or not catalog.isCurrent():
+        catalog = PartitionCatalog(datadir, manifest)
+        _catalogs[datadir] = catalog
+    return catalog
+
+
+def getPartitionFiles(datadir, tableName, region=None, manifest=None):
+    """
+    Returns the list of partition file paths in ``datadir`` for the table.
+    """
+    return getCatalog(datadir, manifest).getPartitionFiles(tableName, region)
+
+
+def clearCatalogs():
+    "Forgets all the catalogs so that they are rebuilt on next use."
+    _catalogs.clear()
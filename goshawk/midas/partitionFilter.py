@@ -0,0 +1,783 @@
+#!/usr/bin/env python
+
+"""
+partitionFilter.py
+==================
+
+Filters the rows of MIDAS partition files by time, station and value conditions.
+
+Partitions are memory-mapped and rows are parsed in place, so only the rows that
+match are copied out of the mapping (set ``useMmap`` to False to read them line
+by line instead). Rows that pass the time and station tests are collected into
+batches, which are then split into fields (only as far as the last column that
+is needed), tested against the compiled value conditions (see 'rowConditions.py')
+and reduced to the selected columns before being written. Compressed partitions
+(see 'compressedPartition.py') are read line by line through streaming
+decompression, starting from the block holding the start time. If a partition has an up-to-date columnar copy (see
+'columnarStore.py') the matching rows are found from that instead.
+
+If a partition has a zone map (see 'zoneMaps.py') the file is skipped when none
+of its rows can match, and otherwise only the blocks that may hold matching rows
+are read. Requests for only a few stations use the station index of the partition (see
+'partitionIndex.py') if it has one: only the byte ranges holding the rows of
+those stations are read, from the start time onwards.
+
+A ``PartitionFilter`` holds everything needed to filter a partition so that it
+can be sent to worker processes, which lets several partitions be filtered in
+parallel (see ``filterPartitionJobs``). Partitions larger than the split size
+are also divided into byte ranges, aligned to the starts of lines, that are
+filtered concurrently. The outputs of the workers are joined back together in
+order so the result is identical to filtering the files one after the other.
+Filters for several tables can be run together in the same pool, which can also
+report progress as the number of bytes of the partition files that have been
+filtered (see ``ByteProgress``). The files, bytes and rows read and written, and
+the time spent filtering and writing rows, are added to the ``ExtractionStats``
+of the filter (see 'extractionStats.py').
+
+The matching rows can also be taken in batches, in this process, without
+writing them anywhere (see ``PartitionFilter.iterPartition`` and
+``iterPartitions``).
+
+"""
+
+# Import required modules
+import os
+import mmap
+import multiprocessing
+
+import partitionIndex
+import columnarStore
+import compressedPartition
+import zoneMaps
+from extractionStats import ExtractionStats, clock
+from rowTokenizer import RowTokenizer, fieldSeparator, canonicalSrcId
+
+
+# Partitions bigger than this (in bytes) are split into ranges for parallel filtering
+defaultSplitSize = 256 * 1024 * 1024
+
+# Number of rows gathered before value conditions are applied and the rows written
+defaultBatchSize = 1000
+
+# Largest number of stations for which the station index is used
+defaultMaxIndexedStations = 50
+
+# Station ranges closer than this (in bytes) are read together
+stationRangeGap = 4096
+
+# Number of lines read between reports of progress within a partition
+progressLines = 10000
+
+# Number of progress reports over the whole extraction
+progressSteps = 100
+
+
+# Seconds between checks for cancellation while waiting for worker processes
+pollInterval = 0.5
+
+
+class ByteProgress:
+    """
+    Counts the bytes of the partition files that have been filtered, out of
+    ``totalBytes``, and passes them to ``callback(doneBytes, totalBytes)`` (if
+    given) about every 1% of the total. Bytes skipped by seeking or by the
+    indexes count as done. Each time the count moves on the ``interruptCheck``
+    (see 'cancellation.py'), if given, is checked.
+    """
+
+    def __init__(self, callback, totalBytes, interruptCheck=None):
+        self.callback = callback
+        self.totalBytes = totalBytes
+        self.interruptCheck = interruptCheck
+        self.step = max(1, totalBytes // progressSteps)
+        self.doneBytes = 0
+        self.fileBytes = 0
+        self.reported = None
+
+    def update(self, fileBytes):
+        "Records the number of bytes of the current file that have been filtered."
+        self.fileBytes = fileBytes
+        self.report()
+
+    def finishFile(self, nBytes):
+        "Records that ``nBytes`` more bytes (a whole file or range) have been filtered."
+        self.doneBytes += nBytes
+        self.fileBytes = 0
+        self.report()
+
+    def report(self, force=False):
+        "Calls the callback if the count has moved on by a step since the last call."
+        if self.interruptCheck is not None:
+            self.interruptCheck.check()
+        if self.callback is None:
+            return
+
+        done = min(self.doneBytes + self.fileBytes, self.totalBytes)
+        if force or self.reported is None or done - self.reported >= self.step or (
+                done == self.totalBytes and done != self.reported):
+            self.reported = done
+            self.callback(done, self.totalBytes)
+
+
+def getProgress(fileLists, progressCallback=None, interruptCheck=None):
+    """
+    Returns a ``ByteProgress`` over the files of the lists, having made its
+    first report, or None if there is no ``progressCallback`` and no active
+    ``interruptCheck`` (see 'cancellation.py').
+    """
+    if interruptCheck is not None and not interruptCheck.isActive():
+        interruptCheck = None
+    if progressCallback is None and interruptCheck is None:
+        return None
+
+    totalBytes = sum(os.path.getsize(filename) for fileList in fileLists for filename in fileList)
+    progress = ByteProgress(progressCallback, totalBytes, interruptCheck)
+    progress.report(force=True)
+    return progress
+
+
+class PartitionFilter:
+    """
+    Time, station and value filter applied to the rows of partition files.
+    """
+
+    def __init__(self, timeIndex, startTimeLong, endTimeLong, srcidIndex=None, src_ids=None,
+                 seekMode="auto", useMmap=True, columnNames=None, useColumnar=True, verbose=1,
+                 conditions=None, columns=None, batchSize=defaultBatchSize,
+                 maxIndexedStations=defaultMaxIndexedStations, stats=None):
+        """
+        Sets up the row tokenizer and the set of stations to match. The columnar
+        copies of partitions are only used if the table's ``columnNames`` are given.
+        Station indexes are used when no more than ``maxIndexedStations`` stations
+        are requested.
+        ``conditions`` is a list of compiled ``RowCondition`` objects, in the order
+        they are applied, and ``columns`` a list of the indexes of the columns to
+        output (default is the whole row). The work done is added to ``stats``
+        (a new ``ExtractionStats`` if not given).
+        """
+        self.stats = stats if stats is not None else ExtractionStats()
+        self.startTimeLong = startTimeLong
+        self.endTimeLong = endTimeLong
+        self.seekMode = seekMode
+        self.useMmap = useMmap
+        self.verbose = verbose
+        self.batchSize = batchSize
+        self.maxIndexedStations = maxIndexedStations
+
+        self.conditions = conditions or []
+        self.columns = columns or None
+        # Rows are only split as far as the last column that is needed
+        neededIndexes = [condition.columnIndex for condition in self.conditions] + (self.columns or [])
+        if neededIndexes:
+            self.maxSplit = max(neededIndexes) + 1
+        else:
+            self.maxSplit = None
+
+        self.timeColumn = None
+        self.srcidColumn = None
+        if columnNames and useColumnar:
+            self.timeColumn = columnNames[timeIndex]
+            if srcidIndex is not None:
+                self.srcidColumn = columnNames[srcidIndex]
+
+        # Station IDs are matched in the form the partitions write them on every path
+        if src_ids:
+            self.srcIdSet = frozenset(canonicalSrcId(src_id) for src_id in src_ids)
+        else:
+            self.srcIdSet = None
+            srcidIndex = None
+
+        self.tokenizer = RowTokenizer(timeIndex, srcidIndex)
+
+    def filterPartition(self, filename, output, byteRange=None, progress=None):
+        """
+        Writes the matching rows of the partition file to the open ``output``
+        file and returns the number of rows written (see ``iterPartition``).
+        """
+        stats = self.stats
+        count = 0
+        for rows in self.iterPartition(filename, byteRange, progress):
+            start = clock()
+            output.write("\n".join(rows) + "\n")
+            stats.addTime("write", clock() - start)
+            count += len(rows)
+        return count
+
+    def iterPartition(self, filename, byteRange=None, progress=None):
+        """
+        Yields the matching rows of the partition file in batches: lists of
+        rows (without line endings) that meet the value conditions, reduced to
+        the selected columns. If ``byteRange`` is given as (start, end) only the
+        lines starting in that range are read. The offset reached in the file is
+        passed to ``progress.update()`` (if given) as lines are read.
+        """
+        if compressedPartition.isCompressed(filename):
+            for rows in self._iterCompressed(filename, byteRange):
+                yield rows
+            return
+
+        zoneMap = zoneMaps.readZoneMap(filename)
+        if zoneMap is not None and not zoneMap[0].mayMatch(self.startTimeLong, self.endTimeLong, self.srcIdSet):
+            if byteRange is None:
+                self.stats.add("filesPruned")
+                if self.verbose:
+                    print "\nSkipping file '%s' as its zone map shows no matching rows." % filename
+            return
+
+        stationRanges = self.getStationRanges(filename)
+        if stationRanges is not None:
+            for rows in self._iterStationRanges(filename, stationRanges, byteRange):
+                yield rows
+            return
+
+        if self.timeColumn and columnarStore.hasColumnarStore(filename):
+            for rows in self._iterColumnar(filename, byteRange):
+                yield rows
+            return
+
+        file = open(filename, "rb")
+
+        if byteRange is None:
+            if self.verbose:
+                print "\nFiltering file '%s' of %s bytes." % (filename, os.path.getsize(filename))
+            position = self.getStartOffset(file, filename)
+            endPosition = None
+        else:
+            (position, endPosition) = byteRange
+
+        if zoneMap is not None:
+            blockRanges = zoneMaps.getMatchingRanges(zoneMap[1], self.startTimeLong, self.endTimeLong,
+                                                     self.srcIdSet, position, endPosition)
+            if self.verbose and byteRange is None:
+                print "Reading %s of %s blocks using the zone map." % (
+                    len(blockRanges), len(zoneMap[1]))
+        else:
+            blockRanges = [(position, endPosition)]
+
+        buf = None
+        if self.useMmap:
+            try:
+                buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                # Empty files (and some file systems) cannot be mapped
+                pass
+
+        try:
+            for (position, endPosition) in blockRanges:
+                if buf is not None:
+                    if endPosition is None:
+                        endPosition = len(buf)
+                    batches = self._iterMapped(buf, position, endPosition, progress)
+                else:
+                    file.seek(position)
+                    batches = self._iterLines(file, position, endPosition, progress)
+                for rows in batches:
+                    yield rows
+        finally:
+            if buf is not None:
+                buf.close()
+            file.close()
+
+    def _iterCompressed(self, filename, byteRange=None):
+        """
+        Filters the rows of a compressed partition by streaming decompression.
+        A ``byteRange`` is given as (start, end) offsets of blocks in the
+        compressed file.
+        """
+        if byteRange is None:
+            if self.verbose:
+                print "\nFiltering compressed file '%s'." % filename
+            start = self.getBlockStart(filename)
+            end = None
+        else:
+            (start, end) = byteRange
+
+        file = compressedPartition.openPartition(filename, start, end)
+        try:
+            for rows in self._iterLines(file, 0, None):
+                yield rows
+        finally:
+            file.close()
+
+    def _iterStationRanges(self, filename, stationRanges, byteRange=None):
+        """
+        Filters the rows in the ``stationRanges`` of the partition file, which
+        hold the rows of the requested stations, reading nothing else.
+        """
+        file = open(filename, "rb")
+
+        if byteRange is None:
+            if self.verbose:
+                print "\nFiltering file '%s' using its station index (%s ranges)." % (
+                    filename, len(stationRanges))
+            start = self.getStartOffset(file, filename)
+            end = None
+        else:
+            (start, end) = byteRange
+
+        getTime = self.tokenizer.getTime
+        getSrcId = self.tokenizer.getSrcId
+        srcIdSet = self.srcIdSet
+        startTimeLong = self.startTimeLong
+        endTimeLong = self.endTimeLong
+        batchSize = self.batchSize
+
+        batch = []
+        lcount = 0
+        bytesRead = 0
+
+        try:
+            for (rangeStart, rangeEnd) in stationRanges:
+                if rangeEnd <= start:
+                    continue
+                if end is not None:
+                    if rangeStart >= end:
+                        break
+                    rangeEnd = min(rangeEnd, end)
+
+                file.seek(max(rangeStart, start))
+                pastEnd = False
+                data = file.read(rangeEnd - file.tell())
+                bytesRead += len(data)
+
+                for line in data.splitlines():
+                    lcount += 1
+                    dmatch = getTime(line)
+
+                    # Check if datetime has gone past the selected range
+                    if dmatch and dmatch > endTimeLong:
+                        pastEnd = True
+                        break
+
+                    # Ranges closer than the gap can hold rows of other stations
+                    if dmatch and startTimeLong <= dmatch and getSrcId(line) in srcIdSet:
+                        batch.append(line.rstrip())
+                        if len(batch) >= batchSize:
+                            rows = self.selectRows(batch)
+                            if rows:
+                                yield rows
+                            batch = []
+
+                if pastEnd:
+                    break
+        finally:
+            file.close()
+            self.stats.add("bytesRead", bytesRead)
+            self.stats.add("rowsParsed", lcount)
+
+        rows = self.selectRows(batch)
+        if rows:
+            yield rows
+
+    def _iterColumnar(self, filename, byteRange=None):
+        """
+        Finds the matching rows using the columnar copy of the partition and
+        copies them out of the text partition.
+        """
+        if self.verbose and byteRange is None:
+            print "\nFiltering file '%s' using its columnar copy." % filename
+
+        (offsets, lengths) = columnarStore.queryRowPositions(
+            filename, self.timeColumn, self.startTimeLong, self.endTimeLong,
+            self.srcidColumn, self.srcIdSet, byteRange)
+        if len(offsets) == 0:
+            return
+        self.stats.add("bytesRead", int(lengths.sum()))
+        self.stats.add("rowsParsed", len(offsets))
+
+        batchSize = self.batchSize
+        file = open(filename, "rb")
+        buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for first in xrange(0, len(offsets), batchSize):
+                batch = [buf[offset:offset + length].rstrip() for (offset, length) in
+                         zip(offsets[first:first + batchSize].tolist(), lengths[first:first + batchSize].tolist())]
+                rows = self.selectRows(batch)
+                if rows:
+                    yield rows
+        finally:
+            buf.close()
+            file.close()
+
+    def _iterMapped(self, buf, position, endPosition, progress=None):
+        """
+        Filters the rows starting between ``position`` and ``endPosition`` in
+        the memory-mapped partition ``buf``. Rows are parsed in place and only
+        those that match the time and stations are copied out, in batches, to
+        ``selectRows``.
+        """
+        getTime = self.tokenizer.getTime
+        getSrcId = self.tokenizer.getSrcId
+        srcIdSet = self.srcIdSet
+        startTimeLong = self.startTimeLong
+        endTimeLong = self.endTimeLong
+        verbose = self.verbose
+        find = buf.find
+        size = len(buf)
+        batchSize = self.batchSize
+
+        batch = []
+        lcount = 0
+        startPosition = position
+
+        while position < endPosition:
+            lineEnd = find("\n", position)
+            if lineEnd < 0:
+                lineEnd = size
+
+            lcount = lcount+1
+            if verbose and lcount % 100000 == 0:
+                print "\tRead %s lines..." % lcount
+            if progress is not None and lcount % progressLines == 0:
+                progress.update(position)
+
+            dmatch = getTime(buf, position, lineEnd)
+
+            # Check if datetime has gone past the selected range
+            if dmatch and dmatch > endTimeLong:
+                if verbose:
+                    print "Breaking out of read loop because time past end time!"
+                break
+
+            # Now check if src ids need to match
+            if dmatch and startTimeLong <= dmatch and (
+                    srcIdSet is None or getSrcId(buf, position, lineEnd) in srcIdSet):
+                batch.append(buf[position:lineEnd].rstrip())
+                if len(batch) >= batchSize:
+                    rows = self.selectRows(batch)
+                    if rows:
+                        yield rows
+                    batch = []
+
+            position = lineEnd + 1
+
+        self.stats.add("bytesRead", min(position, endPosition) - startPosition)
+        self.stats.add("rowsParsed", lcount)
+        rows = self.selectRows(batch)
+        if rows:
+            yield rows
+
+    def _iterLines(self, file, position, endPosition, progress=None):
+        """
+        Filters the rows of the open partition file line by line, from the
+        current position until a line starting at or after ``endPosition``.
+        """
+        tokenizer = self.tokenizer
+        srcIdSet = self.srcIdSet
+        startTimeLong = self.startTimeLong
+        endTimeLong = self.endTimeLong
+        batchSize = self.batchSize
+
+        batch = []
+        lcount = 0
+        startPosition = position
+        line = file.readline()
+
+        while line:
+            if endPosition is not None and position >= endPosition:
+                break
+            position += len(line)
+
+            lcount = lcount+1
+            if self.verbose and lcount % 100000 == 0:
+                print "\tRead %s lines..." % lcount
+            if progress is not None and lcount % progressLines == 0:
+                progress.update(position)
+
+            line = line.strip()
+            dmatch = tokenizer.getTime(line)
+
+            # Check if datetime has gone past the selected range
+            if dmatch and dmatch > endTimeLong:
+                if self.verbose:
+                    print "Breaking out of read loop because time past end time!"
+                break
+
+            # Now check if src ids need to match
+            if dmatch and (srcIdSet is None or tokenizer.getSrcId(line) in srcIdSet):
+                if startTimeLong <= dmatch <= endTimeLong:
+                    batch.append(line)
+                    if len(batch) >= batchSize:
+                        rows = self.selectRows(batch)
+                        if rows:
+                            yield rows
+                        batch = []
+
+            line = file.readline()
+
+        self.stats.add("bytesRead", position - startPosition)
+        self.stats.add("rowsParsed", lcount)
+        rows = self.selectRows(batch)
+        if rows:
+            yield rows
+
+    def getOutputIndex(self, columnIndex):
+        """
+        Returns the index of a column of the table in the rows written by the
+        filter, or None if it is not one of the selected columns.
+        """
+        if self.columns is None:
+            return columnIndex
+        if columnIndex in self.columns:
+            return self.columns.index(columnIndex)
+        return None
+
+    def getOutputTimeIndex(self):
+        """
+        Returns the index of the time column in the rows written by the filter,
+        or None if it is not one of the selected columns.
+        """
+        return self.getOutputIndex(self.tokenizer.timeIndex)
+
+    def selectRows(self, rows):
+        """
+        Applies the value conditions and the column selection to a batch of rows
+        (without line endings) that matched the time and stations and returns
+        the list of selected rows.
+        """
+        stats = self.stats
+        stats.add("rowsMatched", len(rows))
+
+        if self.maxSplit is not None:
+            start = clock()
+            maxSplit = self.maxSplit
+            rows = [(row, row.split(fieldSeparator, maxSplit)) for row in rows]
+
+            for condition in self.conditions:
+                rows = condition.filter(rows)
+
+            if self.columns:
+                columns = self.columns
+                rows = [fieldSeparator.join([fields[i] if i < len(fields) else "" for i in columns])
+                        for (row, fields) in rows]
+            else:
+                rows = [row for (row, fields) in rows]
+            stats.addTime("filter", clock() - start)
+
+        stats.add("rowsWritten", len(rows))
+        return rows
+
+    def getStartOffset(self, file, filename):
+        """
+        Returns the offset in the open partition file of the first row that can
+        be at or after the start time according to the seek mode.
+        """
+        startOffset = None
+
+        if self.seekMode in ("auto", "index"):
+            startOffset = partitionIndex.getStartOffset(filename, self.startTimeLong)
+            if self.verbose and startOffset is not None:
+                print "Seeking to byte %s using time index." % startOffset
+
+        if startOffset is None and self.seekMode in ("auto", "bisect"):
+            startOffset = partitionIndex.bisectStartOffset(file, self.startTimeLong, self.tokenizer.getTime)
+            if self.verbose:
+                print "Seeking to byte %s found by bisection." % startOffset
+
+        return startOffset or 0
+
+    def mayMatchFile(self, filename):
+        """
+        Returns False if the zone map of the partition file shows that none of
+        its rows can match.
+        """
+        zoneMap = zoneMaps.readZoneMap(filename)
+        return zoneMap is None or zoneMap[0].mayMatch(self.startTimeLong, self.endTimeLong, self.srcIdSet)
+
+    def getStationRanges(self, filename):
+        """
+        Returns the sorted byte ranges of the partition file holding the rows of
+        the requested stations, or None if the station index is not to be used
+        (too many or no stations requested, or no up-to-date index).
+        """
+        if self.srcIdSet is None or len(self.srcIdSet) > self.maxIndexedStations:
+            return None
+        return partitionIndex.readStationRanges(filename, self.srcIdSet, stationRangeGap)
+
+    def getBlockStart(self, filename):
+        """
+        Returns the offset of the block of the compressed partition file to
+        start decompressing from according to the seek mode.
+        """
+        if self.seekMode == "scan":
+            return 0
+
+        start = compressedPartition.getBlockStart(filename, self.startTimeLong)
+        if self.verbose and start:
+            print "Starting from compressed block at byte %s." % start
+        return start
+
+    def getByteRanges(self, filename, splitSize=defaultSplitSize):
+        """
+        Returns a list of (start, end) byte ranges, aligned to the starts of
+        lines, covering the part of the partition file from the start time
+        onwards in pieces of about ``splitSize`` bytes. The ranges of compressed
+        partitions are aligned to their blocks instead. Partitions read through
+        their station index are not split.
+        """
+        if compressedPartition.isCompressed(filename):
+            return compressedPartition.getBlockRanges(filename, self.getBlockStart(filename), splitSize)
+
+        size = os.path.getsize(filename)
+        file = open(filename, "rb")
+        boundaries = [self.getStartOffset(file, filename)]
+
+        if self.getStationRanges(filename) is not None:
+            splitSize = size
+
+        while size - boundaries[-1] > splitSize:
+            # Move the split point on to the start of the next line
+            file.seek(boundaries[-1] + splitSize - 1)
+            file.readline()
+            boundaries.append(file.tell())
+
+        file.close()
+        boundaries.append(size)
+        return [(start, end) for (start, end) in zip(boundaries[:-1], boundaries[1:]) if start < end]
+
+
+def _filterPartitionToFile(task):
+    """
+    Worker function: filters one byte range of a partition into its own output
+    file. Returns the number of rows written and the ``ExtractionStats`` of
+    the work done.
+    """
+    (partitionFilter, filename, byteRange, outputPath) = task
+    partitionFilter.stats = ExtractionStats()
+    output = open(outputPath, "wb")
+    try:
+        count = partitionFilter.filterPartition(filename, output, byteRange)
+    finally:
+        output.close()
+    return (count, partitionFilter.stats)
+
+
+def appendFile(inputPath, output, blockSize=1024 * 1024):
+    """
+    Copies the contents of the file at ``inputPath`` to the open ``output`` file
+    in blocks of whole lines.
+    """
+    data = open(inputPath, "rb")
+    block = data.read(blockSize)
+    while block:
+        output.write(block + data.readline())
+        block = data.read(blockSize)
+    data.close()
+
+
+def _waitForResult(results, interruptCheck=None):
+    """
+    Returns the next result of the worker pool's ``results`` iterator, checking
+    the ``interruptCheck`` (if given) while waiting.
+    """
+    if interruptCheck is None:
+        return results.next()
+
+    while True:
+        try:
+            return results.next(pollInterval)
+        except multiprocessing.TimeoutError:
+            interruptCheck.check()
+
+
+def iterPartitions(partitionFilter, fileList, progress=None, withinFiles=True):
+    """
+    Yields the batches of matching rows of each partition in ``fileList`` in
+    turn (see ``PartitionFilter.iterPartition``), in this process. The
+    ``progress`` (if given) is moved on as each file is finished and, if
+    ``withinFiles`` is set, as lines are read.
+    """
+    for filename in fileList:
+        for rows in partitionFilter.iterPartition(filename, progress=progress if withinFiles else None):
+            yield rows
+        if progress is not None:
+            progress.finishFile(os.path.getsize(filename))
+
+
+def filterPartitionJobs(jobs, workers=1, tempDir=None, splitSize=defaultSplitSize, progressCallback=None,
+                        interruptCheck=None):
+    """
+    Takes a list of jobs of the form (partitionFilter, fileList, output) and
+    filters each partition in a job's ``fileList`` into its open ``output`` file.
+    Returns a list of the number of rows written for each job.
+
+    If ``workers`` is more than 1 the partitions of all the jobs (split into byte
+    ranges of about ``splitSize`` bytes) are filtered together by a pool of
+    worker processes, each writing to its own file in ``tempDir``, and the
+    results are appended to the outputs in order.
+
+    If ``progressCallback`` is given it is called as ``progressCallback(doneBytes,
+    totalBytes)`` as the partitions are filtered, where ``totalBytes`` is the
+    total size of the partition files.
+
+    The ``interruptCheck`` (see 'cancellation.py'), if given, is checked every
+    ``progressLines`` lines and between files and ranges, and while waiting for
+    the workers. If it raises, the workers are stopped and their temporary
+    files removed before the exception is passed on.
+
+    The stats of the work done by the workers are added to the stats of each
+    job's filter.
+    """
+    counts = [0] * len(jobs)
+
+    if interruptCheck is not None and not interruptCheck.isActive():
+        interruptCheck = None
+
+    progress = getProgress([fileList for (partitionFilter, fileList, output) in jobs], progressCallback,
+                           interruptCheck)
+
+    tasks = []
+    skippedBytes = 0
+    prunedFilters = []
+    if workers > 1:
+        for (jobIndex, (partitionFilter, fileList, output)) in enumerate(jobs):
+            for filename in fileList:
+                if not partitionFilter.mayMatchFile(filename):
+                    prunedFilters.append(partitionFilter)
+                    skippedBytes += os.path.getsize(filename)
+                    continue
+
+                byteRanges = partitionFilter.getByteRanges(filename, splitSize)
+                # The parts of the file outside the ranges are already done
+                skippedBytes += os.path.getsize(filename) - sum(end - start for (start, end) in byteRanges)
+                for byteRange in byteRanges:
+                    partPath = os.path.join(tempDir, "part_%s_%05d" % (os.getpid(), len(tasks)))
+                    tasks.append((jobIndex, (partitionFilter, filename, byteRange, partPath)))
+
+    if len(tasks) < 2:
+        for (jobIndex, (partitionFilter, fileList, output)) in enumerate(jobs):
+            for filename in fileList:
+                counts[jobIndex] += partitionFilter.filterPartition(filename, output, progress=progress)
+                if progress is not None:
+                    progress.finishFile(os.path.getsize(filename))
+        return counts
+
+    for partitionFilter in prunedFilters:
+        partitionFilter.stats.add("filesPruned")
+    if progress is not None:
+        progress.finishFile(skippedBytes)
+
+    pool = multiprocessing.Pool(min(workers, len(tasks)))
+    try:
+        results = pool.imap(_filterPartitionToFile, [task for (jobIndex, task) in tasks])
+        for (jobIndex, task) in tasks:
+            (partCount, partStats) = _waitForResult(results, interruptCheck)
+            stats = jobs[jobIndex][0].stats
+            stats.merge(partStats)
+            with stats.timer("write"):
+                appendFile(task[-1], jobs[jobIndex][2])
+            counts[jobIndex] += partCount
+            if progress is not None:
+                (start, end) = task[2]
+                progress.finishFile(end - start)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        for (jobIndex, task) in tasks:
+            if os.path.exists(task[-1]):
+                os.unlink(task[-1])
+
+    return counts
@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+
+"""
+partitionIndex.py
+=================
+
+Builds and reads sidecar time and station indexes for the MIDAS partition files.
+
+Each partition file (e.g. 'nonsense-data_tempdrnl_201701-201712.txt') is written
+in time order. The index records the byte offset of the first row for every hour
+(or day) found in the file so that the subsetter can seek straight to the start
+of a requested time window instead of reading the file from the beginning.
+
+The index is written next to the partition with the suffix '.idx':
+
+    granularity hour
+    2017010109 0
+    2017010121 1187
+    ...
+
+A station index is written next to the partition with the suffix '.stations'.
+It maps each src_id to the byte ranges of the partition holding its rows (runs of
+consecutive rows of a station form one range). The header lists each station
+with its number of ranges and their position in the binary table of (start, end)
+offsets that follows it:
+
+    stations 2 8
+    926 365 0
+    1302 365 730
+    <binary offsets>
+
+Requests for a few stations then read only those ranges of the partition.
+
+The time index, the zone map (see 'zoneMaps.py') and the station index are
+built in a single pass over each partition. An index is only
+used if it is newer than its partition file. Partitions without
+an index can still be searched by bisection over their byte offsets (see
+``bisectStartOffset``) since the rows are sorted by time.
+
+Usage:
+======
+
+    partitionIndex.py -t <table> [-g <granularity>] [<partition_file> ...]
+
+Where:
+------
+
+    <table>     - is the name of the MIDAS table
+    -g          - granularity of the index: "hour" (default) or "day"
+    <partition_file> - files to index (default is all partitions of the table)
+
+Examples:
+=========
+
+partitionIndex.py -t TD
+
+partitionIndex.py -t TD -g day data/nonsense-data_tempdrnl_201701-201712.txt
+
+"""
+
+# Import required modules
+import os
+import sys
+import getopt
+import bisect
+import array
+
+import partitionCatalog
+import compressedPartition
+import zoneMaps
+
+
+indexSuffix = ".idx"
+stationIndexSuffix = ".stations"
+
+# Type of the byte offsets stored in the station index
+rangeTypeCode = "l"
+
+# Number of trailing digits removed from a YYYYMMDDhhmm time to get the index key
+granularities = {"hour": 100, "day": 10000}
+
+
+def getIndexPath(partitionPath):
+    "Returns the path of the time index for a partition file."
+    return partitionPath + indexSuffix
+
+
+def getStationIndexPath(partitionPath):
+    "Returns the path of the station index for a partition file."
+    return partitionPath + stationIndexSuffix
+
+
+class _TimeIndexBuilder:
+    """
+    Collects the offset of the first row of each hour (or day) of a partition.
+    """
+
+    def __init__(self, getTime, granularity="hour"):
+        self.getTime = getTime
+        self.granularity = granularity
+        self.divisor = granularities[granularity]
+        self.entries = []
+        self.lastKey = None
+
+    def add(self, line, offset):
+        dateLong = self.getTime(line)
+
+        if dateLong is not None:
+            key = dateLong // self.divisor
+            if key != self.lastKey:
+                self.entries.append((key, offset))
+                self.lastKey = key
+
+    def write(self, partitionPath):
+        indexPath = getIndexPath(partitionPath)
+        tempPath = indexPath + ".tmp"
+        output = open(tempPath, "w")
+        output.write("granularity %s\n" % self.granularity)
+        for key, keyOffset in self.entries:
+            output.write("%s %s\n" % (key, keyOffset))
+        output.close()
+        os.rename(tempPath, indexPath)
+        return indexPath
+
+
+class _StationIndexBuilder:
+    """
+    Collects the byte ranges of the rows of each station of a partition.
+    Consecutive rows of the same station are joined into one range.
+    """
+
+    def __init__(self, getSrcId):
+        self.getSrcId = getSrcId
+        self.ranges = {}
+
+    def add(self, line, offset):
+        src_id = self.getSrcId(line)
+        if src_id is None:
+            return
+
+        src_id = src_id.strip()
+        ranges = self.ranges.get(src_id)
+        if ranges is None:
+            ranges = self.ranges[src_id] = array.array(rangeTypeCode)
+
+        end = offset + len(line)
+        if ranges and ranges[-1] == offset:
+            ranges[-1] = end
+        else:
+            ranges.append(offset)
+            ranges.append(end)
+
+    def write(self, partitionPath):
+        indexPath = getStationIndexPath(partitionPath)
+        tempPath = indexPath + ".tmp"
+        stations = sorted(self.ranges.keys())
+
+        output = open(tempPath, "wb")
+        output.write("stations %s %s\n" % (len(stations), array.array(rangeTypeCode).itemsize))
+        position = 0
+        for src_id in stations:
+            nRanges = len(self.ranges[src_id]) // 2
+            output.write("%s %s %s\n" % (src_id, nRanges, position))
+            position += nRanges * 2
+        for src_id in stations:
+            self.ranges[src_id].tofile(output)
+        output.close()
+        os.rename(tempPath, indexPath)
+        return indexPath
+
+
+def _buildIndexes(partitionPath, builders):
+    """
+    Reads the partition file once, passing each line and its offset to each of
+    the index builders, and writes the indexes. Returns the index paths.
+    """
+    offset = 0
+    partition = open(partitionPath, "rb")
+    for line in partition:
+        for builder in builders:
+            builder.add(line, offset)
+        offset += len(line)
+    partition.close()
+
+    return [builder.write(partitionPath) for builder in builders]
+
+
+def buildTimeIndex(partitionPath, getTime, granularity="hour"):
+    """
+    Reads a partition file and writes its time index. ``getTime`` is called on
+    each line and returns its time as a long (YYYYMMDDhhmm) or None.
+    Returns the path to the index file.
+    """
+    return _buildIndexes(partitionPath, [_TimeIndexBuilder(getTime, granularity)])[0]
+
+
+def buildStationIndex(partitionPath, getSrcId):
+    """
+    Reads a partition file and writes its station index. ``getSrcId`` is called
+    on each line and returns its src_id or None. Returns the path to the index file.
+    """
+    return _buildIndexes(partitionPath, [_StationIndexBuilder(getSrcId)])[0]
+
+
+def buildPartitionIndexes(partitionPath, tokenizer, granularity="hour", zoneBlockSize=zoneMaps.defaultBlockSize):
+    """
+    Writes the time index, the zone map (see 'zoneMaps.py') and, if the
+    ``tokenizer`` has a src_id column, the station index of a partition file
+    in a single pass. Returns the index paths.
+    """
+    getSrcId = None
+    if tokenizer.srcidIndex is not None:
+        getSrcId = tokenizer.getSrcId
+
+    builders = [_TimeIndexBuilder(tokenizer.getTime, granularity),
+                zoneMaps.ZoneMapBuilder(tokenizer.getTime, getSrcId, zoneBlockSize)]
+    if getSrcId is not None:
+        builders.append(_StationIndexBuilder(getSrcId))
+    return _buildIndexes(partitionPath, builders)
+
+
+def readTimeIndex(partitionPath):
+    """
+    Returns a tuple of (divisor, keys, offsets) for the partition, or None if
+    there is no index or the index is older than the partition.
+    """
+    indexPath = getIndexPath(partitionPath)
+    try:
+        if os.path.getmtime(indexPath) < os.path.getmtime(partitionPath):
+            return None
+        index = open(indexPath)
+    except (IOError, OSError):
+        return None
+
+    granularity = index.readline().split()[1]
+    keys = []
+    offsets = []
+    for line in index:
+        key, offset = line.split()
+        keys.append(long(key))
+        offsets.append(long(offset))
+    index.close()
+
+    return (granularities[granularity], keys, offsets)
+
+
+def _isCurrent(indexPath, partitionPath):
+    "Returns True if the index exists and is newer than its partition."
+    try:
+        return os.path.getmtime(indexPath) >= os.path.getmtime(partitionPath)
+    except OSError:
+        return False
+
+
+def readStationRanges(partitionPath, src_ids, gap=0):
+    """
+    Returns a sorted list of (start, end) byte ranges holding the rows of the
+    stations in ``src_ids``, or None if there is no station index or it is
+    older than the partition. Ranges less than ``gap`` bytes apart are joined.
+    """
+    indexPath = getStationIndexPath(partitionPath)
+    if not _isCurrent(indexPath, partitionPath):
+        return None
+
+    index = open(indexPath, "rb")
+    (nStations, itemSize) = [int(item) for item in index.readline().split()[1:]]
+    if itemSize != array.array(rangeTypeCode).itemsize:
+        index.close()
+        return None
+
+    wanted = {}
+    for i in xrange(nStations):
+        (src_id, nRanges, position) = index.readline().split()
+        if src_id in src_ids:
+            wanted[src_id] = (int(nRanges), int(position))
+    dataStart = index.tell()
+
+    ranges = []
+    for (nRanges, position) in wanted.values():
+        stationRanges = array.array(rangeTypeCode)
+        index.seek(dataStart + position * itemSize)
+        stationRanges.fromfile(index, nRanges * 2)
+        ranges.extend(zip(stationRanges[::2], stationRanges[1::2]))
+    index.close()
+
+    ranges.sort()
+    merged = []
+    for (start, end) in ranges:
+        if merged and start - merged[-1][1] <= gap:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def getStartOffset(partitionPath, startTimeLong):
+    """
+    Returns the byte offset in the partition at which rows at or after
+    ``startTimeLong`` begin, or None if no usable index exists.
+    """
+    timeIndex = readTimeIndex(partitionPath)
+    if timeIndex is None:
+        return None
+
+    (divisor, keys, offsets) = timeIndex
+    position = bisect.bisect_left(keys, startTimeLong // divisor)
+
+    if position == len(keys):
+        return os.path.getsize(partitionPath)
+    return offsets[position]
+
+
+def _getLineAt(partition, position, getTime):
+    """
+    Returns a tuple of (lineStart, lineEnd, time) for the first line with a time
+    starting at or after ``position`` in the open partition file, or None at the
+    end of the file.
+    """
+    if position == 0:
+        partition.seek(0)
+    else:
+        # Step back one byte so that a line starting exactly at position is kept
+        partition.seek(position - 1)
+        partition.readline()
+
+    lineStart = partition.tell()
+    line = partition.readline()
+
+    while line:
+        dateLong = getTime(line)
+        lineEnd = lineStart + len(line)
+        if dateLong is not None:
+            return (lineStart, lineEnd, dateLong)
+
+        lineStart = lineEnd
+        line = partition.readline()
+
+    return None
+
+
+def bisectStartOffset(partition, startTimeLong, getTime, tolerance=65536):
+    """
+    Returns the byte offset of the first row at or after ``startTimeLong`` in the
+    open (time-sorted) partition file by binary search over its byte offsets.
+    The search stops once the window is smaller than ``tolerance`` bytes so the
+    offset returned may be a few rows early, but never late.
+    """
+    partition.seek(0, os.SEEK_END)
+    size = partition.tell()
+    low = 0
+    high = size
+
+    while high - low > tolerance:
+        middle = (low + high) // 2
+        found = _getLineAt(partition, middle, getTime)
+
+        if found is None or found[2] >= startTimeLong:
+            high = middle
+        else:
+            low = found[1]
+
+    found = _getLineAt(partition, low, getTime)
+    if found is None:
+        return size
+    return found[0]
+
+
+if __name__ == "__main__":
+
+    from midasSubsetter import tableMatch, getTimeColumnIndex, getColumnIndex, exitNicely, datadir, \
+        midasStructureTable
+    from rowTokenizer import RowTokenizer
+
+    argList = sys.argv[1:]
+    (args, partitionFiles) = getopt.getopt(argList, "t:g:")
+
+    tableName = None
+    granularity = "hour"
+
+    for arg, value in args:
+        if arg == "-t":
+            tableName = value.upper()
+        elif arg == "-g":
+            granularity = value
+
+    if not tableName:
+        exitNicely("Must provide table name with '-t' argument.")
+    if granularity not in granularities:
+        exitNicely("Granularity must be one of: %s" % ", ".join(granularities.keys()))
+
+    (tableID, longTableName) = tableMatch(tableName)
+    try:
+        srcidIndex = getColumnIndex(tableID, "src_id")
+    except Exception:
+        srcidIndex = None
+    tokenizer = RowTokenizer(getTimeColumnIndex(tableID), srcidIndex)
+
+    if not partitionFiles:
+        # Compressed partitions are read by streaming so are not indexed here
+        partitionFiles = [pfile for pfile in
+                          partitionCatalog.getPartitionFiles(datadir, longTableName, manifest=midasStructureTable)
+                          if not compressedPartition.isCompressed(pfile)]
+
+    for partitionFile in partitionFiles:
+        for indexPath in buildPartitionIndexes(partitionFile, tokenizer, granularity):
+            print "Wrote index: %s" % indexPath
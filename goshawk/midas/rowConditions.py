@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""
+rowConditions.py
+================
+
+Value conditions used to filter the rows of MIDAS extractions.
+
+Conditions are given as a dictionary of {<condition>: <value>} where <condition>
+is one of:
+
+    * range=<low>:<high>     [<low> and <high> are values]
+    * greater_than=<value>
+    * less_than=<value>
+    * exact=<match>          [<match> is a string]
+    * pattern=<pattern>      [<pattern> is a regular expression]
+
+The condition can be applied to a named column by writing it as
+<column>:<condition> (e.g. "max_air_temp:greater_than=25"). Otherwise it applies
+to each of the selected value columns.
+
+Each condition is compiled once into a test on a column index, with its
+values converted to the right type up front, and the conditions are sorted so
+that the cheapest and most selective are tested first. Rows are filtered in
+batches of (row, fields) pairs, one condition at a time.
+
+"""
+
+# Import required modules
+import re
+
+
+# Order in which conditions are applied: cheap string comparisons first, then
+# numeric comparisons (narrowest first) and regular expressions last.
+conditionRanks = {"exact": 0, "range": 1, "greater_than": 2, "less_than": 2, "pattern": 3}
+
+
+nan = float("nan")
+
+
+def _toFloat(value):
+    "Returns value as a float or NaN (which fails every comparison) if it is not a number."
+    try:
+        return float(value)
+    except ValueError:
+        return nan
+
+
+class RowCondition:
+    """
+    A condition on the value of one column of a row. The argument of the
+    condition is converted to its final type (numbers or a compiled regular
+    expression) when the condition is created.
+    """
+
+    def __init__(self, name, value, columnIndex):
+        """
+        Compiles condition ``name`` with argument ``value`` for column ``columnIndex``.
+        """
+        if name not in conditionRanks:
+            raise Exception("Condition not known: %s" % name)
+
+        self.name = name
+        self.value = value
+        self.columnIndex = columnIndex
+        self.rank = conditionRanks[name]
+
+        if name == "range":
+            self.argument = tuple([float(v) for v in value.split(":")])
+            if len(self.argument) != 2:
+                raise Exception("Range condition must be given as <low>:<high>: %s" % value)
+        elif name in ("greater_than", "less_than"):
+            self.argument = float(value)
+        elif name == "exact":
+            self.argument = value.strip()
+        else:
+            self.argument = re.compile(value)
+
+    def filter(self, rows):
+        """
+        Returns the (row, fields) pairs in ``rows`` whose field meets the condition.
+        """
+        index = self.columnIndex
+        name = self.name
+
+        if name == "range":
+            (low, high) = self.argument
+            return [row for row in rows if len(row[1]) > index and low <= _toFloat(row[1][index]) <= high]
+        elif name == "greater_than":
+            low = self.argument
+            return [row for row in rows if len(row[1]) > index and _toFloat(row[1][index]) > low]
+        elif name == "less_than":
+            high = self.argument
+            return [row for row in rows if len(row[1]) > index and _toFloat(row[1][index]) < high]
+        elif name == "exact":
+            match = self.argument
+            return [row for row in rows if len(row[1]) > index and row[1][index].strip() == match]
+
+        search = self.argument.search
+        return [row for row in rows if len(row[1]) > index and search(row[1][index])]
+
+
+def compileConditions(conditions, columnNames, valueColumns):
+    """
+    Returns a list of ``RowCondition`` objects, in the order they should be
+    applied, for the ``conditions`` dictionary. ``columnNames`` lists the
+    columns of the table and ``valueColumns`` the indexes of the columns that
+    conditions without a column name apply to.
+    """
+    compiled = []
+
+    for (key, value) in conditions.items():
+        if ":" in key:
+            (columnName, name) = key.split(":", 1)
+            columnName = columnName.strip().lower()
+            if columnName not in columnNames:
+                raise Exception("Cannot find column name '%s' for condition '%s'" % (columnName, key))
+            columnIndexes = [columnNames.index(columnName)]
+        else:
+            name = key
+            if not valueColumns:
+                raise Exception("Condition '%s' needs a column name or a selection of columns." % key)
+            columnIndexes = valueColumns
+
+        for columnIndex in columnIndexes:
+            compiled.append(RowCondition(name.strip(), value, columnIndex))
+
+    compiled.sort(key=lambda condition: condition.rank)
+    return compiled
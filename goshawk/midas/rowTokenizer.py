@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""
+rowTokenizer.py
+===============
+
+Fast positional access to the fields of MIDAS rows.
+
+Rows are byte strings of fields separated by ", ", e.g.:
+
+    2017-01-01 09:00, CLBD, 4835, 12, 1, AWSDLY, 57254, 1011, 7.6, 1.9, , , 1, ...
+
+Rather than splitting a whole row (or matching it with a regular expression) only
+the fields up to the required column are separated, and date/times of the form
+"YYYY-MM-DD hh:mm" are converted to a YYYYMMDDhhmm number by checking the
+separators at their fixed offsets and dropping them.
+
+All functions take a buffer with optional ``start`` and ``end`` positions so they
+work equally on a single line or on a row held within a larger buffer (such as a
+memory-mapped partition).
+
+"""
+
+fieldSeparator = ", "
+
+# Length of "YYYY-MM-DD hh:mm" and the characters separating its parts
+timeLength = 16
+timeSeparators = "-: "
+
+
+def getField(buf, index, start=0, end=None):
+    """
+    Returns field ``index`` of the row as a string, or None if the row has fewer fields.
+    """
+    if start != 0 or end is not None:
+        # Splitting a slice of the row is much quicker than finding each separator
+        # with a loop of find() calls, so only the time is read in place
+        buf = buf[start:end]
+
+    fields = buf.split(fieldSeparator, index + 1)
+    if len(fields) <= index:
+        return None
+    if len(fields) == index + 1:
+        return fields[index].rstrip("\r\n")
+    return fields[index]
+
+
+def canonicalSrcId(src_id):
+    """
+    Returns a requested station ID as the partitions write it: without spaces
+    and, if it is a number, without leading zeros (e.g. "0926" becomes "926").
+    """
+    src_id = src_id.strip()
+    if src_id.isdigit():
+        return str(int(src_id))
+    return src_id
+
+
+def parseTime(buf, position):
+    """
+    Returns the date/time "YYYY-MM-DD hh:mm" found at ``position`` in ``buf`` as
+    a YYYYMMDDhhmm number, or None if there is no date/time there.
+    """
+    t = buf[position:position + timeLength]
+    if len(t) < timeLength or t[4] != "-" or t[7] != "-" or t[13] != ":":
+        return None
+
+    try:
+        return int(t.translate(None, timeSeparators))
+    except ValueError:
+        return None
+
+
+class RowTokenizer:
+    """
+    Extracts the time and station ID of rows from a given table layout.
+    """
+
+    def __init__(self, timeIndex, srcidIndex=None):
+        """
+        Sets the column indexes of the time and (optionally) the src_id fields.
+        """
+        self.timeIndex = timeIndex
+        self.srcidIndex = srcidIndex
+
+    def getTime(self, buf, start=0, end=None):
+        """
+        Returns the time of the row as a YYYYMMDDhhmm number, or None.
+        """
+        if self.timeIndex == 0:
+            return parseTime(buf, start)
+
+        field = getField(buf, self.timeIndex, start, end)
+        if field is None:
+            return None
+        return parseTime(field, 0)
+
+    def getSrcId(self, buf, start=0, end=None):
+        """
+        Returns the src_id of the row as a string, or None.
+        """
+        return getField(buf, self.srcidIndex, start, end)
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+
+"""
+syntheticData.py
+================
+
+Writes a synthetic MIDAS archive for tests and benchmarks.
+
+The archive has the same layout as the real one: the station metadata (SOURCE,
+SRCC and GEAR tables with their column lists) and the table structures under
+'metadata/', and monthly partition files named
+'nonsense-data_<label>_<YYYYMM>-<YYYYMM>.txt' under 'data/'. The rows of each
+partition are sorted by time and then src_id.
+
+Stations are spread over a grid of counties covering the UK. Their
+observations are only written for the months in which the station is open
+(every tenth station closes during the archive period). The output depends
+only on the arguments and the seed, so the same archive can be rebuilt on any
+machine, and each partition is generated from its own seed so the partitions
+can be written in any order.
+
+Rows are about 110 bytes for TD (two rows per station a day) and 65 bytes for
+RH (24 rows per station a day), so for example 3000 stations of RH over two
+years make about 3.5GB of partitions.
+
+Usage:
+======
+
+    syntheticData.py [-n <stations>] [-s <YYYYMM>] [-e <YYYYMM>] [-t <table1>[,<table2>...]]
+                     [-x <seed>] <archive_dir>
+
+Where:
+------
+
+    -n      - number of stations (default 100)
+    -s      - first month of the partitions (default 201701)
+    -e      - last month of the partitions (default 201712)
+    -t      - comma-separated list of tables: TD and/or RH (default TD)
+    -x      - seed of the generator (default 0)
+    <archive_dir> - directory in which 'metadata' and 'data' are written
+
+The partitions can then be indexed with 'partitionIndex.py'.
+
+Examples:
+=========
+
+syntheticData.py -n 500 -s 201601 -e 201612 -t TD,RH /tmp/midas
+
+"""
+
+# Import required modules
+import os
+import sys
+import zlib
+import getopt
+import random
+import calendar
+
+import partitionCatalog
+
+
+# Columns of the station metadata tables
+sourceColumns = ["SRC_ID", "SRC_NAME", "HIGH_PRCN_LAT", "HIGH_PRCN_LON", "LOC_GEOG_AREA_ID", "REC_ST_IND",
+                 "SRC_BGN_DATE", "SRC_TYPE", "ELEVATION", "SRC_END_DATE"]
+geogAreaColumns = ["GEOG_AREA_ID", "GEOG_AREA_NAME", "GEOG_AREA_TYPE", "WTHN_GEOG_AREA_ID", "REC_ST_IND"]
+sourceCapsColumns = ["ID", "ID_TYPE", "MET_DOMAIN_NAME", "SRC_CAP_BGN_DATE", "SRC_CAP_END_DATE",
+                     "PRIME_CAPABILITY_FLAG", "RCPT_METHOD_NAME", "DB_SEGMENT_NAME", "DATA_RETENTION_PERIOD",
+                     "SRC_ID", "COMM_MTHD_ID"]
+
+# Columns and hours of observation of the tables that can be generated
+tableColumns = {
+    "TD": ["ob_end_time", "id_type", "id", "ob_hour_count", "version_num", "met_domain_name", "src_id",
+           "rec_st_ind", "max_air_temp", "min_air_temp", "min_grss_temp", "min_conc_temp", "max_air_temp_q",
+           "min_air_temp_q", "min_grss_temp_q", "min_conc_temp_q", "meto_stmp_time", "midas_stmp_etime",
+           "max_air_temp_j", "min_air_temp_j", "min_grss_temp_j", "min_conc_temp_j"],
+    "RH": ["ob_end_time", "id", "id_type", "ob_hour_count", "version_num", "met_domain_name", "src_id",
+           "rec_st_ind", "prcp_amt", "prcp_dur", "prcp_amt_q", "prcp_dur_q", "meto_stmp_time",
+           "midas_stmp_etime", "prcp_amt_j"]}
+tableNames = {"TD": "TEMP_DRNL_OB", "RH": "RAIN_HRLY_OB"}
+tableHours = {"TD": (9, 21), "RH": range(24)}
+
+defaultCounties = ["CORNWALL", "DEVON", "WILTSHIRE", "SOMERSET", "DORSET", "HAMPSHIRE", "KENT", "ESSEX",
+                   "NORFOLK", "SUFFOLK", "OXFORDSHIRE", "GLOUCESTERSHIRE", "SHROPSHIRE", "CHESHIRE",
+                   "LANCASHIRE", "CUMBRIA", "NORTHUMBERLAND", "DURHAM", "NORTH YORKSHIRE", "LINCOLNSHIRE",
+                   "HIGHLAND", "FIFE", "GWYNEDD", "POWYS", "ANTRIM"]
+
+# Area of the UK over which the counties are laid out (N, W, S, E)
+ukBBox = (58.5, -6.0, 50.0, 1.7)
+
+openEndDate = "3999-12-31 00:00"
+
+
+def _getRandom(seed, *keys):
+    "Returns a random number generator seeded from ``seed`` and the keys."
+    key = "-".join([str(seed)] + [str(k) for k in keys])
+    return random.Random(zlib.crc32(key) & 0xffffffff)
+
+
+def _formatTime(year, month, day, hour, minute=0):
+    return "%04d-%02d-%02d %02d:%02d" % (year, month, day, hour, minute)
+
+
+def _iterMonths(startMonth, endMonth):
+    "Yields (year, month) for each month from startMonth to endMonth (as YYYYMM strings)."
+    (year, month) = (int(startMonth[:4]), int(startMonth[4:6]))
+    while "%04d%02d" % (year, month) <= endMonth:
+        yield (year, month)
+        (year, month) = (year + month // 12, month % 12 + 1)
+
+
+class County:
+    """
+    A county and the box (N, W, S, E) within which its stations lie.
+    """
+
+    def __init__(self, areaID, name, bbox):
+        self.areaID = areaID
+        self.name = name
+        self.bbox = bbox
+
+
+class Station:
+    """
+    A station and the months (as YYYYMM strings) in which it is open.
+    """
+
+    def __init__(self, src_id, name, lat, lon, county, elevation, openMonth, closeMonth=None):
+        self.src_id = src_id
+        self.name = name
+        self.lat = lat
+        self.lon = lon
+        self.county = county
+        self.elevation = elevation
+        self.openMonth = openMonth
+        self.closeMonth = closeMonth
+
+    def isOpen(self, month):
+        "Returns True if the station is open during the month (YYYYMM)."
+        return self.openMonth <= month and (self.closeMonth is None or month <= self.closeMonth)
+
+    def getBeginDate(self):
+        return _formatTime(int(self.openMonth[:4]), int(self.openMonth[4:]), 1, 0)
+
+    def getEndDate(self):
+        if self.closeMonth is None:
+            return openEndDate
+        (year, month) = (int(self.closeMonth[:4]), int(self.closeMonth[4:]))
+        return _formatTime(year, month, calendar.monthrange(year, month)[1], 23, 59)
+
+
+def makeCounties(names=defaultCounties):
+    """
+    Returns a list of ``County`` objects laid out on a grid over the UK.
+    """
+    (n, w, s, e) = ukBBox
+    columns = int(len(names) ** 0.5 + 0.999)
+    rows = (len(names) + columns - 1) // columns
+    (height, width) = ((n - s) / rows, (e - w) / columns)
+
+    counties = []
+    for (i, name) in enumerate(names):
+        (row, column) = divmod(i, columns)
+        north = n - row * height
+        west = w + column * width
+        counties.append(County(str(1000 + i), name, (north, west, north - height, west + width)))
+    return counties
+
+
+def makeStations(nStations, startMonth="201701", endMonth="201712", counties=None, seed=0, src_ids=None):
+    """
+    Returns a list of ``nStations`` stations spread over the counties in
+    turn. ``src_ids`` can be given, otherwise they are drawn at random (in
+    ascending order). Every tenth station closes during the months from
+    ``startMonth`` to ``endMonth`` and all the others are open throughout.
+    """
+    if counties is None:
+        counties = makeCounties()
+    rng = _getRandom(seed, "stations")
+
+    if src_ids is None:
+        src_ids = [str(src_id) for src_id in sorted(rng.sample(xrange(1, 100000), nStations))]
+    months = ["%04d%02d" % month for month in _iterMonths(startMonth, endMonth)]
+
+    stations = []
+    for (i, src_id) in enumerate(src_ids):
+        county = counties[i % len(counties)]
+        (n, w, s, e) = county.bbox
+        closeMonth = None
+        if i % 10 == 9:
+            closeMonth = months[rng.randrange(len(months))]
+        openMonth = "%04d%02d" % (rng.randint(1950, int(startMonth[:4]) - 1), rng.randint(1, 12))
+        stations.append(Station(src_id, "SYNTHETIC STATION %s" % src_id, round(rng.uniform(s, n), 4),
+                                round(rng.uniform(w, e), 4), county, rng.randint(0, 900), openMonth, closeMonth))
+    return stations
+
+
+def _writeTable(path, rows):
+    output = open(path, "w")
+    for row in rows:
+        output.write(", ".join([str(item) for item in row]) + "\n")
+    output.close()
+
+
+def _writeColumns(path, columns):
+    output = open(path, "w")
+    output.write("\n".join(columns) + "\n")
+    output.close()
+
+
+def writeMetadata(metadatadir, stations, counties=None):
+    """
+    Writes the SOURCE, GEAR and SRCC tables of the stations (and the column
+    lists used to read them) under ``metadatadir``.
+    """
+    if counties is None:
+        counties = sorted(set(station.county for station in stations), key=lambda county: county.areaID)
+    structuresDir = os.path.join(metadatadir, "table_structures")
+    if not os.path.isdir(structuresDir):
+        os.makedirs(structuresDir)
+
+    _writeColumns(os.path.join(metadatadir, "SOURCE.txt"), sourceColumns)
+    _writeTable(os.path.join(metadatadir, "SRCE.DATA.COMMAS_REMOVED"),
+                [(station.src_id, station.name, station.lat, station.lon, station.county.areaID, 1001,
+                  station.getBeginDate(), "SFC", station.elevation, station.getEndDate())
+                 for station in stations])
+
+    # Stations refer to their county by the WTHN_GEOG_AREA_ID of its row
+    _writeColumns(os.path.join(metadatadir, "GEOGRAPHIC_AREA.txt"), geogAreaColumns)
+    _writeTable(os.path.join(metadatadir, "GEAR.DATA"),
+                [(county.areaID, county.name, "COUNTY", county.areaID, 1001) for county in counties])
+
+    _writeColumns(os.path.join(structuresDir, "SCTB.txt"), sourceCapsColumns)
+    capabilities = []
+    for station in stations:
+        for (idType, domain) in (("DCNN", "NCM"), ("RAIN", "SREW")):
+            capabilities.append((station.src_id, idType, domain, station.getBeginDate(), station.getEndDate(),
+                                 "T", "SYNOP", "MIDAS", 100, station.src_id, 1))
+    _writeTable(os.path.join(metadatadir, "SRCC.DATA"), capabilities)
+
+
+def writeTableStructure(metadatadir, tableID):
+    """
+    Writes the column list of a table under ``metadatadir``.
+    """
+    structuresDir = os.path.join(metadatadir, "table_structures")
+    if not os.path.isdir(structuresDir):
+        os.makedirs(structuresDir)
+    _writeColumns(os.path.join(structuresDir, "%sTB.txt" % tableID), tableColumns[tableID])
+
+
+def _makeTDRow(rng, obTime, stampTime, src_id):
+    maxTemp = rng.gauss(12, 6)
+    return "%s, DCNN, %s, 12, 1, NCM, %s, 1011, %.1f, %.1f, , , 1, 1, , , %s, 0, , , ,\n" % (
+        obTime, src_id.zfill(4), src_id, maxTemp, maxTemp - rng.uniform(2, 10), stampTime)
+
+
+def _makeRHRow(rng, obTime, stampTime, src_id):
+    amount = 0.0
+    if rng.random() < 0.3:
+        amount = rng.expovariate(1.0)
+    return "%s, %s, RAIN, 1, 1, SREW, %s, 1001, %.1f, , 0, , %s, 0, \n" % (
+        obTime, src_id.zfill(5), src_id, amount, stampTime)
+
+
+rowMakers = {"TD": _makeTDRow, "RH": _makeRHRow}
+
+
+def getPartitionPath(datadir, tableID, year, month):
+    "Returns the path of the monthly partition of a table."
+    label = partitionCatalog.partitionLabels[tableNames[tableID]]
+    yyyymm = "%04d%02d" % (year, month)
+    return os.path.join(datadir, "nonsense-data_%s_%s-%s.txt" % (label, yyyymm, yyyymm))
+
+
+def writePartition(datadir, tableID, year, month, stations, seed=0):
+    """
+    Writes the monthly partition of a table for the stations open that month
+    and returns its path.
+    """
+    rng = _getRandom(seed, tableID, year, month)
+    makeRow = rowMakers[tableID]
+    yyyymm = "%04d%02d" % (year, month)
+    src_ids = [station.src_id for station in stations if station.isOpen(yyyymm)]
+    src_ids.sort(key=int)
+
+    path = getPartitionPath(datadir, tableID, year, month)
+    output = open(path, "w")
+    for day in range(1, calendar.monthrange(year, month)[1] + 1):
+        for hour in tableHours[tableID]:
+            obTime = _formatTime(year, month, day, hour)
+            stampTime = _formatTime(year, month, day, hour, 54)
+            output.writelines([makeRow(rng, obTime, stampTime, src_id) for src_id in src_ids])
+    output.close()
+    return path
+
+
+def writeArchive(archiveDir, nStations=100, startMonth="201701", endMonth="201712", tableIDs=("TD",), seed=0,
+                 verbose=1):
+    """
+    Writes the metadata, table structures and monthly partitions of a
+    synthetic archive under ``archiveDir``. Returns the list of stations.
+    """
+    metadatadir = os.path.join(archiveDir, "metadata")
+    datadir = os.path.join(archiveDir, "data")
+    if not os.path.isdir(datadir):
+        os.makedirs(datadir)
+
+    stations = makeStations(nStations, startMonth, endMonth, seed=seed)
+    writeMetadata(metadatadir, stations, makeCounties())
+
+    for tableID in tableIDs:
+        writeTableStructure(metadatadir, tableID)
+        for (year, month) in _iterMonths(startMonth, endMonth):
+            path = writePartition(datadir, tableID, year, month, stations, seed)
+            if verbose:
+                print "Wrote partition: %s (%s bytes)" % (path, os.path.getsize(path))
+
+    return stations
+
+
+def exitNicely(msg=""):
+    print __doc__
+    print "ERROR:", msg
+    sys.exit()
+
+
+if __name__ == "__main__":
+
+    argList = sys.argv[1:]
+    (args, rest) = getopt.getopt(argList, "n:s:e:t:x:")
+
+    nStations = 100
+    startMonth = "201701"
+    endMonth = "201712"
+    tableIDs = ["TD"]
+    seed = 0
+
+    for arg, value in args:
+        if arg == "-n":
+            nStations = int(value)
+        elif arg == "-s":
+            startMonth = value
+        elif arg == "-e":
+            endMonth = value
+        elif arg == "-t":
+            tableIDs = [tableID.strip().upper()[:2] for tableID in value.split(",")]
+        elif arg == "-x":
+            seed = int(value)
+
+    if len(rest) != 1:
+        exitNicely("Must provide the archive directory.")
+    for tableID in tableIDs:
+        if tableID not in tableColumns:
+            exitNicely("Table must be one of: %s" % ", ".join(sorted(tableColumns.keys())))
+    if len(startMonth) != 6 or len(endMonth) != 6 or startMonth > endMonth:
+        exitNicely("Start and end months must be given as YYYYMM with the start before the end.")
+
+    writeArchive(rest[0], nStations, startMonth, endMonth, tableIDs, seed)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+"""
+zoneMaps.py
+===========
+
+Zone maps: statistics of the rows held in each block of a MIDAS partition file.
+
+A partition is divided into blocks of whole rows (about 1MB each by default) and
+for each block, and for the file as a whole, the zone map records the byte range,
+the number of rows, the first and last times, the lowest and highest src_ids and
+a Bloom filter of the src_ids. The subsetter uses these to skip whole files and
+blocks that cannot hold any rows of the requested time window or stations, even
+when a partition has no other index.
+
+The zone map is written next to the partition with the suffix '.zones' by the
+index builder (see 'partitionIndex.py'):
+
+    zones 2
+    file 0 2097190 20480 201701010900 201703150900 926 61737 4 <bloom>
+    block 0 1048600 10240 201701010900 201702060900 926 61737 4 <bloom>
+    block 1048600 2097190 10240 201702060900 201703150900 926 61737 4 <bloom>
+
+where <bloom> is the bit array of the Bloom filter in hexadecimal, preceded by
+the number of hash functions. Times or src_ids that are not known are written
+as "-". A zone map is only used if it is newer than its partition file.
+
+"""
+
+# Import required modules
+import os
+import zlib
+import binascii
+
+
+zonesSuffix = ".zones"
+defaultBlockSize = 1024 * 1024
+
+# Bits of the Bloom filter per station and number of hash functions (about 1% false positives)
+bloomBitsPerStation = 10
+bloomHashes = 4
+
+
+def getZonesPath(partitionPath):
+    "Returns the path of the zone map for a partition file."
+    return partitionPath + zonesSuffix
+
+
+def _toInt(value):
+    "Returns value as an int or None if it is not a whole number."
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def _getBloomPositions(value, nBits, nHashes):
+    "Returns the bit positions of a string value in a Bloom filter of ``nBits`` bits."
+    first = zlib.crc32(value) & 0xffffffff
+    second = (zlib.adler32(value) & 0xffffffff) | 1
+    return [(first + i * second) % nBits for i in xrange(nHashes)]
+
+
+def makeBloomFilter(values, nHashes=bloomHashes):
+    "Returns a bytearray holding a Bloom filter of the string values."
+    nBytes = max(8, (len(values) * bloomBitsPerStation + 7) // 8)
+    bits = bytearray(nBytes)
+    for value in values:
+        for position in _getBloomPositions(value, nBytes * 8, nHashes):
+            bits[position >> 3] |= 1 << (position & 7)
+    return bits
+
+
+class Zone:
+    """
+    Statistics of the rows held in one byte range of a partition file.
+    """
+
+    def __init__(self, start, end, rows, minTime, maxTime, minSrcId, maxSrcId, nHashes, bloom):
+        self.start = start
+        self.end = end
+        self.rows = rows
+        self.minTime = minTime
+        self.maxTime = maxTime
+        self.minSrcId = minSrcId
+        self.maxSrcId = maxSrcId
+        self.nHashes = nHashes
+        self.bloom = bloom
+
+    def mayHoldStation(self, src_id):
+        "Returns False if the zone cannot hold rows of station ``src_id``."
+        if self.minSrcId is not None:
+            number = _toInt(src_id)
+            if number is not None and not self.minSrcId <= number <= self.maxSrcId:
+                return False
+
+        if self.bloom is None:
+            return True
+
+        bloom = self.bloom
+        for position in _getBloomPositions(src_id, len(bloom) * 8, self.nHashes):
+            if not bloom[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def mayMatch(self, startTimeLong, endTimeLong, srcIdSet=None):
+        """
+        Returns False if the zone cannot hold rows between the start and end
+        times from one of the stations in ``srcIdSet`` (if given).
+        """
+        if self.minTime is None or self.maxTime < startTimeLong or self.minTime > endTimeLong:
+            return False
+
+        if srcIdSet is not None:
+            for src_id in srcIdSet:
+                if self.mayHoldStation(src_id):
+                    return True
+            return False
+
+        return True
+
+    def format(self, kind):
+        "Returns the zone as a line of the zone map file."
+        items = [kind, self.start, self.end, self.rows, self.minTime, self.maxTime, self.minSrcId, self.maxSrcId,
+                 self.nHashes, binascii.hexlify(self.bloom) if self.bloom is not None else None]
+        return " ".join(["-" if item is None else str(item) for item in items]) + "\n"
+
+    @staticmethod
+    def parse(line):
+        "Returns the zone described by a line of the zone map file."
+        items = [None if item == "-" else item for item in line.split()]
+        (kind, start, end, rows, minTime, maxTime, minSrcId, maxSrcId, nHashes, bloom) = items
+        minTime = long(minTime) if minTime is not None else None
+        maxTime = long(maxTime) if maxTime is not None else None
+        minSrcId = int(minSrcId) if minSrcId is not None else None
+        maxSrcId = int(maxSrcId) if maxSrcId is not None else None
+        bloom = bytearray(binascii.unhexlify(bloom)) if bloom is not None else None
+        return Zone(long(start), long(end), int(rows), minTime, maxTime, minSrcId, maxSrcId, int(nHashes), bloom)
+
+
+class _ZoneStatistics:
+    """
+    Running statistics of the rows added to a zone.
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        self.rows = 0
+        self.minTime = None
+        self.maxTime = None
+        self.stations = set()
+
+    def add(self, dateLong, src_id, end):
+        self.end = end
+        self.rows += 1
+
+        if dateLong is not None:
+            if self.minTime is None or dateLong < self.minTime:
+                self.minTime = dateLong
+            if self.maxTime is None or dateLong > self.maxTime:
+                self.maxTime = dateLong
+
+        if src_id is not None:
+            self.stations.add(src_id)
+
+    def update(self, other):
+        "Adds the statistics of another zone following this one."
+        self.end = other.end
+        self.rows += other.rows
+        if other.minTime is not None:
+            self.minTime = other.minTime if self.minTime is None else min(self.minTime, other.minTime)
+            self.maxTime = other.maxTime if self.maxTime is None else max(self.maxTime, other.maxTime)
+        self.stations.update(other.stations)
+
+    def getZone(self, hasStations):
+        "Returns the ``Zone`` of the statistics."
+        minSrcId = maxSrcId = bloom = None
+        if hasStations:
+            bloom = makeBloomFilter(self.stations)
+            numbers = [_toInt(src_id) for src_id in self.stations]
+            if numbers and None not in numbers:
+                (minSrcId, maxSrcId) = (min(numbers), max(numbers))
+        return Zone(self.start, self.end, self.rows, self.minTime, self.maxTime, minSrcId, maxSrcId,
+                    bloomHashes, bloom)
+
+
+class ZoneMapBuilder:
+    """
+    Collects the zone map of a partition from its lines. Used by the index
+    builder of 'partitionIndex.py'.
+    """
+
+    def __init__(self, getTime, getSrcId=None, blockSize=defaultBlockSize):
+        self.getTime = getTime
+        self.getSrcId = getSrcId
+        self.blockSize = blockSize
+        self.blocks = []
+        self.block = _ZoneStatistics(0)
+
+    def add(self, line, offset):
+        if offset - self.block.start >= self.blockSize:
+            self.blocks.append(self.block)
+            self.block = _ZoneStatistics(offset)
+
+        src_id = None
+        if self.getSrcId is not None:
+            src_id = self.getSrcId(line)
+            if src_id is not None:
+                src_id = src_id.strip()
+
+        self.block.add(self.getTime(line), src_id, offset + len(line))
+
+    def write(self, partitionPath):
+        blocks = self.blocks
+        if self.block.rows:
+            blocks = blocks + [self.block]
+
+        total = _ZoneStatistics(0)
+        for block in blocks:
+            total.update(block)
+
+        hasStations = self.getSrcId is not None
+        zonesPath = getZonesPath(partitionPath)
+        tempPath = zonesPath + ".tmp"
+        output = open(tempPath, "w")
+        output.write("zones %s\n" % len(blocks))
+        output.write(total.getZone(hasStations).format("file"))
+        for block in blocks:
+            output.write(block.getZone(hasStations).format("block"))
+        output.close()
+        os.rename(tempPath, zonesPath)
+        return zonesPath
+
+
+def readZoneMap(partitionPath):
+    """
+    Returns a tuple of (fileZone, blockZones) for the partition, or None if
+    there is no zone map or it is older than the partition.
+    """
+    zonesPath = getZonesPath(partitionPath)
+    try:
+        if os.path.getmtime(zonesPath) < os.path.getmtime(partitionPath):
+            return None
+        zoneMap = open(zonesPath)
+    except (IOError, OSError):
+        return None
+
+    zoneMap.readline()
+    fileZone = Zone.parse(zoneMap.readline())
+    blockZones = [Zone.parse(line) for line in zoneMap]
+    zoneMap.close()
+
+    return (fileZone, blockZones)
+
+
+def getMatchingRanges(blockZones, startTimeLong, endTimeLong, srcIdSet=None, start=0, end=None):
+    """
+    Returns the sorted list of (start, end) byte ranges, between offsets
+    ``start`` and ``end``, of the blocks that may hold matching rows.
+    Neighbouring blocks are joined into one range.
+    """
+    ranges = []
+    for zone in blockZones:
+        if zone.end <= start or (end is not None and zone.start >= end):
+            continue
+        if not zone.mayMatch(startTimeLong, endTimeLong, srcIdSet):
+            continue
+
+        rangeStart = max(zone.start, start)
+        rangeEnd = zone.end if end is None else min(zone.end, end)
+        if ranges and ranges[-1][1] == rangeStart:
+            ranges[-1] = (ranges[-1][0], rangeEnd)
+        else:
+            ranges.append((rangeStart, rangeEnd))
+    return ranges
@@ -1,10 +1,23 @@
-from pywps import Process, LiteralInput, ComplexOutput, BoundingBoxInput, Format
+import os
+import re
+import time
+import shutil
+
+from pywps import Process, LiteralInput, ComplexOutput, BoundingBoxInput, Format, configuration
 from pywps.app.Common import Metadata
 
+from goshawk.util import get_station_list, extract_station_data, zip_files
+from goshawk.midas.outputWriters import formatExtensions
+from goshawk.midas.cancellation import ExtractionInterrupted
+from goshawk.midas.extractionStats import ExtractionStats
+
 import logging
 LOGGER = logging.getLogger("PYWPS")
 
 
+# Name of the station list written by the GetWeatherStations process
+STATIONS_FILE_NAME = 'weather_stations.txt'
+
 UK_COUNTIES = [
     'ABERDEENSHIRE',
     'ALDERNEY',
@@ -13,6 +26,24 @@ UK_COUNTIES = [
 ]
 
 
+def get_job_station_list(job_id):
+    """
+    Returns the station IDs listed in the output of a GetWeatherStations job,
+    which is stored in the directory of the job under the WPS output path.
+    """
+    if not re.match(r'^[0-9a-fA-F-]{32,36}$', job_id):
+        raise Exception('Invalid input job ID: {}'.format(job_id))
+
+    stations_file = os.path.join(configuration.get_config_value('server', 'outputpath'), job_id,
+                                 STATIONS_FILE_NAME)
+    if not os.path.isfile(stations_file):
+        raise Exception('No weather stations have been found for input job {}.'
+                        ' Please check the job ID and try again.'.format(job_id))
+
+    with open(stations_file) as reader:
+        return [line.strip() for line in reader if line.strip()]
+
+
 class ExtractUKStationData(Process):
     """A process extracting UK station data."""
     def __init__(self):
@@ -46,7 +77,8 @@ class ExtractUKStationData(Process):
                          data_type='string',
                          min_occurs=0),
             LiteralInput('InputJobId', 'Input Job Id',
-                         abstract='The Id of a separate WPS Job used to select a set of weather stations.',
+                         abstract='The Id of a separate GetWeatherStations WPS Job used to select a set of'
+                                  ' weather stations.',
                          data_type='string',
                          min_occurs=0),
             LiteralInput('ObsTableName', 'Obervation Table Name',
@@ -64,12 +96,24 @@ class ExtractUKStationData(Process):
                          data_type='string',
                          allowed_values=['comma', 'tab'],
                          min_occurs=0),
+            LiteralInput('OutputFormat', 'Output Format',
+                         abstract='The format of the output files: delimited text, or Arrow IPC, Parquet or'
+                                  ' NetCDF files with typed columns. The delimiter is only used for text.',
+                         data_type='string',
+                         allowed_values=['text', 'arrow', 'parquet', 'netcdf'],
+                         min_occurs=0),
+            LiteralInput('SortOrder', 'Sort Order',
+                         abstract='Order of the rows in each output file: grouped by "station" (then by time)'
+                                  ' or by "time" (then by station).',
+                         data_type='string',
+                         allowed_values=['station', 'time'],
+                         min_occurs=0),
         ]
         outputs = [
             ComplexOutput('output', 'Output',
-                          abstract='Station list as XML.',
+                          abstract='Zip file of the station data files, one for each time chunk.',
                           as_reference=True,
-                          supported_formats=[Format('text/xml')])]
+                          supported_formats=[Format('application/zip', extension='.zip')])]
 
         super(ExtractUKStationData, self).__init__(
             self._handler,
@@ -83,7 +127,8 @@ class ExtractUKStationData(Process):
                      ' You can select which stations you require using'
                      ' either a bounding box, a list of UK counties,'
                      ' a list of station IDs or an uploaded file containing station IDs.'
-                     ' Data is returned in CSV or tab-delimited text files.'
+                     ' Data is returned in CSV or tab-delimited text files,'
+                     ' or in Arrow, Parquet or NetCDF files.'
                      ' Please see the disclaimer.',
             keywords=['stations', 'uk', 'demo'],
             metadata=[
@@ -98,8 +143,103 @@ class ExtractUKStationData(Process):
             status_supported=True
         )
 
-    @staticmethod
-    def _handler(request, response):
+    def _handler(self, request, response):
         LOGGER.info("extracting UK station data")
-        response.outputs['output'].data = '<xml>Didcot</xml>'
+        response.update_status('Job is now running', 0)
+
+        start_time = request.inputs['StartDateTime'][0].data
+        end_time = request.inputs['EndDateTime'][0].data
+
+        # Resolve the list of stations: a request must select some stations
+        if 'InputJobId' in request.inputs:
+            station_ids = get_job_station_list(request.inputs['InputJobId'][0].data)
+        elif 'StationIDs' in request.inputs:
+            station_ids = [src_id for station_input in request.inputs['StationIDs']
+                           for src_id in station_input.data.replace(',', ' ').split()]
+        elif 'Counties' in request.inputs or 'BBox' in request.inputs:
+            counties = [county.data for county in request.inputs.get('Counties', [])]
+            bbox = request.inputs['BBox'][0].data if 'BBox' in request.inputs else None
+            station_ids = get_station_list(
+                counties=counties,
+                bbox=bbox,
+                data_types=[],
+                start_time=start_time,
+                end_time=end_time,
+                output_file=os.path.join(self.workdir, STATIONS_FILE_NAME))
+        else:
+            raise Exception('No weather stations have been selected. Please provide station IDs, counties,'
+                            ' a bounding box or the ID of a job that selected a set of weather stations.')
+
+        if not station_ids:
+            raise Exception('No weather stations have been found for this request.'
+                            ' Please modify your request and try again.')
+
+        if 'ObsTableName' in request.inputs:
+            obs_table = request.inputs['ObsTableName'][0].data
+        else:
+            obs_table = 'TD'
+
+        if 'Delimiter' in request.inputs:
+            delimiter = request.inputs['Delimiter'][0].data
+        else:
+            delimiter = 'comma'
+
+        if 'OutputFormat' in request.inputs:
+            output_format = request.inputs['OutputFormat'][0].data
+        else:
+            output_format = 'text'
+
+        if output_format == 'text':
+            ext = 'csv' if delimiter == 'comma' else 'txt'
+        else:
+            ext = formatExtensions[output_format]
+
+        if 'SortOrder' in request.inputs:
+            sort_order = request.inputs['SortOrder'][0].data
+        else:
+            sort_order = None
+
+        if 'OutputTimeChunk' in request.inputs:
+            time_chunk = request.inputs['OutputTimeChunk'][0].data
+        else:
+            time_chunk = None
+
+        response.update_status('Extracting station data', 5)
+
+        def report_progress(done_bytes, total_bytes):
+            # Reading the partitions takes the job from 5% to 95%
+            percentage = int(5 + 90 * done_bytes // max(total_bytes, 1))
+            response.update_status('Extracting station data: {0} of {1} bytes read'.format(
+                done_bytes, total_bytes), percentage)
+
+        # Extractions still running after the configured time are stopped
+        deadline = None
+        max_extraction_time = configuration.get_config_value('goshawk', 'max_extraction_time')
+        if max_extraction_time:
+            deadline = time.time() + float(max_extraction_time)
+
+        # Repeated requests are answered from the extraction cache if one is configured
+        cache_dir = configuration.get_config_value('goshawk', 'extraction_cache_dir') or None
+
+        # The partitions are read once with each row written to the file of its time chunk
+        temp_dir = os.path.join(self.workdir, 'tmp')
+        os.mkdir(temp_dir)
+        stats = ExtractionStats()
+        try:
+            output_paths = extract_station_data(
+                [obs_table], start_time, end_time, station_ids, time_chunk,
+                os.path.join(self.workdir, 'station_data'), delimiter, ext, temp_dir,
+                output_format=output_format, sort_order=sort_order, progress_callback=report_progress,
+                deadline=deadline, stats=stats, cache_dir=cache_dir)
+        except ExtractionInterrupted as err:
+            LOGGER.error('Extraction stopped: {}'.format(err))
+            raise Exception('The extraction was stopped: {}'.format(err))
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            LOGGER.info('Extraction stats for job {}: {}'.format(self.uuid, stats.format()))
+
+        LOGGER.info('Written output files: {}'.format(', '.join(output_paths)))
+        response.update_status('Writing zip file', 95)
+
+        response.outputs['output'].file = zip_files(output_paths, os.path.join(self.workdir, 'station_data.zip'))
         return response
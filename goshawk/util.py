@@ -1,4 +1,7 @@
-from goshawk.midas import getStations
+import os
+import zipfile
+
+from goshawk.midas import getStations, midasSubsetter, extractionCache
 
 
 def translate_bbox(wps_bbox):
@@ -34,6 +37,60 @@ def get_station_list(counties, bbox, data_types, start_time, end_time, output_fi
     return station_getter.stList
 
 
+def extract_station_data(obs_tables, start_time, end_time, src_ids, time_chunk, output_file_base,
+                         delimiter, ext, temp_dir, world_region=None, output_format="text", sort_order=None,
+                         progress_callback=None, cancel_token=None, deadline=None, stats=None, cache_dir=None):
+    """
+    Wrapper to call of midas subsetter code. Extracts data to a file for each
+    time chunk (or a single file if ``time_chunk`` is None) in a single pass over
+    the partition files, written in ``output_format`` ("text", "arrow",
+    "parquet" or "netcdf"), sorted by "station" or "time" if ``sort_order`` is given.
+    ``progress_callback(done_bytes, total_bytes)`` is called as the partition files are read.
+    The extraction is stopped with an ``ExtractionInterrupted`` exception if the
+    ``cancel_token`` is cancelled or the ``deadline`` (a ``time.time()`` value) passes.
+    The timings and counts of the extraction are added to ``stats`` (an ``ExtractionStats``) if given.
+    If ``cache_dir`` is given, a repeated request is answered from the extraction
+    cache held in that directory (see 'extractionCache.py') without reading the partitions.
+    Returns a list of output file paths produced.
+    """
+    output_path = "{0}.{1}".format(output_file_base, ext)
+    start_time = revert_datetime_to_long_string(start_time)[:12]
+    end_time = revert_datetime_to_long_string(end_time)[:12]
+    options = dict(
+        src_ids=src_ids,
+        region=world_region,
+        delimiter=delimiter,
+        tempDir=temp_dir,
+        timeChunk=time_chunk,
+        outputFormat=output_format,
+        sortOrder=sort_order,
+        progressCallback=progress_callback,
+        cancelToken=cancel_token,
+        deadline=deadline,
+        stats=stats,
+        verbose=0)
+
+    if cache_dir:
+        extractionCache.ExtractionCache(cache_dir, verbose=0).extract(
+            obs_tables, output_path, start_time, end_time, **options)
+        table_ids = [midasSubsetter.tableMatch(obs_table.upper())[0] for obs_table in obs_tables]
+        return midasSubsetter.getOutputPaths(table_ids, output_path, start_time, end_time, timeChunk=time_chunk)
+
+    subsetter = midasSubsetter.MIDASSubsetter(obs_tables, output_path, startTime=start_time, endTime=end_time,
+                                              **options)
+    return subsetter.outputPaths
+
+
+def zip_files(file_paths, zip_path):
+    """
+    Writes the files to a zip archive (without their directories).
+    """
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for file_path in file_paths:
+            archive.write(file_path, os.path.basename(file_path))
+    return zip_path
+
+
 def revert_datetime_to_long_string(dt):
     """
     Turns a date/time into a long string as needed by midas code.
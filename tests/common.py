@@ -2,6 +2,8 @@ from pywps import get_ElementMakerForVersion
 from pywps.app.basic import get_xpath_ns
 from pywps.tests import WpsClient, WpsTestResponse
 
+from goshawk.midas import midasSubsetter, getStations, syntheticData
+
 VERSION = "1.0.0"
 WPS, OWS = get_ElementMakerForVersion(VERSION)
 xpath_ns = get_xpath_ns(VERSION)
@@ -41,3 +43,50 @@ def get_output(doc):
             output[identifier_el.text] = data_el[0].text
 
     return output
+
+
+TD_COLUMNS = [
+    'ob_end_time', 'id_type', 'id', 'ob_hour_count', 'version_num', 'met_domain_name', 'src_id',
+    'rec_st_ind', 'max_air_temp', 'min_air_temp', 'min_grss_temp', 'min_conc_temp', 'max_air_temp_q',
+    'min_air_temp_q', 'min_grss_temp_q', 'min_conc_temp_q', 'meto_stmp_time', 'midas_stmp_etime',
+    'max_air_temp_j', 'min_air_temp_j', 'min_grss_temp_j', 'min_conc_temp_j',
+]
+
+STATIONS = ['926', '4835', '61737']
+
+
+def make_row(day, hour, src_id, month=1):
+    return ('2017-%02d-%02d %02d:00, DCNN, 0579, 12, 1, NCM, %s, 1011, 5.8, 8.3, , , 1, 1, , , '
+            '2017-%02d-%02d %02d:54, 0, , , ,\n' % (month, day, hour, src_id, month, day, hour - 1))
+
+
+def write_midas_archive(root):
+    """Writes a small TD archive for January and February 2017, and its station metadata, under the root directory."""
+    structures = root.mkdir('metadata').mkdir('table_structures')
+    structures.join('TDTB.txt').write('\n'.join(TD_COLUMNS) + '\n')
+    syntheticData.writeMetadata(str(root.join('metadata')),
+                                syntheticData.makeStations(len(STATIONS), '201701', '201702', src_ids=STATIONS))
+
+    data = root.mkdir('data')
+    rows = [make_row(day, hour, src_id)
+            for day in range(1, 32) for hour in (9, 21) for src_id in STATIONS]
+    data.join('nonsense-data_tempdrnl_201701-201701.txt').write(''.join(rows))
+    rows = [make_row(day, hour, src_id, month=2)
+            for day in range(1, 29) for hour in (9, 21) for src_id in STATIONS]
+    data.join('nonsense-data_tempdrnl_201702-201702.txt').write(''.join(rows))
+    return root
+
+
+def use_midas_archive(monkeypatch, root):
+    """Points the subsetter at the archive under the root directory."""
+    monkeypatch.setattr(midasSubsetter, 'base_dir', str(root))
+    monkeypatch.setattr(midasSubsetter, 'datadir', str(root.join('data')))
+    monkeypatch.setattr(midasSubsetter, 'metadatadir', str(root.join('metadata')))
+
+    metadata = root.join('metadata')
+    monkeypatch.setattr(getStations, 'sourceFile', str(metadata.join('SRCE.DATA.COMMAS_REMOVED')))
+    monkeypatch.setattr(getStations, 'sourceColsFile', str(metadata.join('SOURCE.txt')))
+    monkeypatch.setattr(getStations, 'sourceCapabilitiesFile', str(metadata.join('SRCC.DATA')))
+    monkeypatch.setattr(getStations, 'sourceCapsColsFile', str(metadata.join('table_structures', 'SCTB.txt')))
+    monkeypatch.setattr(getStations, 'geogAreaFile', str(metadata.join('GEAR.DATA')))
+    monkeypatch.setattr(getStations, 'geogAreaColsFile', str(metadata.join('GEOGRAPHIC_AREA.txt')))
@@ -0,0 +1,14 @@
+import os
+
+import pytest
+
+from goshawk.midas import midasSubsetter
+
+from .common import write_midas_archive, use_midas_archive
+
+
+@pytest.fixture(autouse=True)
+def example_midas_archive(tmpdir_factory, monkeypatch):
+    """Uses a small generated archive when the example MIDAS data are not installed."""
+    if not os.path.isdir(midasSubsetter.datadir):
+        use_midas_archive(monkeypatch, write_midas_archive(tmpdir_factory.mktemp('midas')))
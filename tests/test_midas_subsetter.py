@@ -0,0 +1,772 @@
+import os
+
+import pytest
+
+from goshawk.midas import midasSubsetter, outputWriters, partitionCatalog, partitionIndex, rowTokenizer, rowConditions
+from goshawk.midas.midasSubsetter import MIDASSubsetter
+from goshawk.midas.rowTokenizer import RowTokenizer
+
+from .common import TD_COLUMNS, make_row, write_midas_archive, use_midas_archive
+
+
+@pytest.fixture
+def midas_archive(tmpdir, monkeypatch):
+    """Writes a small TD archive for January and February 2017 and points the subsetter at it."""
+    write_midas_archive(tmpdir)
+    use_midas_archive(monkeypatch, tmpdir)
+    tmpdir.mkdir('tmp')
+    return tmpdir
+
+
+def add_wd_table(archive):
+    """Gives the WD table the same structure and rows as TD."""
+    archive.join('metadata', 'table_structures', 'WDTB.txt').write('\n'.join(TD_COLUMNS) + '\n')
+    for partition in archive.join('data').listdir('*_tempdrnl_*'):
+        partition.copy(archive.join('data', partition.basename.replace('tempdrnl', 'wxdrnl')))
+
+
+def extract(archive, start, end, **kwargs):
+    output = archive.join('output.txt')
+    MIDASSubsetter(['TD'], str(output), start, end, tempDir=str(archive.join('tmp')),
+                   verbose=0, **kwargs)
+    return output.read().splitlines()
+
+
+def test_extract_time_window(midas_archive):
+    lines = extract(midas_archive, '201701100000', '201701111000')
+    assert lines[0] == ', '.join(TD_COLUMNS)
+    assert len(lines) == 1 + 3 * 3
+    assert lines[1].startswith('2017-01-10 09:00')
+    assert lines[-1].startswith('2017-01-11 09:00')
+
+
+def test_time_index_seek(midas_archive):
+    partition = str(midas_archive.join('data', 'nonsense-data_tempdrnl_201701-201701.txt'))
+    expected = extract(midas_archive, '201701200000', '201701202359')
+
+    partitionIndex.buildTimeIndex(partition, RowTokenizer(0).getTime)
+    offset = partitionIndex.getStartOffset(partition, 201701200000)
+    with open(partition) as reader:
+        reader.seek(offset)
+        assert reader.readline().startswith('2017-01-20 09:00')
+
+    assert extract(midas_archive, '201701200000', '201701202359') == expected
+
+
+def test_bisect_start_offset(midas_archive):
+    partition = str(midas_archive.join('data', 'nonsense-data_tempdrnl_201701-201701.txt'))
+    get_time = RowTokenizer(0).getTime
+
+    with open(partition) as reader:
+        for start, first in [(201701151000, '2017-01-15 21:00'), (201701010000, '2017-01-01 09:00')]:
+            reader.seek(partitionIndex.bisectStartOffset(reader, start, get_time, tolerance=0))
+            assert reader.readline().startswith(first)
+
+        end = partitionIndex.bisectStartOffset(reader, 201702010000, get_time, tolerance=0)
+        assert end == os.path.getsize(partition)
+
+
+@pytest.mark.parametrize('seek_mode', ['bisect', 'scan'])
+def test_seek_modes_agree(midas_archive, seek_mode):
+    assert (extract(midas_archive, '201701150000', '201701161000', seekMode=seek_mode) ==
+            extract(midas_archive, '201701150000', '201701161000', seekMode='index'))
+
+
+def test_extract_station_ids(midas_archive):
+    lines = extract(midas_archive, '201701010000', '201701312359', src_ids=['61737', ' 926'])
+    src_ids = set(line.split(', ')[6] for line in lines[1:])
+    assert src_ids == set(['61737', '926'])
+    assert len(lines) == 1 + 31 * 2 * 2
+
+
+def test_parallel_workers(midas_archive):
+    serial = extract(midas_archive, '201701300000', '201702022359', src_ids=['926'])
+    assert len(serial) == 1 + 4 * 2
+    assert extract(midas_archive, '201701300000', '201702022359', src_ids=['926'], workers=2) == serial
+    assert not midas_archive.join('tmp').listdir()
+
+
+def test_station_index(midas_archive):
+    tokenizer = RowTokenizer(0, 6)
+    expected = [extract(midas_archive, '201701251000', '201702031000', src_ids=src_ids)
+                for src_ids in [['926'], ['4835', '61737']]]
+
+    for partition in midas_archive.join('data').listdir():
+        paths = partitionIndex.buildPartitionIndexes(str(partition), tokenizer)
+        assert [os.path.basename(path) for path in paths] == [partition.basename + suffix for suffix in
+                                                             ['.idx', '.zones', '.stations']]
+
+    partition = str(midas_archive.join('data', 'nonsense-data_tempdrnl_201701-201701.txt'))
+    ranges = partitionIndex.readStationRanges(partition, set(['926']))
+    assert len(ranges) == 31 * 2
+    with open(partition) as reader:
+        for (start, end) in ranges:
+            reader.seek(start)
+            assert reader.read(end - start).split(', ')[6] == '926'
+    assert len(partitionIndex.readStationRanges(partition, set(['926']), gap=1000)) < 10
+    assert partitionIndex.readStationRanges(partition, set(['1'])) == []
+
+    for lines, src_ids in zip(expected, [['926'], ['4835', '61737']]):
+        assert extract(midas_archive, '201701251000', '201702031000', src_ids=src_ids) == lines
+        assert extract(midas_archive, '201701251000', '201702031000', src_ids=src_ids,
+                       workers=2, splitSize=500) == lines
+
+    # Long station lists only use the station index up to maxIndexedStations stations
+    from goshawk.midas.extractionStats import ExtractionStats
+    src_ids = ['926', '4835'] + [str(src_id) for src_id in range(100000, 103000)]
+    counts = []
+    for maxIndexedStations in [50, len(src_ids)]:
+        stats = ExtractionStats()
+        lines = extract(midas_archive, '201701251000', '201702031000', src_ids=src_ids, stats=stats,
+                        maxIndexedStations=maxIndexedStations)
+        assert lines == extract(midas_archive, '201701251000', '201702031000', src_ids=['926', '4835'])
+        counts.append(stats.counts['rowsParsed'])
+    assert counts[1] < counts[0]
+
+
+def test_zone_maps(midas_archive):
+    from goshawk.midas import zoneMaps
+
+    queries = [('201701251000', '201702031000', None), ('201701030000', '201701052359', ['926']),
+               ('201701251000', '201702031000', ['4835', '1'])]
+    expected = [extract(midas_archive, start, end, src_ids=src_ids) for (start, end, src_ids) in queries]
+
+    for partition in midas_archive.join('data').listdir():
+        partitionIndex.buildPartitionIndexes(str(partition), RowTokenizer(0, 6), zoneBlockSize=500)
+        os.remove(partitionIndex.getStationIndexPath(str(partition)))
+
+    partition = str(midas_archive.join('data', 'nonsense-data_tempdrnl_201701-201701.txt'))
+    (file_zone, block_zones) = zoneMaps.readZoneMap(partition)
+    assert file_zone.rows == 31 * 2 * 3 and (file_zone.minTime, file_zone.maxTime) == (201701010900, 201701312100)
+    assert (file_zone.minSrcId, file_zone.maxSrcId) == (926, 61737)
+    assert sum(zone.rows for zone in block_zones) == file_zone.rows and len(block_zones) > 10
+    assert not file_zone.mayMatch(201701010000, 201701312359, frozenset(['1']))
+    assert not file_zone.mayMatch(201702010000, 201702282359)
+    ranges = zoneMaps.getMatchingRanges(block_zones, 201701100000, 201701112359)
+    assert len(ranges) == 1 and 0 < ranges[0][0] and ranges[0][1] < file_zone.end
+
+    for (start, end, src_ids), lines in zip(queries, expected):
+        assert extract(midas_archive, start, end, src_ids=src_ids) == lines
+        assert extract(midas_archive, start, end, src_ids=src_ids, seekMode='scan', useMmap=False) == lines
+        assert extract(midas_archive, start, end, src_ids=src_ids, workers=3, splitSize=700) == lines
+
+
+def test_progress_callback(midas_archive, monkeypatch):
+    from goshawk.midas import partitionFilter
+    monkeypatch.setattr(partitionFilter, 'progressLines', 5)
+    total = sum(partition.size() for partition in midas_archive.join('data').listdir())
+
+    for kwargs in [{}, {'useMmap': False}, {'workers': 3, 'splitSize': 1000}]:
+        reports = []
+        extract(midas_archive, '201701100000', '201702101000',
+                progressCallback=lambda done, total_bytes: reports.append((done, total_bytes)), **kwargs)
+        assert reports[0] == (0, total) and reports[-1] == (total, total)
+        assert [done for (done, total_bytes) in reports] == sorted(done for (done, total_bytes) in reports)
+        assert len(reports) > 5
+
+
+def test_extraction_stats(midas_archive):
+    from goshawk.midas.extractionStats import ExtractionStats
+    partitions = midas_archive.join('data').listdir()
+    output = midas_archive.join('output.txt')
+
+    for kwargs in [{}, {'useMmap': False}, {'workers': 3, 'splitSize': 1000}]:
+        stats = ExtractionStats()
+        extract(midas_archive, '201701010000', '201702282359', stats=stats, **kwargs)
+        counts = stats.asDict()
+        assert counts['filesConsidered'] == counts['filesSelected'] == 2 and counts['filesPruned'] == 0
+        assert counts['bytesRead'] == sum(partition.size() for partition in partitions)
+        assert counts['rowsParsed'] == counts['rowsMatched'] == counts['rowsWritten'] == 59 * 2 * 3
+        assert counts['bytesWritten'] == output.size()
+        assert counts['totalSeconds'] >= counts['scanSeconds'] > 0
+
+    stats = ExtractionStats()
+    extract(midas_archive, '201701010000', '201701312359', stats=stats, src_ids=['926'],
+            conditions={'max_air_temp:greater_than': '6'})
+    assert stats.counts['filesSelected'] == 1
+    assert stats.counts['rowsMatched'] == 31 * 2 and stats.counts['rowsWritten'] == 0
+
+    for partition in partitions:
+        partitionIndex.buildPartitionIndexes(str(partition), RowTokenizer(0, 6))
+    for kwargs in [{}, {'workers': 3, 'splitSize': 1000}]:
+        stats = ExtractionStats()
+        extract(midas_archive, '201701010000', '201702282359', stats=stats, src_ids=['99999'], **kwargs)
+        assert stats.counts['filesPruned'] == 2 and stats.counts['bytesRead'] == 0
+
+    stats = ExtractionStats()
+    stats.addTime('scan', 1.5)
+    stats.addTime('scan', -2.0)
+    assert stats.times['scan'] == 1.5
+
+
+def test_cancellation(midas_archive, monkeypatch):
+    import time
+    from goshawk.midas import cancellation, partitionFilter
+    monkeypatch.setattr(partitionFilter, 'progressLines', 5)
+    output = midas_archive.join('output.txt')
+
+    for kwargs in [{}, {'workers': 3, 'splitSize': 1000}, {'sortOrder': 'station', 'timeChunk': 'month'}]:
+        token = cancellation.CancellationToken()
+
+        def cancel(done, total):
+            if done > 0:
+                token.cancel()
+
+        with pytest.raises(cancellation.ExtractionCancelled):
+            extract(midas_archive, '201701010000', '201702282359', cancelToken=token, progressCallback=cancel,
+                    **kwargs)
+        assert not output.exists() and not midas_archive.join('tmp').listdir()
+        assert not midas_archive.listdir('output*')
+
+        with pytest.raises(cancellation.ExtractionDeadlineExceeded):
+            extract(midas_archive, '201701010000', '201702282359', deadline=time.time() - 1, **kwargs)
+        assert not midas_archive.listdir('output*') and not midas_archive.join('tmp').listdir()
+
+    assert len(extract(midas_archive, '201701010000', '201702282359', deadline=time.time() + 60,
+                       cancelToken=cancellation.CancellationToken())) == 1 + 59 * 2 * 3
+
+
+def test_quiet_extraction(midas_archive, capsys):
+    for kwargs in [{'src_ids': ['926']}, {'src_ids': ['1']}, {'timeChunk': 'month', 'sortOrder': 'time'},
+                   {'workers': 2, 'splitSize': 1000, 'seekMode': 'bisect'}, {'useMmap': False}]:
+        extract(midas_archive, '201701250000', '201702022359', **kwargs)
+    assert capsys.readouterr()[0] == ''
+
+
+def test_parallel_byte_ranges(midas_archive):
+    serial = extract(midas_archive, '201701030000', '201701292359')
+    assert extract(midas_archive, '201701030000', '201701292359', workers=3, splitSize=1000) == serial
+
+
+def test_mmap_matches_line_reader(midas_archive):
+    for kwargs in [{}, {'src_ids': ['4835']}, {'workers': 2, 'splitSize': 2000}]:
+        assert (extract(midas_archive, '201701251000', '201702031000', useMmap=False, **kwargs) ==
+                extract(midas_archive, '201701251000', '201702031000', **kwargs))
+
+
+def test_tab_delimited_output(midas_archive):
+    lines = extract(midas_archive, '201701300000', '201702022359', src_ids=['926'], delimiter='tab', workers=2)
+    assert lines[0] == '\t'.join(TD_COLUMNS)
+    assert lines[1].split('\t')[:3] == ['2017-01-30 09:00', 'DCNN', '0579']
+    assert len(lines) == 1 + 4 * 2
+
+
+def test_no_data_found(midas_archive):
+    lines = extract(midas_archive, '201701300000', '201702022359', src_ids=['1'])
+    assert lines[0].startswith('Your extraction request has run successfully, but no data')
+    assert not midas_archive.join('tmp').listdir()
+
+
+def test_multiple_tables(midas_archive):
+    add_wd_table(midas_archive)
+    output = midas_archive.join('output.txt')
+    MIDASSubsetter(['TD', 'WD'], str(output), '201701300000', '201702022359', src_ids=['926'],
+                   tempDir=str(midas_archive.join('tmp')), verbose=0, workers=2)
+    td_lines = midas_archive.join('output_TD.txt').read().splitlines()
+    assert td_lines == extract(midas_archive, '201701300000', '201702022359', src_ids=['926'])
+    assert midas_archive.join('output_WD.txt').read().splitlines()[1:] == td_lines[1:]
+
+    MIDASSubsetter(['TD', 'WD'], str(output), '201701300000', '201702022359', src_ids=['926'],
+                   tempDir=str(midas_archive.join('tmp')), verbose=0, mergeTables=True)
+    merged = output.read().splitlines()
+    assert merged[0] == 'TD, ' + td_lines[0]
+    assert merged[1] == 'WD, ' + td_lines[0]
+    assert merged[2:6] == ['TD, ' + td_lines[1], 'WD, ' + td_lines[1], 'TD, ' + td_lines[2], 'WD, ' + td_lines[2]]
+    assert len(merged) == 2 + 2 * (len(td_lines) - 1)
+    assert not midas_archive.join('tmp').listdir()
+
+
+def test_value_conditions(midas_archive):
+    lines = extract(midas_archive, '201701010000', '201701312359', conditions={'src_id:greater_than': '1000'})
+    assert set(line.split(', ')[6] for line in lines[1:]) == set(['4835', '61737'])
+
+    lines = extract(midas_archive, '201701010000', '201701312359',
+                    conditions={'met_domain_name:exact': 'NCM', 'src_id:range': '900:5000', 'id:pattern': '^05'},
+                    useMmap=False)
+    assert set(line.split(', ')[6] for line in lines[1:]) == set(['926', '4835'])
+    assert len(lines) == 1 + 31 * 2 * 2
+
+    lines = extract(midas_archive, '201701300000', '201702022359', columns=['1', '7', '9'],
+                    conditions={'less_than': '6'}, src_ids=['926'], workers=2, splitSize=1000)
+    assert lines[:3] == ['ob_end_time, src_id, max_air_temp',
+                         '2017-01-30 09:00, 926, 5.8', '2017-01-30 21:00, 926, 5.8']
+    assert len(lines) == 1 + 4 * 2
+
+    lines = extract(midas_archive, '201701300000', '201702022359', columns=['1', '9'],
+                    conditions={'greater_than': '6'})
+    assert lines[0].startswith('Your extraction request has run successfully, but no data')
+
+
+def test_select_columns_by_name(midas_archive):
+    lines = extract(midas_archive, '201701300000', '201702022359', columns=['src_id', 'OB_END_TIME', '10'],
+                    src_ids=['4835'], delimiter='tab')
+    assert lines[:2] == ['src_id\tob_end_time\tmin_air_temp', '4835\t2017-01-30 09:00\t8.3']
+    assert len(lines) == 1 + 4 * 2
+
+    add_wd_table(midas_archive)
+    output = midas_archive.join('output.txt')
+    MIDASSubsetter(['TD', 'WD'], str(output), '201701300000', '201701302359', columns=['src_id', 'ob_end_time'],
+                   src_ids=['926'], tempDir=str(midas_archive.join('tmp')), verbose=0, mergeTables=True)
+    assert output.read().splitlines() == [
+        'TD, src_id, ob_end_time', 'WD, src_id, ob_end_time',
+        'TD, 926, 2017-01-30 09:00', 'WD, 926, 2017-01-30 09:00',
+        'TD, 926, 2017-01-30 21:00', 'WD, 926, 2017-01-30 21:00']
+
+    with pytest.raises(Exception):
+        extract(midas_archive, '201701300000', '201702022359', columns=['no_such_column'])
+
+
+def test_table_structures_read_once(midas_archive, monkeypatch):
+    add_wd_table(midas_archive)
+    read = []
+    getRowHeaders = MIDASSubsetter._getRowHeaders
+    monkeypatch.setattr(MIDASSubsetter, '_getRowHeaders', lambda self, tableID: read.append(tableID) or
+                        getRowHeaders(self, tableID))
+
+    subsetter = MIDASSubsetter(['TD', 'WD'], None, '201701300000', '201701302359', columns=['src_id'],
+                               src_ids=['926'], tempDir=str(midas_archive.join('tmp')), verbose=0, run=False)
+    assert read == []
+    records = list(subsetter.iterRecords())
+    assert read == ['TD', 'WD']
+    assert [(type(record).__name__, record.src_id) for record in records] == [('TDRecord', '926')] * 2 + \
+        [('WDRecord', '926')] * 2
+
+
+def test_compile_conditions():
+    conditions = rowConditions.compileConditions(
+        {'pattern': '^5', 'id:exact': '0579', 'src_id:range': '1:10'}, TD_COLUMNS, [8, 9])
+    assert [(c.name, c.columnIndex) for c in conditions] == [
+        ('exact', 2), ('range', 6), ('pattern', 8), ('pattern', 9)]
+
+    rows = [(row, row.split(', ')) for row in ('0, 5.5', '0, x', '0, 7')]
+    assert rowConditions.RowCondition('greater_than', '5', 1).filter(rows) == [rows[0], rows[2]]
+
+    with pytest.raises(Exception):
+        rowConditions.compileConditions({'range': '1:2'}, TD_COLUMNS, [])
+    with pytest.raises(Exception):
+        rowConditions.compileConditions({'unknown:range': '1:2'}, TD_COLUMNS, [8])
+
+
+def test_partition_catalog(midas_archive):
+    data = midas_archive.join('data')
+    catalog = partitionCatalog.getCatalog(str(data))
+    assert partitionCatalog.getCatalog(str(data)) is catalog
+    assert catalog.getPartitionFiles('TEMP_DRNL_OB') == [
+        str(data.join('nonsense-data_tempdrnl_201701-201701.txt')),
+        str(data.join('nonsense-data_tempdrnl_201702-201702.txt'))]
+    # Tables whose label is not known or not used by any file get every partition file, as before labels
+    assert catalog.getPartitionFiles('WEATHER_DRNL_OB') == catalog.getPartitionFiles('TEMP_DRNL_OB')
+    assert catalog.getPartitionFiles('MARINE_OB') == catalog.getPartitionFiles('TEMP_DRNL_OB')
+
+    data.join('nonsense-data_glblwx-europe_201701-201701.txt').write('')
+    data.join('nonsense-data_glblwx-asia_201701-201701.txt').write('')
+    data.join('nonsense-data_tempdrnl_201701-201701.txt.idx').write('')
+    catalog = partitionCatalog.getCatalog(str(data))
+    assert len(catalog.getPartitionFiles('TEMP_DRNL_OB')) == 2
+    assert len(catalog.getPartitionFiles('GBL_WX_OB')) == 2
+    europe = str(data.join('nonsense-data_glblwx-europe_201701-201701.txt'))
+    assert catalog.getPartitionFiles('GBL_WX_OB', '6') == [europe]
+    assert len(catalog.getPartitionFiles('TEMP_DRNL_OB', '6')) == 2
+    assert len(catalog.getPartitionFiles('WEATHER_DRNL_OB')) == 4
+    assert catalog.getPartitionFiles('GBL_WX_OB', '5') == []
+
+
+@pytest.mark.parametrize('codec', ['gzip', 'bz2', 'zstd'])
+def test_compressed_partitions(midas_archive, codec):
+    if codec == 'zstd':
+        pytest.importorskip('zstandard')
+    from goshawk.midas import compressedPartition
+
+    expected = extract(midas_archive, '201701251000', '201702031000', src_ids=['4835', '926'])
+    for partition in midas_archive.join('data').listdir():
+        compressedPartition.compressPartition(str(partition), codec, blockSize=1000,
+                                              getTime=RowTokenizer(0).getTime)
+        partition.remove()
+
+    compressed = str(midas_archive.join('data', 'nonsense-data_tempdrnl_201701-201701.txt' +
+                                        compressedPartition.codecSuffixes[codec]))
+    (times, offsets) = compressedPartition.readBlockIndex(compressed)
+    assert len(offsets) > 10 and times == sorted(times)
+    start = compressedPartition.getBlockStart(compressed, 201701251000)
+    reader = compressedPartition.openPartition(compressed, start)
+    lines = reader.read().splitlines()
+    reader.close()
+    assert start > 0 and '2017-01-23' < lines[0] < '2017-01-25 10:00'
+    assert lines[-1].startswith('2017-01-31 21:00')
+
+    assert extract(midas_archive, '201701251000', '201702031000', src_ids=['4835', '926']) == expected
+    assert extract(midas_archive, '201701251000', '201702031000', src_ids=['4835', '926'],
+                   seekMode='scan') == expected
+    assert extract(midas_archive, '201701251000', '201702031000', src_ids=['4835', '926'],
+                   workers=3, splitSize=500) == expected
+
+
+@pytest.mark.parametrize('codec', ['gzip', 'bz2', 'zstd'])
+def test_multi_frame_partition(tmpdir, codec):
+    if codec == 'zstd':
+        pytest.importorskip('zstandard')
+    from goshawk.midas import compressedPartition
+
+    # Two frames concatenated, as written by other tools, with a block index
+    first = ''.join(make_row(day, 9, '926') + '\n' for day in range(1, 16))
+    second = ''.join(make_row(day, 9, '926') + '\n' for day in range(16, 32))
+    frames = [compressedPartition._compressBlock(codec, rows) for rows in (first, second)]
+    partition = tmpdir.join('nonsense-data_tempdrnl_201701-201701.txt' + compressedPartition.codecSuffixes[codec])
+    partition.write_binary(''.join(frames))
+    tmpdir.join(partition.basename + compressedPartition.blocksSuffix).write(
+        'codec %s\n201701010900 0\n201701160900 %s\n' % (codec, len(frames[0])))
+
+    reader = compressedPartition.openPartition(str(partition))
+    assert reader.read() == first + second
+    reader.close()
+
+    start = compressedPartition.getBlockStart(str(partition), 201701200000)
+    assert start == len(frames[0])
+    reader = compressedPartition.openPartition(str(partition), start)
+    assert reader.read() == second
+    reader.close()
+    reader = compressedPartition.openPartition(str(partition), 0, start)
+    assert reader.read() == first
+    reader.close()
+
+
+def test_extraction_cache(midas_archive, monkeypatch):
+    from goshawk.midas.extractionCache import ExtractionCache
+
+    cache = ExtractionCache(str(midas_archive.join('cache')), verbose=0)
+    output = midas_archive.join('output.txt')
+    kwargs = dict(tempDir=str(midas_archive.join('tmp')), verbose=0)
+    expected = extract(midas_archive, '201701300000', '201702022359', src_ids=['926', '4835'])
+    output.remove()
+
+    assert not cache.extract(['TD'], str(output), '201701300000', '201702022359', src_ids=['926', '4835'], **kwargs)
+    assert output.read().splitlines() == expected
+
+    # The same request (with stations in another order and a shorter start time) is a hit
+    output.remove()
+    assert cache.extract(['td'], str(output), '2017013000', '201702022359', src_ids=['4835 ', '926'], **kwargs)
+    assert output.read().splitlines() == expected
+    assert not cache.extract(['TD'], str(output), '201701300000', '201702022359', src_ids=['926'], **kwargs)
+
+    # Writing a new output over a cached one does not change the cache
+    extract(midas_archive, '201701010000', '201701012359')
+    assert cache.extract(['TD'], str(output), '201701300000', '201702022359', src_ids=['926', '4835'], **kwargs)
+    assert output.read().splitlines() == expected
+
+    # Changing a partition invalidates the entries
+    partition = midas_archive.join('data', 'nonsense-data_tempdrnl_201702-201702.txt')
+    partition.write(make_row(1, 9, '926', month=2))
+    assert not cache.extract(['TD'], str(output), '201701300000', '201702022359', src_ids=['926', '4835'],
+                             **kwargs)
+    assert len(output.read().splitlines()) == len(expected) - 7
+
+    # Least recently used entries are evicted to stay within the budget
+    cache.maxBytes = output.size() + 100
+    cache.evict()
+    assert len(midas_archive.join('cache').listdir()) == 1
+
+
+def test_extract_station_data_cache(midas_archive):
+    import datetime
+    from goshawk.util import extract_station_data
+    from goshawk.midas.extractionStats import ExtractionStats
+
+    cache_dir = midas_archive.join('cache')
+    output_base = str(midas_archive.join('station_data'))
+    args = (['TD'], datetime.datetime(2017, 1, 30), datetime.datetime(2017, 2, 2, 23, 59), ['926'], 'month',
+            output_base, 'default', 'csv', str(midas_archive.join('tmp')))
+    output_paths = extract_station_data(*args, cache_dir=str(cache_dir))
+    assert [os.path.basename(path) for path in output_paths] == [
+        'station_data-201701300000-201701312359.csv', 'station_data-201702010000-201702022359.csv']
+    expected = [open(path).read() for path in output_paths]
+    assert len(cache_dir.listdir()) == 1
+
+    # A repeated request is answered from the cache
+    for path in output_paths:
+        os.remove(path)
+    stats = ExtractionStats()
+    assert extract_station_data(*args, cache_dir=str(cache_dir), stats=stats) == output_paths
+    assert [open(path).read() for path in output_paths] == expected
+    assert stats.counts['bytesRead'] == 0
+
+
+def test_time_chunked_output(midas_archive):
+    assert outputWriters.splitTimeChunks('201612151200', '201702101000', 'month') == [
+        ('201612151200', '201612312359'), ('201701010000', '201701312359'), ('201702010000', '201702101000')]
+    assert outputWriters.splitTimeChunks('198705010000', '201001010000', 'decade') == [
+        ('198705010000', '198912312359'), ('199001010000', '199912312359'),
+        ('200001010000', '200912312359'), ('201001010000', '201001010000')]
+
+    output = midas_archive.join('output.csv')
+    subsetter = MIDASSubsetter(['TD'], str(output), '201612151200', '201702101000', src_ids=['926'],
+                               tempDir=str(midas_archive.join('tmp')), verbose=0, timeChunk='month', workers=2)
+    assert subsetter.outputPaths == [str(midas_archive.join(name)) for name in (
+        'output-201612151200-201612312359.csv', 'output-201701010000-201701312359.csv',
+        'output-201702010000-201702101000.csv')]
+
+    chunks = [open(path).read().splitlines() for path in subsetter.outputPaths]
+    assert chunks[0][0].startswith('Your extraction request has run successfully, but no data')
+    assert chunks[1] == extract(midas_archive, '201701010000', '201701312359', src_ids=['926'])
+    assert chunks[2] == extract(midas_archive, '201702010000', '201702101000', src_ids=['926'])
+
+
+def test_external_sort(midas_archive):
+    from goshawk.midas import externalSort
+
+    rows = [make_row(day, hour, src_id) for day in range(1, 11) for hour in (9, 21)
+            for src_id in ['61737', '926', '4835']]
+    output = midas_archive.join('sorted.txt')
+    writer = externalSort.SortingOutputWriter(outputWriters.TextOutputWriter(str(output), None),
+                                              externalSort.RowSortKey('station', 0, 6), str(midas_archive.join('tmp')),
+                                              maxBytes=500)
+    for first in range(0, len(rows), 7):
+        writer.write(''.join(rows[first:first + 7]))
+    assert len(writer.runs) > 5
+    writer.close()
+
+    by_station = sorted(rows, key=lambda row: (int(row.split(', ')[6]), row[:16]))
+    assert output.read() == ''.join(by_station)
+    assert not midas_archive.join('tmp').listdir()
+
+    lines = extract(midas_archive, '201701251000', '201702031000', sortOrder='station', workers=2, splitSize=1000)
+    expected = extract(midas_archive, '201701251000', '201702031000')
+    assert lines[0] == expected[0]
+    assert lines[1:] == sorted(expected[1:], key=lambda row: (int(row.split(', ')[6]), row[:16]))
+    lines = extract(midas_archive, '201701251000', '201702031000', sortOrder='time')
+    assert lines[1:] == sorted(expected[1:], key=lambda row: (row[:16], int(row.split(', ')[6])))
+
+    with pytest.raises(Exception):
+        extract(midas_archive, '201701251000', '201702031000', sortOrder='station', columns=['max_air_temp'])
+
+
+def test_external_sort_merge_passes(midas_archive, monkeypatch):
+    from goshawk.midas import externalSort
+    monkeypatch.setattr(externalSort, 'maxMergeRuns', 3)
+
+    rows = [make_row(day, hour, src_id) for day in range(1, 21) for hour in (9, 21)
+            for src_id in ['61737', '926', '4835']]
+    output = midas_archive.join('sorted.txt')
+    writer = externalSort.SortingOutputWriter(outputWriters.TextOutputWriter(str(output), None),
+                                              externalSort.RowSortKey('time', 0, 6), str(midas_archive.join('tmp')),
+                                              maxBytes=100)
+    # No more than two runs of each level are kept open
+    for row in rows:
+        writer.write(row)
+        levels = [level for (level, runFile) in writer.runs]
+        assert all(levels.count(level) <= 2 for level in levels)
+    assert max(level for (level, runFile) in writer.runs) >= 2
+    writer.close()
+
+    by_time = sorted(rows, key=lambda row: (row[:16], int(row.split(', ')[6])))
+    assert output.read() == ''.join(by_time)
+    assert not midas_archive.join('tmp').listdir()
+
+
+def split_row(line):
+    """Splits a TD row into its fields as the typed output writers do."""
+    fields = line.split(', ', len(TD_COLUMNS) - 1)
+    return tuple(fields + [''] * (len(TD_COLUMNS) - len(fields)))
+
+
+def test_iter_records(midas_archive):
+    import time
+    from goshawk.midas import cancellation
+    tmp = str(midas_archive.join('tmp'))
+    expected = extract(midas_archive, '201701251000', '201702031000')
+    midas_archive.join('output.txt').remove()
+
+    records = midasSubsetter.iterRecords(['TD'], '201701251000', '201702031000', tempDir=tmp, verbose=0)
+    first = next(records)
+    assert type(first).__name__ == 'TDRecord'
+    assert first._fields == tuple(TD_COLUMNS)
+    assert (first.ob_end_time, first.src_id) == tuple(expected[1].split(', ')[i] for i in (0, 6))
+    assert [tuple(record) for record in [first] + list(records)] == [split_row(line) for line in expected[1:]]
+    assert not midas_archive.listdir('output*')
+
+    record_type = midasSubsetter.getRecordType('TD', ['a', 'b', 'c'])
+    assert list(midasSubsetter._iterRecordsOfRows(record_type, ['x,1, y, z, w', 'v'])) == [
+        ('x,1', 'y', 'z, w'), ('v', '', '')]
+
+    records = list(midasSubsetter.iterRecords(['TD'], '201701251000', '201702031000', tempDir=tmp, verbose=0,
+                                              sortOrder='station', columns=['ob_end_time', 'src_id']))
+    assert records[0]._fields == ('ob_end_time', 'src_id')
+    assert records == sorted(records, key=lambda record: (int(record.src_id), record.ob_end_time))
+    assert len(records) == len(expected) - 1
+    assert not midas_archive.join('tmp').listdir()
+
+    add_wd_table(midas_archive)
+    merged = list(midasSubsetter.iterRecords(['TD', 'WD'], '201701300000', '201702022359', src_ids=['926'],
+                                             tempDir=tmp, verbose=0, mergeTables=True))
+    assert [type(record).__name__ for record in merged[:4]] == ['TDRecord', 'WDRecord', 'TDRecord', 'WDRecord']
+    assert [record.ob_end_time for record in merged] == sorted(record.ob_end_time for record in merged)
+    assert len(merged) == 2 * 4 * 2
+
+    with pytest.raises(cancellation.ExtractionDeadlineExceeded):
+        list(midasSubsetter.iterRecords(['TD'], '201701010000', '201702282359', tempDir=tmp, verbose=0,
+                                        deadline=time.time() - 1))
+
+    subsetter = MIDASSubsetter(['TD'], None, '201701010000', '201702282359', verbose=0, run=False)
+    with pytest.raises(Exception):
+        subsetter.run()
+    assert len(list(subsetter.iterRecords())) == 59 * 2 * 3
+
+
+class ListOutputWriter(outputWriters.RecordOutputWriter):
+    """Keeps the converted batches in memory."""
+    formatName = 'list'
+
+    @classmethod
+    def checkAvailable(cls):
+        pass
+
+    def _open(self):
+        self.batches = []
+
+    def _writeBatch(self, columns, nRows, start):
+        assert start == sum(n_rows for (n_rows, batch) in self.batches)
+        self.batches.append((nRows, columns))
+
+    def _close(self):
+        pass
+
+
+def test_record_output_writer(midas_archive):
+    tmp = str(midas_archive.join('tmp'))
+    writer = ListOutputWriter(str(midas_archive.join('output.list')), TD_COLUMNS, batchSize=4, tempDir=tmp)
+    writer.write(make_row(1, 9, '926') + make_row(1, 9, '4835'))
+    writer.write(make_row(1, 21, '926') + make_row(1, 21, '4835') + make_row(2, 9, '926'))
+    types = dict(zip(TD_COLUMNS, writer.getColumnTypes()))
+    assert (types['ob_end_time'], types['id'], types['src_id'], types['max_air_temp'], types['min_grss_temp']) == (
+        'time', 'string', 'int', 'float', None)
+
+    # A later value that does not fit the type of its column widens the type
+    writer.write('2017-01-02 21:00, DCNN, 0579, 12, 1, NCM, 4835, 1011, n/a\n')
+    writer.close()
+    assert os.listdir(tmp) == []
+
+    assert writer.count == 6
+    assert [n_rows for (n_rows, columns) in writer.batches] == [4, 2]
+    types = dict(zip(TD_COLUMNS, writer.types))
+    assert (types['ob_end_time'], types['id'], types['src_id'], types['max_air_temp'], types['min_grss_temp']) == (
+        'time', 'string', 'int', 'string', 'string')
+
+    columns = dict(zip(TD_COLUMNS, writer.batches[0][1]))
+    assert columns['ob_end_time'][0] == 1483261200
+    assert columns['src_id'][:2] == [926, 4835]
+    assert columns['id'][0] == '0579' and columns['max_air_temp'][0] == '5.8'
+    assert columns['min_grss_temp'][0] is None
+    assert dict(zip(TD_COLUMNS, writer.batches[1][1]))['max_air_temp'] == ['5.8', 'n/a']
+
+    assert outputWriters.inferColumnTypes(['src_id', 'a', 'b'], [['1', '2.5'], ['1', '2017-01-01 09:00'], ['', '']]) \
+        == ['float', 'string', None]
+    assert outputWriters.mergeColumnTypes([['int', 'time', None, 'float'], ['float', 'time', 'time', None],
+                                           ['int', None, None, 'string']]) == ['float', 'time', 'time', 'string']
+
+
+def test_chunked_record_output(midas_archive, monkeypatch):
+    # The files of a chunked binary output share the column types found across all of them
+    writers = []
+
+    class ChunkListOutputWriter(ListOutputWriter):
+        def __init__(self, *args, **kwargs):
+            ListOutputWriter.__init__(self, *args, **kwargs)
+            writers.append(self)
+
+    monkeypatch.setitem(outputWriters.recordWriters, 'list', ChunkListOutputWriter)
+    chunks = outputWriters.splitTimeChunks('201701010000', '201703312359', 'month')
+    writer = outputWriters.ChunkedOutputWriter(str(midas_archive.join('output.list')), TD_COLUMNS, 'default',
+                                               chunks, RowTokenizer(0).getTime, 'list',
+                                               tempDir=str(midas_archive.join('tmp')), verbose=0)
+    writer.write(make_row(1, 9, '926'))
+    writer.write(make_row(1, 9, '4835', month=2).replace('5.8', 'n/a'))
+    writer.close()
+
+    assert len(writers) == 3
+    assert [w.types for w in writers] == [writers[0].types] * 3
+    assert dict(zip(TD_COLUMNS, writers[0].types))['max_air_temp'] == 'string'
+    assert dict(zip(TD_COLUMNS, writers[0].batches[0][1]))['max_air_temp'] == ['5.8']
+    assert writers[2].batches == []
+
+
+@pytest.mark.parametrize('output_format', ['arrow', 'parquet'])
+def test_arrow_output(midas_archive, output_format):
+    pyarrow = pytest.importorskip('pyarrow')
+    expected = extract(midas_archive, '201701251000', '201702031000', src_ids=['926'])
+
+    output = str(midas_archive.join('output.' + output_format))
+    MIDASSubsetter(['TD'], output, '201701251000', '201702031000', src_ids=['926'],
+                   tempDir=str(midas_archive.join('tmp')), verbose=0, outputFormat=output_format)
+    if output_format == 'arrow':
+        table = pyarrow.RecordBatchFileReader(pyarrow.OSFile(output)).read_all()
+    else:
+        table = pytest.importorskip('pyarrow.parquet').read_table(output)
+
+    assert table.schema.names == TD_COLUMNS
+    assert table.num_rows == len(expected) - 1
+    assert table.column('src_id').to_pylist() == [926] * table.num_rows
+
+
+def test_netcdf_output(midas_archive):
+    netCDF4 = pytest.importorskip('netCDF4')
+    expected = extract(midas_archive, '201701251000', '201702031000', src_ids=['926'])
+
+    output = str(midas_archive.join('output.nc'))
+    MIDASSubsetter(['TD'], output, '201701251000', '201702031000', src_ids=['926'],
+                   tempDir=str(midas_archive.join('tmp')), verbose=0, outputFormat='netcdf')
+    dataset = netCDF4.Dataset(output)
+    assert list(dataset.variables) == TD_COLUMNS
+    assert len(dataset.variables['src_id']) == len(expected) - 1
+    assert dataset.variables['ob_end_time'].units == 'seconds since 1970-01-01 00:00:00'
+    dataset.close()
+
+
+def test_row_tokenizer():
+    row = make_row(5, 21, '4835')
+    tokenizer = RowTokenizer(16, 6)
+    assert tokenizer.getTime(row) == 201701052054
+    assert tokenizer.getSrcId(row) == '4835'
+    assert RowTokenizer(0).getTime(row) == 201701052100
+    assert rowTokenizer.getField(row, 10) == ''
+    assert rowTokenizer.getField('a, b\r\n', 1) == 'b'
+    assert rowTokenizer.getField('a, b', 2) is None
+    assert rowTokenizer.parseTime('2017-01-05, 4835', 0) is None
+
+    # Fields are found within the row between start and end of a larger buffer
+    buf = 'a, b, c\nd, e\nf, g, h, i\n'
+    assert [rowTokenizer.getField(buf, i, 8, 12) for i in range(3)] == ['d', 'e', None]
+    assert tokenizer.getSrcId(make_row(1, 9, '926') + row, len(make_row(1, 9, '926')), None) == '4835'
+
+
+def test_columnar_store(midas_archive, monkeypatch):
+    pytest.importorskip('numpy')
+    from goshawk.midas import columnarStore
+
+    expected = extract(midas_archive, '201701251000', '201702031000', src_ids=['4835', '926'])
+    conditions = {'src_id:less_than': '1000'}
+    expected_926 = extract(midas_archive, '201701251000', '201702031000', conditions=conditions)
+    # Station IDs with leading zeros match the same rows on every path
+    assert extract(midas_archive, '201701251000', '201702031000', src_ids=['4835', '0926']) == expected
+    for partition in midas_archive.join('data').listdir():
+        columnarStore.buildColumnarStore(str(partition), TD_COLUMNS, 0, 6)
+        assert columnarStore.hasColumnarStore(str(partition))
+
+    store = columnarStore.getStorePath(str(midas_archive.join('data', 'nonsense-data_tempdrnl_201701-201701.txt')))
+    assert columnarStore.numpy.load(os.path.join(store, 'ob_end_time.npy')).dtype == 'int64'
+    assert columnarStore.numpy.load(os.path.join(store, 'src_id.npy')).dtype == 'int32'
+    assert columnarStore.numpy.load(os.path.join(store, 'max_air_temp.npy')).dtype == 'float32'
+
+    # Building the store in chunks of rows gives the same arrays
+    numpy = columnarStore.numpy
+    columns = dict((name, numpy.load(os.path.join(store, name))) for name in os.listdir(store) if name.endswith('.npy'))
+    monkeypatch.setattr(columnarStore, 'chunkRows', 7)
+    columnarStore.buildColumnarStore(store[:-len(columnarStore.storeSuffix)], TD_COLUMNS, 0, 6)
+    assert sorted(os.listdir(store)) == sorted(list(columns) + [columnarStore.completeFlag])
+    for (name, column) in columns.items():
+        chunked = numpy.load(os.path.join(store, name))
+        assert chunked.dtype == column.dtype and numpy.array_equal(numpy.isnan(chunked), numpy.isnan(column))
+        assert numpy.array_equal(chunked[~numpy.isnan(chunked)], column[~numpy.isnan(column)])
+
+    assert extract(midas_archive, '201701251000', '201702031000', src_ids=['4835', '926']) == expected
+    assert extract(midas_archive, '201701251000', '201702031000', conditions=conditions) == expected_926
+    assert extract(midas_archive, '201701251000', '201702031000', src_ids=['4835', ' 0926']) == expected
+    assert len(expected_926) == 1 + 9 * 2
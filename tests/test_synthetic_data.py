@@ -0,0 +1,59 @@
+from goshawk.midas import midasSubsetter, partitionCatalog, syntheticData
+from goshawk.midas.getStations import StationIDGetter
+from goshawk.midas.midasSubsetter import MIDASSubsetter
+
+from .common import use_midas_archive
+
+
+def write_archive(root, **kwargs):
+    return syntheticData.writeArchive(str(root), 30, '201701', '201703', ('TD', 'RH'), verbose=0, **kwargs)
+
+
+def test_archive_is_deterministic(tmpdir):
+    write_archive(tmpdir.mkdir('first'))
+    write_archive(tmpdir.mkdir('second'))
+    write_archive(tmpdir.mkdir('other'), seed=1)
+
+    names = sorted(path.basename for path in tmpdir.join('first', 'data').listdir())
+    assert len(names) == 6
+    for name in names:
+        assert partitionCatalog.partitionNamePattern.match(name)
+        assert midasSubsetter._partitionPattern.match(name)
+        assert tmpdir.join('first', 'data', name).read() == tmpdir.join('second', 'data', name).read()
+        assert tmpdir.join('first', 'data', name).read() != tmpdir.join('other', 'data', name).read()
+
+    for name in ['SRCE.DATA.COMMAS_REMOVED', 'SRCC.DATA', 'GEAR.DATA']:
+        assert tmpdir.join('first', 'metadata', name).read() == tmpdir.join('second', 'metadata', name).read()
+
+
+def test_extract_synthetic_archive(tmpdir, monkeypatch):
+    stations = write_archive(tmpdir)
+    use_midas_archive(monkeypatch, tmpdir)
+    closed = [station for station in stations if station.closeMonth is not None]
+    assert len(closed) == 3
+
+    output = tmpdir.join('output.txt')
+    MIDASSubsetter(['TD'], str(output), '201701010000', '201703312359', verbose=0)
+    rows = output.read().splitlines()[1:]
+    expected = sum(2 * 31 + 2 * 28 * station.isOpen('201702') + 2 * 31 * station.isOpen('201703')
+                   for station in stations)
+    assert len(rows) == expected
+
+    src_id = closed[0].src_id
+    MIDASSubsetter(['RH'], str(output), '201701010000', '201703312359', src_ids=[src_id], verbose=0)
+    rows = output.read().splitlines()[1:]
+    assert rows[-1].startswith('%s-%s-' % (closed[0].closeMonth[:4], closed[0].closeMonth[4:]))
+    assert set(row.split(', ')[6] for row in rows) == set([src_id])
+
+
+def test_station_lookups(tmpdir, monkeypatch):
+    stations = write_archive(tmpdir)
+    use_midas_archive(monkeypatch, tmpdir)
+
+    cornwall = [station for station in stations if station.county.name == 'CORNWALL']
+    getter = StationIDGetter(['cornwall'], None, [], None, None, noprint=1)
+    assert getter.getStationList() == [station.src_id for station in cornwall]
+
+    (n, w, s, e) = cornwall[0].county.bbox
+    getter = StationIDGetter([], [n, w, s, e], ['rain'], '201701010000', '201701312359', noprint=1)
+    assert set(getter.getStationList()) == set(station.src_id for station in cornwall)
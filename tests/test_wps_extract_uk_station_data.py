@@ -1,17 +1,56 @@
-import pytest
+import os
+import shutil
+import uuid
+import zipfile
 
-from pywps import Service
+from pywps import Service, configuration
 from pywps.tests import client_for, assert_response_success
 
 from .common import get_output
 from goshawk.processes.wps_extract_uk_station_data import ExtractUKStationData
 
 
-def test_wps_extract_uk_station_data():
+def execute(datainputs):
     client = client_for(Service(processes=[ExtractUKStationData()]))
-    datainputs = ""
-    resp = client.get(
+    return client.get(
         "?service=WPS&request=Execute&version=1.0.0&identifier=ExtractUKStationData&datainputs={}".format(
             datainputs))
+
+
+def test_wps_extract_uk_station_data():
+    resp = execute("StationIDs=926")
     assert_response_success(resp)
     assert 'output' in get_output(resp.xml)
+
+
+def test_wps_extract_uk_station_data_by_month():
+    resp = execute("StartDateTime=2017-01-15T00:00:00Z;EndDateTime=2017-02-28T23:59:00Z;"
+                   "StationIDs=926,4835;OutputTimeChunk=month;Delimiter=tab;SortOrder=station")
+    assert_response_success(resp)
+    assert get_output(resp.xml)['output'].endswith('.zip')
+
+
+def test_wps_extract_uk_station_data_needs_stations():
+    resp = execute("StartDateTime=2017-01-15T00:00:00Z;EndDateTime=2017-02-28T23:59:00Z")
+    assert 'ProcessFailed' in resp.data
+
+
+def test_wps_extract_uk_station_data_by_input_job():
+    job_id = str(uuid.uuid1())
+    job_dir = os.path.join(configuration.get_config_value('server', 'outputpath'), job_id)
+    os.makedirs(job_dir)
+    with open(os.path.join(job_dir, 'weather_stations.txt'), 'w') as writer:
+        writer.write('926\r\n4835\r\n')
+
+    resp = execute("StartDateTime=2017-01-15T00:00:00Z;EndDateTime=2017-02-28T23:59:00Z;"
+                   "InputJobId={}".format(job_id))
+    assert_response_success(resp)
+    zip_path = os.path.join(job_dir, '..', *get_output(resp.xml)['output'].split('/')[-2:])
+    with zipfile.ZipFile(zip_path) as zip_file:
+        rows = zip_file.read(zip_file.namelist()[0]).splitlines()[1:]
+    assert set(row.split(',')[6].strip() for row in rows) == set(['926', '4835'])
+
+    for bad_job_id in ['../../etc', str(uuid.uuid1())]:
+        resp = execute("InputJobId={}".format(bad_job_id))
+        assert 'ProcessFailed' in resp.data
+    shutil.rmtree(job_dir)